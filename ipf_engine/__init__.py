@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/12 11:20
+# @Author  : cy1026
+# @File    : __init__.py
+# @Software: PyCharm
+"""
+无界面的图片处理引擎，两个切分工具和批量任务共用。
+只依赖 OpenCV 与 NumPy；tkinter 不会被导入，rembg / onnxruntime / PIL 在第一次使用 AI 模式时才导入，
+模型目录也在那时才创建 (见 models)。
+
+    from ipf_engine import ImageProcessor, process
+    mask, crops = process(ImageProcessor.cv_imread(path), {"mode": "gray", "gray_thresh": 0, "bg_type": "white"})
+"""
+from .profiler import Profiler
+from .morphology import MorphologyEngine
+from .processor import ImageProcessor, MaskMode
+from .crops import CropEngine, MaskEncoder
+from .engine import MaskStages, process
+from .batch import BatchRunner, BatchManifest, process_file
+
+__all__ = ["Profiler", "MorphologyEngine", "ImageProcessor", "MaskMode", "CropEngine", "MaskEncoder", "MaskStages", "process",
+           "BatchRunner", "BatchManifest", "process_file"]
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/13 9:40
+# @Author  : cy1026
+# @File    : batch.py
+# @Software: PyCharm
+"""
+整个文件夹套用同一组参数的批量处理。结果清单 batch_manifest.json 放在输出目录，
+记录每张源图处理时的修改时间、大小和参数摘要以及写出的切片；三者都没变、切片也都完好的图片
+再次运行时直接跳过。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .engine import process
+from .processor import ImageProcessor
+
+MANIFEST_NAME = "batch_manifest.json"
+
+
+def params_digest(params):
+    """参数的短摘要，参数任一项变化后清单中的旧记录即失效。"""
+    text = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def process_file(src_path, output_dir, params, digest=None):
+    """
+    处理一张图片，把切片写成 {文件名}_{序号}.png，返回清单记录。
+    params 的 "mode" 为 ImageProcessor.MODES 中的名称；读取或写入失败时抛出异常。
+    """
+    st = os.stat(src_path)
+    image = ImageProcessor.cv_imread(src_path)
+    if image is None:
+        raise ValueError("无法读取图片")
+    _, crops = process(image, params)
+    base_name = os.path.splitext(os.path.basename(src_path))[0]
+    outputs = save_crops(crops, output_dir, base_name, params.get("png_compression", 1))
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "params": digest or params_digest(params),
+            "crops": outputs, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def save_crops(crops, output_dir, base_name, png_compression=1):
+    """把 process() 返回的切片写成 {base_name}_{序号}.png，返回 [{"file", "bbox", "size"}]。"""
+    outputs = []
+    for i, (box, crop) in enumerate(crops):
+        name = f"{base_name}_{i}.png"
+        path = os.path.join(output_dir, name)
+        if not ImageProcessor.cv_imwrite(path, crop, png_compression):
+            raise IOError(f"写入失败: {name}")
+        outputs.append({"file": name, "bbox": list(box), "size": os.path.getsize(path)})
+    return outputs
+
+
+class BatchManifest:
+    """输出目录中的结果清单：文件名 -> 清单记录。写入时先写临时文件再替换，中途退出也不会损坏。"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get("images", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"结果清单读取失败，将重新处理全部图片: {e}")
+
+    def is_done(self, name, st, digest):
+        entry = self.entries.get(name)
+        return (entry is not None and entry.get("mtime_ns") == st.st_mtime_ns
+                and entry.get("size") == st.st_size and entry.get("params") == digest
+                and self._outputs_intact(entry))
+
+    def _outputs_intact(self, entry):
+        """清单记录的切片须都还在输出目录中，且大小与写入时一致 (被删除或没写完的要重新处理)。"""
+        output_dir = os.path.dirname(self.path)
+        for crop in entry.get("crops", []):
+            try:
+                size = os.path.getsize(os.path.join(output_dir, crop["file"]))
+            except OSError:
+                return False
+            if size != crop.get("size", size):
+                return False
+        return True
+
+    def record(self, name, entry, flush_every=20):
+        with self._lock:
+            self.entries[name] = entry
+            self._dirty += 1
+            if self._dirty >= flush_every:
+                self._save_locked()
+
+    def save(self):
+        with self._lock:
+            if self._dirty:
+                self._save_locked()
+
+    def _save_locked(self):
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"images": self.entries}, f, ensure_ascii=False, indent=1)
+            os.replace(temp_path, self.path)
+            self._dirty = 0
+        except OSError as e:
+            print(f"结果清单写入失败: {e}")
+
+
+class BatchRunner:
+    """
+    在线程池中把 params 套用到 folder 下的 names，切片写入 output_dir。
+    计数器由工作线程累加，界面只读取；每处理完一张 (以及整批结束时) 在工作线程中调用 on_progress(runner)。
+    """
+    def __init__(self, folder, names, output_dir, params, workers=None, on_progress=None):
+        self.folder = folder
+        self.names = list(names)
+        self.output_dir = output_dir
+        self.params = params
+        self.digest = params_digest(params)
+        if workers is None:
+            # 给界面的预览线程留一个核；AI 推理本身已是多线程，并行只会互相争抢
+            workers = 1 if params.get("mode") == "rembg" else max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.workers = workers
+        self.on_progress = on_progress
+        self.manifest = BatchManifest(os.path.join(output_dir, MANIFEST_NAME))
+
+        self.total = len(self.names)
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.crops = 0
+        self.failures = []      # (文件名, 错误说明)
+        self.start_time = None
+        self.end_time = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def cancel(self):
+        """已开始的图片会处理完，排队中的不再处理。"""
+        self.cancelled = True
+
+    @property
+    def finished(self):
+        return self.end_time is not None
+
+    @property
+    def processed(self):
+        return self.done + self.failed
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def rate(self):
+        """每秒处理的图片数 (不含跳过的)。"""
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """剩余秒数，还没有处理完任何图片时返回 None。"""
+        rate = self.rate
+        if rate <= 0:
+            return None
+        return (self.total - self.skipped - self.processed) / rate
+
+    def _run(self):
+        try:
+            pending = []
+            for name in self.names:
+                try:
+                    st = os.stat(os.path.join(self.folder, name))
+                except OSError as e:
+                    self._fail(name, str(e))
+                    continue
+                if self.manifest.is_done(name, st, self.digest):
+                    self.skipped += 1
+                else:
+                    pending.append(name)
+            if self.skipped:
+                self._notify()
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as pool:
+                for name in pending:
+                    pool.submit(self._process_one, name)
+        finally:
+            self.manifest.save()
+            self.end_time = time.perf_counter()
+            self._notify()
+
+    def _process_one(self, name):
+        if self.cancelled:
+            return
+        try:
+            entry = process_file(os.path.join(self.folder, name), self.output_dir, self.params, self.digest)
+        except Exception as e:
+            self._fail(name, str(e))
+            return
+        self.manifest.record(name, entry)
+        with self._lock:
+            self.done += 1
+            self.crops += len(entry["crops"])
+        self._notify()
+
+    def _fail(self, name, message):
+        print(f"批量处理失败 {name}: {message}")
+        with self._lock:
+            self.failed += 1
+            self.failures.append((name, message))
+        self._notify()
+
+    def _notify(self):
+        if self.on_progress:
+            self.on_progress(self)
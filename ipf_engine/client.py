@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/14 11:10
+# @Author  : cy1026
+# @File    : client.py
+# @Software: PyCharm
+"""
+本地处理服务 (server.py) 的客户端。只用标准库，服务未启动时 health() 返回 None，调用方可退回本地处理。
+访问令牌默认每次请求时从 app_config.json 读取，服务重启换了令牌也不必重建客户端。
+
+    python -m ipf_engine.client a.png b.png --mode gray -o out_dir
+"""
+import argparse
+import json
+import urllib.error
+import urllib.request
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .server import CONFIG_FILE, DEFAULT_PORT, TOKEN_HEADER, read_token
+
+DEFAULT_URL = f"http://127.0.0.1:{DEFAULT_PORT}"
+
+
+class EngineClient:
+    def __init__(self, url=DEFAULT_URL, timeout=600, token=None, config_file=CONFIG_FILE):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.token = token
+        self.config_file = config_file
+
+    def _headers(self):
+        return {TOKEN_HEADER: self.token or read_token(self.config_file) or ""}
+
+    def health(self, timeout=0.5):
+        """服务状态；连不上或令牌无效时返回 None。"""
+        request = urllib.request.Request(f"{self.url}/health", headers=self._headers())
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read())
+        except (OSError, ValueError):
+            return None
+
+    def process(self, image, params, output_dir=None, priority=0, base_only=False, name=None):
+        """
+        image 为图片路径时只传路径；为数组时通过共享内存传图并取回蒙版 (结果的 "mask")。
+        返回服务端的结果字典，任务失败时抛出 RuntimeError。
+        """
+        request = {"params": params, "priority": priority, "base_only": base_only}
+        if output_dir:
+            request["output_dir"] = output_dir
+        if isinstance(image, str):
+            request["image"] = image
+            return self._check(self._post(request))
+
+        image = np.ascontiguousarray(image)
+        src = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        dst = shared_memory.SharedMemory(create=True, size=max(1, image.shape[0] * image.shape[1]))
+        try:
+            np.ndarray(image.shape, dtype=image.dtype, buffer=src.buf)[:] = image
+            request.update(shm={"name": src.name, "shape": list(image.shape), "dtype": image.dtype.str},
+                           mask_shm=dst.name, name=name or "image")
+            result = self._check(self._post(request))
+            result["mask"] = np.ndarray(image.shape[:2], dtype=np.uint8, buffer=dst.buf).copy()
+            return result
+        finally:
+            for shm in (src, dst):
+                shm.close()
+                shm.unlink()
+
+    def process_batch(self, paths, params, output_dir=None, priority=0):
+        """一次请求处理多张图片 (按路径)，返回与 paths 对应的结果列表；单个失败的结果中 ok 为 False。"""
+        requests = [{"image": path, "params": params, "priority": priority} for path in paths]
+        if output_dir:
+            for request in requests:
+                request["output_dir"] = output_dir
+        return self._post({"requests": requests})["results"]
+
+    def _post(self, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(f"{self.url}/process", data=data,
+                                         headers={"Content-Type": "application/json; charset=utf-8", **self._headers()})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"处理服务返回错误 {e.code}: {e.read().decode('utf-8', 'replace')}") from e
+
+    @staticmethod
+    def _check(result):
+        if not result.get("ok"):
+            raise RuntimeError(result.get("error", "处理失败"))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把图片交给本地处理服务")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--mode", default="rembg", help="ImageProcessor.MODES 中的模式名称")
+    parser.add_argument("--params", help="其余参数的 JSON 文件 (如界面保存的参数)")
+    parser.add_argument("-o", "--output", help="切片保存目录；不给出时只返回外接框")
+    parser.add_argument("--priority", type=int, default=0)
+    parser.add_argument("--url", default=DEFAULT_URL)
+    args = parser.parse_args()
+
+    params = {}
+    if args.params:
+        with open(args.params, 'r', encoding='utf-8') as f:
+            params = json.load(f)
+    params["mode"] = args.mode
+
+    client = EngineClient(args.url)
+    if client.health() is None:
+        parser.exit(1, f"连接不到处理服务 {args.url}，请先运行 python -m ipf_engine.server\n")
+    for path, result in zip(args.images, client.process_batch(args.images, params, args.output, args.priority)):
+        if result.get("ok"):
+            print(f"{path}: {len(result['boxes'])} 个对象, {result['ms']:.0f} ms")
+        else:
+            print(f"{path}: 失败 - {result.get('error')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/12 10:20
+# @Author  : cy1026
+# @File    : crops.py
+# @Software: PyCharm
+import cv2
+import numpy as np
+
+from .processor import ImageProcessor
+from .profiler import Profiler
+
+
+class CropEngine:
+    """
+    切片提取：一次 connectedComponentsWithStats 得到所有对象的外接框和面积，不再逐个轮廓求外接框。
+    先填充对象内部的孔洞，使孔洞里的小块归入外层对象 (与 findContours 的 RETR_EXTERNAL 一致)；
+    再丢弃面积过小的碎片，最后把间距不超过 merge_dist 的外接框合并成一个切片
+    (例如角色和与之分离的武器)。合并用网格空间索引 + 并查集，上万个对象时也接近线性。
+    """
+    MIN_SIDE = 10  # 宽或高小于该值的切片丢弃
+
+    @staticmethod
+    def find_boxes(mask, min_area=0, merge_dist=0):
+        """返回 [(x, y, w, h), ...]，按从上到下、从左到右排序。"""
+        return CropEngine.find_objects(mask, min_area, merge_dist)[0]
+
+    @staticmethod
+    @Profiler.timed("find_objects")
+    def find_objects(mask, min_area=0, merge_dist=0):
+        """
+        同 find_boxes，另外返回连通域标签图和“标签 -> 切片序号”的对照表 (被丢弃的为 -1)，
+        用于逐个对象导出蒙版。标签图基于填充孔洞后的蒙版，取对象像素时需再与原蒙版相与。
+        """
+        h, w = mask.shape[:2]
+        # 从边框向内漫水填充背景，没被填到的背景就是孔洞
+        flooded = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+        cv2.floodFill(flooded, None, (0, 0), 255)
+        filled = cv2.bitwise_or(mask, cv2.bitwise_not(flooded[1:h + 1, 1:w + 1]))
+
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(filled, connectivity=8)
+        kept = np.nonzero(stats[1:, cv2.CC_STAT_AREA] >= max(1, min_area))[0] + 1  # 第 0 个是背景
+        stats = stats[kept]
+        boxes = np.column_stack([stats[:, 0], stats[:, 1], stats[:, 0] + stats[:, 2], stats[:, 1] + stats[:, 3]])
+        members = np.arange(len(boxes))  # 每个连通域属于哪个框
+        if merge_dist > 0 and len(boxes) > 1:
+            boxes, members = CropEngine.merge_boxes(boxes, merge_dist)
+
+        sizes = boxes[:, 2:] - boxes[:, :2]
+        valid = np.nonzero((sizes >= CropEngine.MIN_SIDE).all(axis=1))[0]
+        valid = valid[np.lexsort((boxes[valid, 0], boxes[valid, 1]))]
+        rank = np.full(len(boxes), -1)
+        rank[valid] = np.arange(len(valid))
+        label_objects = np.full(count, -1)
+        label_objects[kept] = rank[members]
+        boxes = boxes[valid]
+        return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes.tolist()], labels, label_objects
+
+    @staticmethod
+    def cut(raw_image, alpha_mask, box):
+        """裁出 box 区域的 BGRA 切片；给定 alpha_mask 时把蒙版叠加到透明通道 (去背)。"""
+        x, y, w, h = box
+        region = raw_image[y:y + h, x:x + w]
+        crop = ImageProcessor.to_bgra(region)
+        if crop is region:
+            crop = crop.copy()
+        if alpha_mask is not None:
+            np.bitwise_and(crop[:, :, 3], alpha_mask[y:y + h, x:x + w], out=crop[:, :, 3])
+        return crop
+
+    @staticmethod
+    def merge_boxes(boxes, dist):
+        """
+        合并 (x0, y0, x1, y1) 外接框：水平、竖直间距都不超过 dist 的两框归为一组。
+        合并后的大框可能又靠近别的框，因此重复到不再合并为止；之后每轮只需查询上一轮变大的框。
+        返回 (合并后的框, 每个输入框并入了哪个框)。
+        """
+        active = np.arange(len(boxes))
+        members = np.arange(len(boxes))
+        while len(active):
+            boxes, active, groups = CropEngine._merge_once(boxes, dist, active)
+            members = groups[members]
+        return boxes, members
+
+    @staticmethod
+    def _near(boxes, box, dist):
+        x0, y0, x1, y1 = box
+        return np.nonzero((np.maximum(boxes[:, 0] - x1, x0 - boxes[:, 2]) <= dist) &
+                          (np.maximum(boxes[:, 1] - y1, y0 - boxes[:, 3]) <= dist))[0]
+
+    @staticmethod
+    def _merge_once(boxes, dist, active):
+        """查询 active 中每个框的邻居并合并，返回 (合并后的框, 本轮变大的框的下标, 旧框 -> 新框)。"""
+        n = len(boxes)
+        parent = list(range(n))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # 格子边长取典型框大小与 dist 的较大者，普通框只落在少数几个格子里；
+        # 跨越很多格子的大框 (通常是已经合并过的) 不进网格，单独逐个比较
+        spans = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        cell = max(dist, int(np.median(spans)), 1)
+        is_large = spans > cell * 8
+        large = np.nonzero(is_large)[0]
+        rows = boxes.tolist()
+        is_active = [False] * n
+        for i in active.tolist():
+            is_active[i] = True
+        grid = {}
+        for i in np.nonzero(~is_large)[0].tolist():
+            x0, y0, x1, y1 = rows[i]
+            for gy in range(y0 // cell, (y1 - 1) // cell + 1):
+                for gx in range(x0 // cell, (x1 - 1) // cell + 1):
+                    grid.setdefault((gx, gy), []).append(i)
+
+        for i in active.tolist():
+            x0, y0, x1, y1 = rows[i]
+            if is_large[i]:
+                candidates = CropEngine._near(boxes, rows[i], dist).tolist()
+            else:
+                candidates = large[CropEngine._near(boxes[large], rows[i], dist)].tolist() if len(large) else []
+                # 足够近的框满足 bx0 <= x1 + dist 且 bx1 - 1 >= x0 - dist - 1 (x1、bx1 不含)，
+                # 只可能落在这些格子里
+                for gy in range((y0 - dist - 1) // cell, (y1 + dist) // cell + 1):
+                    for gx in range((x0 - dist - 1) // cell, (x1 + dist) // cell + 1):
+                        for j in grid.get((gx, gy), ()):
+                            if j == i or (j < i and is_active[j]):
+                                continue  # 两框都要查询时，这一对只需检查一次
+                            bx0, by0, bx1, by1 = rows[j]
+                            if max(bx0 - x1, x0 - bx1) <= dist and max(by0 - y1, y0 - by1) <= dist:
+                                candidates.append(j)
+            for j in candidates:
+                ri, rj = find(i), find(j)
+                if ri != rj:
+                    parent[rj] = ri
+
+        roots = np.array([find(i) for i in range(n)])
+        _, groups, counts = np.unique(roots, return_inverse=True, return_counts=True)
+        merged = np.empty((len(counts), 4), dtype=boxes.dtype)
+        merged[:, :2] = np.iinfo(boxes.dtype).max
+        merged[:, 2:] = np.iinfo(boxes.dtype).min
+        np.minimum.at(merged[:, 0], groups, boxes[:, 0])
+        np.minimum.at(merged[:, 1], groups, boxes[:, 1])
+        np.maximum.at(merged[:, 2], groups, boxes[:, 2])
+        np.maximum.at(merged[:, 3], groups, boxes[:, 3])
+        return merged, np.nonzero(counts > 1)[0], groups
+
+
+class MaskEncoder:
+    """
+    对象蒙版的紧凑编码，供只需要几何信息的下游直接使用，不必再从 PNG 透明通道里提取轮廓。
+    RLE 保留孔洞；多边形只描述外轮廓。
+    """
+    @staticmethod
+    def rle(obj, x, y, height, width):
+        """
+        obj 为外接框左上角位于 (x, y) 的子蒙版 (非 0 为对象)，返回整张图 (height×width) 上的
+        COCO 未压缩 RLE 计数：按列优先展开，从 0 的游程开始交替记录，总和为 height*width。
+        """
+        h, w = obj.shape
+        # 每列上下各补一行 0，游程不会跨列，按列展开后用差分找出每段的起止
+        padded = np.zeros((h + 2, w), dtype=np.int8)
+        padded[1:-1] = obj > 0
+        changes = np.diff(padded.ravel(order='F'))
+        starts, ends = np.nonzero(changes == 1)[0] + 1, np.nonzero(changes == -1)[0] + 1
+        # 展开下标 -> 整图的列优先下标
+        begins = (x + starts // (h + 2)) * height + y + starts % (h + 2) - 1
+        finishes = (x + ends // (h + 2)) * height + y + ends % (h + 2) - 1
+        if len(begins) > 1:
+            # 对象占满整列高度时，相邻两列的游程在整图上是连在一起的
+            joined = finishes[:-1] == begins[1:]
+            begins = np.concatenate([begins[:1], begins[1:][~joined]])
+            finishes = np.concatenate([finishes[:-1][~joined], finishes[-1:]])
+
+        counts = np.empty(len(begins) * 2 + 1, dtype=np.int64)
+        counts[0:-1:2] = begins - np.concatenate([[0], finishes[:-1]])
+        counts[1::2] = finishes - begins
+        counts[-1] = height * width - (finishes[-1] if len(finishes) else 0)
+        counts = counts.tolist()
+        if len(counts) > 1 and counts[-1] == 0:
+            counts.pop()
+        return counts
+
+    @staticmethod
+    def polygons(obj, x, y, epsilon=1.0):
+        """外轮廓经 approxPolyDP 简化后的多边形列表，每个为 [x0, y0, x1, y1, ...] (整图坐标)。"""
+        contours, _ = cv2.findContours(obj, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+        result = []
+        for contour in contours:
+            if epsilon > 0:
+                contour = cv2.approxPolyDP(contour, epsilon, True)
+            if len(contour) >= 3:
+                result.append(contour.reshape(-1).tolist())
+        return result
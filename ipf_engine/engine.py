@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/12 11:05
+# @Author  : cy1026
+# @File    : engine.py
+# @Software: PyCharm
+import cv2
+
+from .crops import CropEngine
+from .processor import ImageProcessor
+
+
+class MaskStages:
+    """
+    基础蒙版之后的各阶段，process() 与界面的 MaskPipeline 共用，两边的阶段顺序和参数换算不会走样。
+    每个阶段先由 *_args 从参数得到本阶段实际使用的值 (流水线拿它作缓存键)，再交给同名方法计算。
+    scale 为代理预览的缩放比例，以像素为单位的参数按比例换算，保证与全分辨率结果一致。
+    """
+    @staticmethod
+    def shift_args(mode_name, params, scale=1.0):
+        """只有 AI 模式有位移，返回 (dx, dy)。"""
+        if mode_name != "rembg":
+            return 0, 0
+        return (int(round(params.get("rembg_shift_x", 0) * scale)),
+                int(round(params.get("rembg_shift_y", 0) * scale)))
+
+    @staticmethod
+    def shift(mask, dx, dy):
+        return ImageProcessor.shift_mask(mask, dx, dy)
+
+    @staticmethod
+    def morph_args(params, scale=1.0):
+        """返回 (去噪核, 连接核, 连接次数)，缺省值与界面默认值相同。"""
+        return (ImageProcessor.scale_kernel(params.get("clean_kernel", 3), scale),
+                ImageProcessor.scale_kernel(params.get("connect_kernel", 5), scale),
+                params.get("connect_iters", 2))
+
+    @staticmethod
+    def morph(mask, clean_k, connect_k, iters):
+        return ImageProcessor.apply_morphology(mask, clean_k, connect_k, iters)
+
+    @staticmethod
+    def threshold_args(params):
+        return params.get("rembg_mask_thresh", 127)
+
+    @staticmethod
+    def threshold(mask, thresh, dst=None):
+        """dst 给出时原地写入 (界面只重算脏区域时使用)。"""
+        return cv2.threshold(mask, thresh, 255, cv2.THRESH_BINARY, dst=dst)[1]
+
+
+def process(image, params, cut=True):
+    """
+    一次完成整个处理流程：颜色转换 → 基础蒙版 → 位移 (AI 模式) → 形态学 → 阈值 → 切片提取。
+    image 为 cv_imread 读入的原图 (灰度 / BGR / BGRA)；params 与界面保存的参数同名，
+    其中 "mode" 为 ImageProcessor.MODES 中的名称，缺省的形态学、切片参数按界面默认值处理。
+    返回 (蒙版, 切片列表)，切片为 ((x, y, w, h), BGRA 图像)；cut=False 时只返回外接框，不裁图。
+    """
+    mode = ImageProcessor.MODES[params["mode"]]
+    mask, _ = ImageProcessor.compute_mask(mode.name, ImageProcessor.convert(image, mode.color_space), params)
+    mask = MaskStages.shift(mask, *MaskStages.shift_args(mode.name, params))
+    mask = MaskStages.morph(mask, *MaskStages.morph_args(params))
+    mask = MaskStages.threshold(mask, MaskStages.threshold_args(params))
+
+    boxes = CropEngine.find_boxes(mask, params.get("crop_min_area", 0), params.get("crop_merge_dist", 0))
+    if not cut:
+        return mask, boxes
+    alpha_mask = mask if params.get("apply_mask", True) else None
+    return mask, [(box, CropEngine.cut(image, alpha_mask, box)) for box in boxes]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/12 10:30
+# @Author  : cy1026
+# @File    : models.py
+# @Software: PyCharm
+"""
+AI 模型目录与会话。rembg / onnxruntime 只在第一次真正推理时才导入，
+不使用 AI 模式的程序 (以及只做颜色/灰度处理的批量任务) 不必加载它们。
+"""
+import os
+import sys
+
+if getattr(sys, 'frozen', False):
+    base_path = os.path.dirname(sys.executable)
+else:
+    base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_models_dir = os.path.join(base_path, "models")  # 项目本地模型目录
+
+
+def set_models_dir(path):
+    """在第一次推理之前调用，改用其他模型目录。"""
+    global _models_dir
+    _models_dir = path
+
+
+def models_dir():
+    """返回模型目录，首次调用时创建并设置 REMBG_HOME。"""
+    if not os.path.exists(_models_dir):
+        os.makedirs(_models_dir)
+    os.environ["REMBG_HOME"] = _models_dir
+    return _models_dir
+
+
+def model_path(model_name):
+    """本地模型文件的路径；文件不存在时返回 None (不会创建模型目录)。"""
+    path = os.path.join(_models_dir, f"{model_name}.onnx")
+    return path if os.path.exists(path) else None
+
+
+class CustomSession:
+    """
+    自定义 Session，用于直接加载本地 ONNX 模型，绕过 rembg 的下载和校验逻辑。
+    """
+    def __init__(self, model_path):
+        import onnxruntime as ort
+        self.model_name = os.path.splitext(os.path.basename(model_path))[0]
+        # 显式指定 providers，优先使用 CPU，避免部分环境 CUDA 报错
+        # 如果您有 GPU 环境，onnxruntime 会自动优先尝试 CUDAExecutionProvider
+        self.inner_session = ort.InferenceSession(
+            model_path, 
+            providers=ort.get_available_providers()
+        )
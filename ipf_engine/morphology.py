@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/12 10:12
+# @Author  : cy1026
+# @File    : morphology.py
+# @Software: PyCharm
+import cv2
+import numpy as np
+
+
+class MorphologyEngine:
+    """
+    形态学运算，结果与 cv2.morphologyEx 完全相同，大核的耗时基本不随核大小与迭代次数增长：
+    - 结构元素与各核的行范围表按尺寸缓存，不再每次重建；
+    - 矩形核迭代 n 次等价于一次 n*(k-1)+1 的矩形核；二值蒙版上的大矩形核改用盒式滤波的
+      行/列累加和，与核大小无关。更小的矩形核 OpenCV 本身按行、列分离计算，已经很快；
+    - 二值蒙版上的大椭圆核 (任意奇偶，迭代 n 次先合并成 n 个椭圆的闵可夫斯基和) 按行拆开：
+      每一行是一段水平区间，像素被腐蚀当且仅当某一行区间内有背景。先算出每个像素到左右最近
+      背景的距离，查表得到它会腐蚀掉上下哪一段像素，再沿列做一次前缀最大 / 后缀最小，
+      总共只有固定几遍扫描。椭圆核的各行区间都含锚点、且离锚点越远越短，保证查表结果是连续区间。
+    非二值蒙版 (如 AI 软蒙版) 仍交给 morphologyEx，矩形核同样先合并迭代。
+    """
+    RECT_BOX_MIN = 151     # 矩形核边长达到此值时改用盒式滤波
+    ELLIPSE_ROWS_MIN = 41  # 单次椭圆核边长达到此值时按行计算更快 (单线程实测)，迭代时见 uses_rows
+    FAR = 1 << 30          # 空区间的哨兵值，使用时截断到所用整数类型的范围内
+
+    _kernels = {}
+    _row_tables = {}
+
+    @classmethod
+    def kernel(cls, shape, k):
+        key = (shape, k)
+        if key not in cls._kernels:
+            cls._kernels[key] = cv2.getStructuringElement(shape, (k, k))
+        return cls._kernels[key]
+
+    @classmethod
+    def row_table(cls, shape, k, iters=1):
+        """
+        迭代 iters 次的核按行拆开后的查表数据 (lut, cap)，不满足按行计算的条件时为 None。
+        lut 为 4 个 256 项的表，以像素到左 / 右最近背景的距离 (截断到 cap) 为下标，
+        给出该像素会让哪一段行偏移 [lo, hi] 上的输出被腐蚀；空区间记为 [FAR, -FAR]，
+        取并集 (lo 取小、hi 取大) 时自然被忽略。
+        """
+        key = (shape, k, iters)
+        if key not in cls._row_tables:
+            cls._row_tables[key] = cls._build_row_table(cls.kernel(shape, k), k // 2, iters)
+        return cls._row_tables[key]
+
+    @staticmethod
+    def _build_row_table(kernel, anchor, iters):
+        # 每行相对锚点的区间 [-left, right]，行偏移 dy 同样相对锚点
+        rows = {}
+        for i, line in enumerate(kernel):
+            cols = np.nonzero(line)[0]
+            if len(cols) == 0:
+                continue
+            if cols[-1] - cols[0] + 1 != len(cols) or not cols[0] <= anchor <= cols[-1]:
+                return None
+            rows[i - anchor] = (anchor - cols[0], cols[-1] - anchor)
+        # 迭代 = 与自身反复做闵可夫斯基和；各行都含锚点，同一行偏移上的区间并集仍是区间
+        total = rows
+        for _ in range(iters - 1):
+            merged = {}
+            for dy1, (l1, r1) in total.items():
+                for dy2, (l2, r2) in rows.items():
+                    l0, r0 = merged.get(dy1 + dy2, (0, 0))
+                    merged[dy1 + dy2] = (max(l0, l1 + l2), max(r0, r1 + r2))
+            total = merged
+
+        cap = int(max(max(extent) for extent in total.values())) + 1
+        if cap > 255:
+            return None
+        lut = []
+        for side in (0, 1):
+            lo = np.full(256, MorphologyEngine.FAR, dtype=np.int32)
+            hi = np.full(256, -MorphologyEngine.FAR, dtype=np.int32)
+            for d in range(cap):
+                dys = [dy for dy, extent in total.items() if extent[side] >= d]
+                if dys:
+                    lo[d], hi[d] = min(dys), max(dys)
+                    if hi[d] - lo[d] + 1 != len(dys):
+                        return None
+            lut += [lo, hi]
+        return lut, cap
+
+    @classmethod
+    def morph(cls, mask, op, shape, k, iters=1):
+        """op 为 cv2.MORPH_OPEN / cv2.MORPH_CLOSE，shape 为 cv2.MORPH_RECT / cv2.MORPH_ELLIPSE。"""
+        if k <= 1 or iters <= 0:
+            return mask
+        if shape == cv2.MORPH_RECT:
+            # n 个 k×k 矩形的闵可夫斯基和仍是矩形，锚点同样累加 (偶数核时锚点不在正中)
+            size, anchor = iters * (k - 1) + 1, iters * (k // 2)
+            if size >= cls.RECT_BOX_MIN and cls._is_binary(mask):
+                first, second = (cls._box_erode, cls._box_dilate) if op == cv2.MORPH_OPEN else (cls._box_dilate, cls._box_erode)
+                return second(first(mask, size, anchor), size, anchor)
+            return cv2.morphologyEx(mask, op, cls.kernel(shape, size), anchor=(anchor, anchor))
+        if cls.uses_rows(shape, k, iters) and cls._is_binary(mask):
+            table = cls.row_table(shape, k, iters)
+            if table is not None:
+                erode = lambda m: cls._rows_erode(m, table)
+                dilate = lambda m: cv2.bitwise_not(cls._rows_erode(cv2.bitwise_not(m), table))
+                first, second = (erode, dilate) if op == cv2.MORPH_OPEN else (dilate, erode)
+                return second(first(mask))
+        return cv2.morphologyEx(mask, op, cls.kernel(shape, k), iterations=iters)
+
+    @classmethod
+    def uses_rows(cls, shape, k, iters=1):
+        """
+        二值蒙版上这组参数是否按行计算。按行计算的耗时基本固定，OpenCV 的耗时约与
+        迭代次数 × 核边长² 成正比，所以小核迭代几次仍交给 OpenCV。
+        """
+        return shape == cv2.MORPH_ELLIPSE and iters * k * k >= cls.ELLIPSE_ROWS_MIN ** 2
+
+    @staticmethod
+    def _is_binary(mask):
+        return cv2.countNonZero(mask) == cv2.countNonZero(cv2.compare(mask, 255, cv2.CMP_EQ))
+
+    @staticmethod
+    def _box_dilate(mask, size, anchor):
+        # 先压成 0/1，累加和在 float32 中保持精确
+        ones = cv2.threshold(mask, 0, 1, cv2.THRESH_BINARY)[1]
+        sums = cv2.boxFilter(ones, cv2.CV_32F, (size, size), anchor=(anchor, anchor),
+                             normalize=False, borderType=cv2.BORDER_CONSTANT)
+        return cv2.compare(sums, 0.5, cv2.CMP_GT)
+
+    @staticmethod
+    def _box_erode(mask, size, anchor):
+        # 腐蚀 = 对补集膨胀再取反；erode 把图外视为前景，对应补集的图外为背景
+        return cv2.bitwise_not(MorphologyEngine._box_dilate(cv2.bitwise_not(mask), size, anchor))
+
+    @staticmethod
+    def _row_distances(mask, cap):
+        """
+        每个像素到左 / 右最近背景的水平距离 (背景本身为 0，图外视为前景)，达到 cap 后不再增加。
+        转置后逐列递推，每列三次 ufunc，比整行 accumulate 再截断快。
+        """
+        columns = cv2.transpose(mask)
+        left, right = np.empty_like(columns), np.empty_like(columns)
+        for out, order in ((left, range(len(columns))), (right, range(len(columns) - 1, -1, -1))):
+            prev = np.full(columns.shape[1], cap, dtype=np.uint8)
+            for i in order:
+                cur = out[i]
+                np.minimum(prev, cap - 1, out=cur)
+                cur += 1
+                cur &= columns[i]  # 前景为 255，背景清零
+                prev = cur
+        return cv2.transpose(left), cv2.transpose(right)
+
+    @staticmethod
+    def _rows_erode(mask, table):
+        """按行拆开的核腐蚀二值蒙版 (图外视为前景，与 cv2.erode 相同)；膨胀 = 对补集腐蚀再取反。"""
+        cap = table[1]
+        h, w = mask.shape
+        # 坐标加减哨兵值仍放得进 int16 时用 int16，数据量减半
+        dtype, far = (np.int16, 16000) if max(h, w) < 16000 else (np.int32, MorphologyEngine.FAR // 2)
+        lo_left, hi_left, lo_right, hi_right = (np.clip(t, -far, far).astype(dtype) for t in table[0])
+        left, right = MorphologyEngine._row_distances(mask, cap)
+
+        # 第 y' 行的像素会腐蚀掉第 y' - hi ... y' - lo 行的输出；左右两侧的区间都含 y'，取并集
+        y = np.arange(h, dtype=dtype)[:, None]
+        bottom = np.minimum(cv2.LUT(left, lo_left), cv2.LUT(right, lo_right))
+        np.subtract(y, bottom, out=bottom)
+        top = np.maximum(cv2.LUT(left, hi_left), cv2.LUT(right, hi_right))
+        np.subtract(y, top, out=top)
+
+        # 被某个 y' <= y 的区间盖住 <=> bottom 的前缀最大值 >= y；y' >= y 的情况对称。
+        # 逐行调用 ufunc 比沿 0 轴 accumulate 快
+        for i in range(1, h):
+            np.maximum(bottom[i - 1], bottom[i], out=bottom[i])
+        for i in range(h - 2, -1, -1):
+            np.minimum(top[i + 1], top[i], out=top[i])
+        keep = (bottom < y) & (top > y)
+        return keep.view(np.uint8) * np.uint8(255)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/12 10:40
+# @Author  : cy1026
+# @File    : processor.py
+# @Software: PyCharm
+import os
+import cv2
+import numpy as np
+
+from . import models
+from .morphology import MorphologyEngine
+from .profiler import Profiler
+
+
+class ImageProcessor:
+    """
+    负责图像处理的核心算法，与UI解耦。
+    各蒙版模式登记在 MODES 中 (见文件末尾)，界面和批量工具都通过 compute_mask 按名称调用。
+    """
+    _sessions = {}
+    MODES = {}
+
+    @classmethod
+    def get_session(cls, model_name):
+        if model_name not in cls._sessions:
+            print(f"正在请求模型: {model_name} ...")
+            
+            # 1. 检查项目本地目录
+            local_path = os.path.join(models.models_dir(), f"{model_name}.onnx")
+
+            
+            target_path = None
+            
+            if os.path.exists(local_path):
+                print(f"✅ 在项目目录找到模型: {local_path}")
+                target_path = local_path
+            
+            try:
+                from rembg import new_session  # 只有 AI 模式才需要，避免导入引擎时加载 onnxruntime
+                # 只有在需要下载时，才强制指定下载目录到项目下的 models
+                # 这样下载后的文件就在项目里，方便打包
+                cls._sessions[model_name] = new_session(model_name)
+            except Exception as e:
+                print(f"❌ 模型加载失败: {e}")
+                return None
+                
+        return cls._sessions[model_name]
+
+    @staticmethod
+    @Profiler.timed("cv_imread")
+    def cv_imread(file_path):
+        try:
+            return cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        except Exception as e:
+            print(f"Error reading file {file_path}: {e}")
+            return None
+
+    @staticmethod
+    def cv_imwrite(file_path, img, png_compression=1):
+        try:
+            is_success, im_buf = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, png_compression])
+            if is_success:
+                im_buf.tofile(file_path)
+                return True
+        except Exception as e:
+            print(f"Error writing file {file_path}: {e}")
+        return False
+
+    @staticmethod
+    def to_bgr(raw_image):
+        if len(raw_image.shape) == 2:
+            return cv2.cvtColor(raw_image, cv2.COLOR_GRAY2BGR)
+        if raw_image.shape[2] == 4:
+            return cv2.cvtColor(raw_image, cv2.COLOR_BGRA2BGR)
+        return raw_image
+
+    @staticmethod
+    def to_bgra(raw_image):
+        if len(raw_image.shape) == 2:
+            return cv2.cvtColor(raw_image, cv2.COLOR_GRAY2BGRA)
+        if raw_image.shape[2] == 3:
+            return cv2.cvtColor(raw_image, cv2.COLOR_BGR2BGRA)
+        return raw_image
+
+    @staticmethod
+    def to_hsv_planes(img):
+        """BGR -> (H, S, V) 三个单通道平面。按图片缓存后，拖动滑块只需查表，不必重复转换颜色空间。"""
+        return tuple(cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV)))
+
+    @staticmethod
+    def range_lut(lower, upper, period=256):
+        """
+        值落在 [lower, upper] 内映射为 255、否则为 0 的查找表。
+        按 period 取模比较，色相 (period=180) 跨越 0 的区间也只需一张表。
+        """
+        values = np.arange(256)
+        return np.where((values - lower) % period <= upper - lower, 255, 0).astype(np.uint8)
+
+    @staticmethod
+    @Profiler.timed("get_mask_hsv")
+    def get_mask_hsv(hsv_planes, h_min, h_max, s_min, v_min):
+        """逐通道查表再按位与，等价于 inRange，色相环绕时也不用拆成两次。"""
+        h, s, v = hsv_planes
+        mask = cv2.LUT(h, ImageProcessor.range_lut(h_min, h_max, 180))
+        cv2.bitwise_and(mask, cv2.LUT(s, ImageProcessor.range_lut(s_min, 255)), dst=mask)
+        cv2.bitwise_and(mask, cv2.LUT(v, ImageProcessor.range_lut(v_min, 255)), dst=mask)
+        return mask
+
+    @staticmethod
+    @Profiler.timed("get_mask_color")
+    def get_mask_color(hsv_planes, hue_tol, sat_min, val_min):
+        """以四个角的色相中位数作为背景色，选出色相接近背景的像素后反转，保留前景。"""
+        hue = hsv_planes[0]
+        h, w = hue.shape
+        bg_h = float(np.median([hue[0, 0], hue[0, w - 1], hue[h - 1, 0], hue[h - 1, w - 1]]))
+
+        # 与 inRange 处理小数边界的方式一致：四舍六入五取偶
+        mask = ImageProcessor.get_mask_hsv(hsv_planes, round(bg_h - hue_tol), round(bg_h + hue_tol), sat_min, val_min)
+        return cv2.bitwise_not(mask)
+
+    @staticmethod
+    @Profiler.timed("get_mask_rgba_range")
+    def get_mask_rgba_range(raw_image, r_min, r_max, g_min, g_max, b_min, b_max, a_min, a_max, invert=True):
+        if len(raw_image.shape) == 2:
+            image_bgra = cv2.cvtColor(raw_image, cv2.COLOR_GRAY2BGRA)
+        elif raw_image.shape[2] == 3:
+            image_bgra = cv2.cvtColor(raw_image, cv2.COLOR_BGR2BGRA)
+        else:
+            image_bgra = raw_image
+
+        lower_bound = np.array([b_min, g_min, r_min, a_min], dtype=np.uint8)
+        upper_bound = np.array([b_max, g_max, r_max, a_max], dtype=np.uint8)
+        
+        mask = cv2.inRange(image_bgra, lower_bound, upper_bound)
+        match_ratio = np.count_nonzero(mask) / (mask.shape[0] * mask.shape[1])
+        
+        if invert:
+            return cv2.bitwise_not(mask), match_ratio
+        else:
+            return mask, match_ratio
+
+    @staticmethod
+    @Profiler.timed("get_mask_yellow")
+    def get_mask_yellow(hsv_planes, h_center, h_tol, s_min, v_min):
+        # 输入为 to_hsv_planes 的结果
+        return ImageProcessor.get_mask_hsv(hsv_planes, h_center - h_tol, h_center + h_tol, s_min, v_min)
+
+    @staticmethod
+    @Profiler.timed("get_mask_gray")
+    def get_mask_gray(img, thresh_val, bg_type, blur_ksize=5):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(gray, (blur_ksize, blur_ksize), 0) if blur_ksize > 1 else gray
+        type_flag = cv2.THRESH_BINARY if bg_type == "black" else cv2.THRESH_BINARY_INV
+
+        if thresh_val == 0:
+            type_flag += cv2.THRESH_OTSU
+
+        _, mask = cv2.threshold(blurred, thresh_val, 255, type_flag)
+        return mask
+
+    @staticmethod
+    @Profiler.timed("get_mask_rembg")
+    def get_mask_rembg(img, model_name="u2net", alpha_matting=False, am_fg_thresh=240, am_bg_thresh=10, am_erode=10):
+        try:
+            from PIL import Image
+            from rembg import remove
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            pil_img = Image.fromarray(img_rgb)
+            
+            session = ImageProcessor.get_session(model_name)
+            if session is None:
+                return np.zeros(img.shape[:2], dtype=np.uint8)
+
+            output = remove(
+                pil_img,
+                session=session,
+                alpha_matting=alpha_matting,
+                alpha_matting_foreground_threshold=am_fg_thresh,
+                alpha_matting_background_threshold=am_bg_thresh,
+                alpha_matting_erode_size=am_erode
+            )
+            
+            output_np = np.array(output)
+            if output_np.shape[2] == 4:
+                return output_np[:, :, 3]
+            return np.zeros(img.shape[:2], dtype=np.uint8)
+        except Exception as e:
+            print(f"Rembg error: {e}")
+            return np.zeros(img.shape[:2], dtype=np.uint8)
+
+    @staticmethod
+    def shift_mask(mask, dx, dy):
+        if dx == 0 and dy == 0:
+            return mask
+        h, w = mask.shape
+        M = np.float32([[1, 0, dx], [0, 1, dy]])
+        return cv2.warpAffine(mask, M, (w, h))
+
+    @staticmethod
+    def scale_kernel(k, scale):
+        """把核大小换算到缩放后的图像上：k×k 核的覆盖半径为 (k-1)/2，按比例缩放该半径。"""
+        if k <= 1 or scale == 1:
+            return k
+        return max(1, int(round((k - 1) * scale)) + 1)
+
+    @staticmethod
+    @Profiler.timed("apply_morphology")
+    def apply_morphology(mask, clean_k, connect_k, iters):
+        if clean_k > 0:
+            mask = MorphologyEngine.morph(mask, cv2.MORPH_OPEN, cv2.MORPH_ELLIPSE, clean_k)
+        if connect_k > 0 and iters > 0:
+            mask = MorphologyEngine.morph(mask, cv2.MORPH_CLOSE, cv2.MORPH_RECT, connect_k, iters)
+        return mask
+
+    @classmethod
+    def register(cls, name, color_space, params):
+        """
+        登记蒙版模式的装饰器。color_space 为该模式需要的输入 ("bgr" / "bgra" / "hsv")，
+        params 为它依赖的参数名 (界面据此决定哪些参数变化需要重算)。
+        被装饰函数的签名为 func(图像, 参数字典, 缩放比例) -> (蒙版, 颜色匹配率)。
+        """
+        def decorator(func):
+            cls.MODES[name] = MaskMode(name, color_space, tuple(params), func)
+            return func
+        return decorator
+
+    @staticmethod
+    def convert(raw_image, color_space):
+        """把原图转换为模式需要的颜色空间。"""
+        if color_space == "bgra":
+            return ImageProcessor.to_bgra(raw_image)
+        if color_space == "hsv":
+            return ImageProcessor.to_hsv_planes(ImageProcessor.to_bgr(raw_image))
+        return ImageProcessor.to_bgr(raw_image)
+
+    @classmethod
+    def compute_mask(cls, mode, image, params, scale=1.0):
+        """按模式名称计算基础蒙版，image 须已是 MODES[mode].color_space 对应的格式。返回 (蒙版, 颜色匹配率)。"""
+        return cls.MODES[mode].func(image, params, scale)
+
+
+class MaskMode:
+    def __init__(self, name, color_space, params, func):
+        self.name = name
+        self.color_space = color_space
+        self.params = params
+        self.func = func
+
+
+# ==========================================
+# 蒙版模式 (Mask Modes)
+# ==========================================
+@ImageProcessor.register("hsv_color", "hsv", ("hue_tol", "sat_min", "val_min"))
+def _hsv_color(hsv_planes, params, scale):
+    return ImageProcessor.get_mask_color(hsv_planes, params["hue_tol"], params["sat_min"], params["val_min"]), 0
+
+
+@ImageProcessor.register("rgba_range", "bgra", ("color_r_min", "color_r_max", "color_g_min", "color_g_max",
+                                                "color_b_min", "color_b_max", "color_a_min", "color_a_max", "color_invert"))
+def _rgba_range(image_bgra, params, scale):
+    return ImageProcessor.get_mask_rgba_range(
+        image_bgra,
+        params["color_r_min"], params["color_r_max"],
+        params["color_g_min"], params["color_g_max"],
+        params["color_b_min"], params["color_b_max"],
+        params["color_a_min"], params["color_a_max"],
+        invert=params.get("color_invert", True)
+    )
+
+
+@ImageProcessor.register("yellow", "hsv", ("yellow_h_center", "yellow_h_tol", "yellow_s_min", "yellow_v_min"))
+def _yellow(hsv_planes, params, scale):
+    return ImageProcessor.get_mask_yellow(hsv_planes, params["yellow_h_center"], params["yellow_h_tol"],
+                                          params["yellow_s_min"], params["yellow_v_min"]), 0
+
+
+@ImageProcessor.register("gray", "bgr", ("gray_thresh", "bg_type"))
+def _gray(image, params, scale):
+    # 模糊核随代理比例缩放，保证预览与全分辨率结果一致
+    blur_ksize = ImageProcessor.scale_kernel(5, scale) | 1
+    return ImageProcessor.get_mask_gray(image, params["gray_thresh"], params["bg_type"], blur_ksize), 0
+
+
+@ImageProcessor.register("rembg", "bgr", ("rembg_model", "rembg_alpha_matting", "rembg_fg_thresh", "rembg_bg_thresh", "rembg_erode"))
+def _rembg(image, params, scale):
+    # 模型输入尺寸固定，缩放后的图片只是降低了输出精度；需要代理预览时应缩小全分辨率结果
+    return ImageProcessor.get_mask_rembg(image, model_name=params.get("rembg_model", "u2net"),
+                                         alpha_matting=params.get("rembg_alpha_matting", False),
+                                         am_fg_thresh=params.get("rembg_fg_thresh", 240),
+                                         am_bg_thresh=params.get("rembg_bg_thresh", 10),
+                                         am_erode=params.get("rembg_erode", 10)), 0
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/14 10:20
+# @Author  : cy1026
+# @File    : server.py
+# @Software: PyCharm
+"""
+常驻的本地处理服务。模型会话留在 ImageProcessor._sessions 中，客户端 (两个切分工具、批量脚本)
+不必各自加载 onnxruntime 和模型。只监听 127.0.0.1，协议为 HTTP + JSON (见 client.EngineClient)。
+
+服务能读任意本地图片、往任意目录写文件，所以每次启动生成一个随机令牌写入 app_config.json
+("engine_token")，请求须在 X-IPF-Token 头中带上它；同时拒绝非 application/json 的请求和带 Origin
+头的请求 (浏览器中的网页发来的跨域请求)。
+
+    python -m ipf_engine.server --port 8765 --preload u2net
+
+POST /process 的请求体为一个任务，或 {"requests": [任务, ...]}，任务字段:
+    image       源图路径；或 shm: {"name", "shape", "dtype"}，由客户端创建的共享内存中的图片
+    params      处理参数，"mode" 为 ImageProcessor.MODES 中的名称
+    priority    数字越大越先处理，默认 0
+    base_only   只计算基础蒙版 (不做形态学、阈值和切片)
+    output_dir  给出时把切片写到该目录 (共享内存图片用 name 作为文件名)
+    mask_shm    给出时把蒙版写入这块共享内存 (大小须为 高 x 宽 字节)
+每个任务返回 {"ok", "boxes", "crops", "shape", "ms"}，失败时为 {"ok": false, "error"}。
+"""
+import argparse
+import hmac
+import itertools
+import json
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .batch import save_crops
+from .engine import process
+from .models import base_path
+from .processor import ImageProcessor
+
+DEFAULT_PORT = 8765
+CONFIG_FILE = os.path.join(base_path, "app_config.json")  # 与界面共用的配置文件，令牌写在这里
+TOKEN_HEADER = "X-IPF-Token"
+
+
+def read_token(config_file=CONFIG_FILE):
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            return json.load(f).get("engine_token")
+    except (OSError, ValueError):
+        return None
+
+
+def publish_token(token, config_file=CONFIG_FILE):
+    """把令牌写入配置文件，保留其余配置项。先写临时文件再替换，界面同时读取也不会读到半个文件。"""
+    config = {}
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        pass
+    config["engine_token"] = token
+    temp_path = f"{config_file}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    os.replace(temp_path, config_file)
+
+
+def attach_shm(name):
+    """打开客户端创建的共享内存。"""
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix" and sys.version_info < (3, 13):
+        # 3.13 之前只是打开也会登记到 resource_tracker，服务退出时会把客户端的内存一并删除
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class EngineJob:
+    def __init__(self, request):
+        self.request = request
+        self.result = None
+        self.done = threading.Event()
+
+
+class EngineServer:
+    """按优先级排队的任务由 workers 个线程依次执行；HTTP 线程只负责收发，等待结果时不占用处理线程。"""
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, workers=2, token=None):
+        self.token = token or secrets.token_urlsafe(24)
+        self.jobs = queue.PriorityQueue()
+        self._order = itertools.count()  # 同优先级先到先处理
+        self.served = 0
+        self._stats_lock = threading.Lock()  # served 由多个处理线程累加
+        self.started = time.time()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        for _ in range(workers):
+            threading.Thread(target=self._work_loop, daemon=True).start()
+
+    def submit(self, requests):
+        """把一组任务放入队列，等全部完成后按原顺序返回结果。"""
+        jobs = [EngineJob(request) for request in requests]
+        for job in jobs:
+            self.jobs.put((-float(job.request.get("priority", 0)), next(self._order), job))
+        for job in jobs:
+            job.done.wait()
+        return [job.result for job in jobs]
+
+    def serve_forever(self):
+        host, port = self.httpd.server_address[:2]
+        print(f"处理服务已启动: http://{host}:{port}  (Ctrl+C 退出)")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.httpd.server_close()
+
+    def _work_loop(self):
+        while True:
+            _, _, job = self.jobs.get()
+            start = time.perf_counter()
+            try:
+                job.result = self._run(job.request)
+                job.result["ok"] = True
+            except Exception as e:
+                print(f"任务失败: {e}")
+                job.result = {"ok": False, "error": str(e)}
+            job.result["ms"] = (time.perf_counter() - start) * 1000
+            with self._stats_lock:
+                self.served += 1
+            job.done.set()
+
+    def _run(self, request):
+        params = request["params"]
+        if "shm" in request:
+            spec = request["shm"]
+            shm = attach_shm(spec["name"])
+            try:
+                # 复制出来再处理，处理期间不持有指向共享内存的引用，客户端可随时释放
+                image = np.ndarray(tuple(spec["shape"]), dtype=spec.get("dtype", "uint8"), buffer=shm.buf).copy()
+            finally:
+                shm.close()
+            base_name = request.get("name", "image")
+        else:
+            image = ImageProcessor.cv_imread(request["image"])
+            if image is None:
+                raise ValueError(f"无法读取图片: {request['image']}")
+            base_name = os.path.splitext(os.path.basename(request["image"]))[0]
+
+        result = {"shape": list(image.shape)}
+        if request.get("base_only"):
+            mode = ImageProcessor.MODES[params["mode"]]
+            mask, _ = mode.func(ImageProcessor.convert(image, mode.color_space), params, 1.0)
+        elif request.get("output_dir"):
+            mask, crops = process(image, params)
+            result["boxes"] = [list(box) for box, _ in crops]
+            result["crops"] = save_crops(crops, request["output_dir"], base_name, params.get("png_compression", 1))
+        else:
+            mask, boxes = process(image, params, cut=False)
+            result["boxes"] = [list(box) for box in boxes]
+
+        if request.get("mask_shm"):
+            shm = attach_shm(request["mask_shm"])
+            try:
+                np.ndarray(mask.shape, dtype=np.uint8, buffer=shm.buf)[:] = mask
+            finally:
+                shm.close()
+        return result
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                if self.path != "/health":
+                    self._reply(404, {"error": "not found"})
+                    return
+                self._reply(200, {"status": "ok", "pid": os.getpid(), "sessions": list(ImageProcessor._sessions),
+                                  "queued": server.jobs.qsize(), "served": server.served,
+                                  "uptime": time.time() - server.started})
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                if self.path != "/process":
+                    self._reply(404, {"error": "not found"})
+                    return
+                if self.headers.get_content_type() != "application/json":
+                    # 网页不经预检就能发出的“简单请求”只能是 text/plain 等类型
+                    self._reply(415, {"error": "只接受 application/json"})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                except ValueError as e:
+                    self._reply(400, {"error": f"请求不是有效的 JSON: {e}"})
+                    return
+                if not isinstance(body, dict):
+                    self._reply(400, {"error": "请求体须为 JSON 对象"})
+                    return
+                batch = "requests" in body
+                requests = body["requests"] if batch else [body]
+                error = self._invalid(requests)
+                if error:
+                    self._reply(400, {"error": error})
+                    return
+                results = server.submit(requests)
+                self._reply(200, {"results": results} if batch else results[0])
+
+            @staticmethod
+            def _invalid(requests):
+                """检查请求体的结构，返回错误说明；结构正确时返回 None (参数取值的错误由各任务自己报告)。"""
+                if not isinstance(requests, list):
+                    return "requests 须为列表"
+                for i, request in enumerate(requests):
+                    if not isinstance(request, dict):
+                        return f"任务 {i} 须为 JSON 对象"
+                    params = request.get("params")
+                    if not isinstance(params, dict):
+                        return f"任务 {i} 缺少 params 对象"
+                    if params.get("mode") not in ImageProcessor.MODES:
+                        return f"任务 {i} 的 mode 须为以下之一: {', '.join(ImageProcessor.MODES)}"
+                    if not isinstance(request.get("priority", 0), (int, float)):
+                        return f"任务 {i} 的 priority 须为数字"
+                    if not isinstance(request.get("image"), str) and not isinstance(request.get("shm"), dict):
+                        return f"任务 {i} 须给出 image 路径或 shm"
+                return None
+
+            def _authorized(self):
+                if self.headers.get("Origin") is not None:
+                    self._reply(403, {"error": "不接受来自网页的请求"})
+                    return False
+                if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ""), server.token):
+                    self._reply(403, {"error": "令牌无效，请从 app_config.json 读取 engine_token"})
+                    return False
+                return True
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass  # 每个请求一行日志太多，失败的任务在 _work_loop 中打印
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="常驻的本地图片处理服务 (保持模型会话)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=2, help="同时处理的任务数")
+    parser.add_argument("--preload", nargs="*", default=[], help="启动时加载的模型，如 u2net isnet-general-use")
+    parser.add_argument("--config", default=CONFIG_FILE, help="写入访问令牌的配置文件")
+    args = parser.parse_args()
+
+    for model_name in args.preload:
+        ImageProcessor.get_session(model_name)
+    server = EngineServer(port=args.port, workers=args.workers)
+    publish_token(server.token, args.config)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/15 14:30
+# @Author  : cy1026
+# @File    : shards.py
+# @Software: PyCharm
+"""
+多台机器共享一个目录 (如 NFS) 分片批量处理。队列目录结构:
+
+    job.json                 源文件夹、输出文件夹、处理参数
+    todo/shard_00000.json    待处理的分片 (文件名列表)
+    claimed/shard_00000.json@<worker>   已被某个 worker 领取，文件的修改时间即租约心跳
+    done/shard_00000.json    已完成
+    manifests/<worker>.jsonl 每个 worker 自己的结果清单，一行一张图片
+
+领取和归还都靠同一文件系统内的 rename，只会有一个 worker 成功。处理期间 worker 定期刷新
+claimed 文件的修改时间；超过租约仍未刷新的分片 (worker 崩溃或断网) 会被其他 worker 放回 todo。
+被收回的分片可能重复处理，切片按文件名覆盖写入，结果不受影响。各机器的时钟偏差须远小于租约时长。
+
+    python -m ipf_engine.shards init Q --source 输入 --output 输出 --mode gray --params 参数.json
+    python -m ipf_engine.shards work Q                # 每台机器上运行
+    python -m ipf_engine.shards work Q --processes 4  # 本机多进程模拟多个节点
+    python -m ipf_engine.shards status Q
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from .batch import process_file
+from .processor import ImageProcessor
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+
+class ShardQueue:
+    def __init__(self, root):
+        self.root = root
+        self.todo_dir = os.path.join(root, "todo")
+        self.claimed_dir = os.path.join(root, "claimed")
+        self.done_dir = os.path.join(root, "done")
+        self.manifest_dir = os.path.join(root, "manifests")
+
+    @classmethod
+    def create(cls, root, source, output, params, shard_size=50):
+        """把 source 中的图片按 shard_size 张一组写成分片，返回队列。"""
+        queue = cls(root)
+        for path in (queue.todo_dir, queue.claimed_dir, queue.done_dir, queue.manifest_dir, output):
+            os.makedirs(path, exist_ok=True)
+        names = sorted(name for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTS))
+        job = {"source": os.path.abspath(source), "output": os.path.abspath(output), "params": params,
+               "images": len(names), "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+        with open(os.path.join(root, "job.json"), 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False, indent=1)
+        for i in range(0, len(names), shard_size):
+            queue._write_json(os.path.join(queue.todo_dir, f"shard_{i // shard_size:05d}.json"), names[i:i + shard_size])
+        return queue
+
+    def load_job(self):
+        with open(os.path.join(self.root, "job.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def claim(self, worker_id):
+        """领取一个分片，返回 claimed 中的路径；没有可领取的分片时返回 None。"""
+        for name in sorted(os.listdir(self.todo_dir)):
+            if not name.endswith(".json"):
+                continue
+            src = os.path.join(self.todo_dir, name)
+            path = os.path.join(self.claimed_dir, f"{name}@{worker_id}")
+            try:
+                # rename 保留原修改时间，须在移入 claimed 之前刷新，否则在 todo 中放得久的分片
+                # 一出现在 claimed 里就算过期，可能在领取者刷新之前被别的 worker 收回
+                os.utime(src)
+                os.rename(src, path)
+            except OSError:
+                continue  # 被别的 worker 抢先领取
+            return path
+        return None
+
+    def complete(self, claimed_path):
+        """标记完成；租约已被收回时返回 False (分片会由其他 worker 重做)。"""
+        name = os.path.basename(claimed_path).rsplit("@", 1)[0]
+        try:
+            os.rename(claimed_path, os.path.join(self.done_dir, name))
+            return True
+        except OSError:
+            return False
+
+    def reclaim_expired(self, lease):
+        """把超过 lease 秒没有心跳的分片放回 todo，返回收回的数量。"""
+        count = 0
+        now = time.time()
+        for name in os.listdir(self.claimed_dir):
+            path = os.path.join(self.claimed_dir, name)
+            try:
+                if now - os.stat(path).st_mtime <= lease:
+                    continue
+                target = os.path.join(self.todo_dir, name.rsplit("@", 1)[0])
+                os.rename(path, target)
+                os.utime(target)
+            except OSError:
+                continue  # 刚被完成、续约或被别的 worker 收回
+            print(f"收回超时分片: {name}")
+            count += 1
+        return count
+
+    def status(self):
+        """
+        各目录的分片数和图片结果数。被收回的分片会重复处理，同一张图片以 finished 最晚的记录为准；
+        正在写入的最后一行可能不完整，跳过。
+        """
+        counts = {key: len(os.listdir(path)) for key, path in
+                  (("todo", self.todo_dir), ("claimed", self.claimed_dir), ("done", self.done_dir))}
+        results = {}  # 图片 -> (finished, ok)
+        for name in os.listdir(self.manifest_dir):
+            with open(os.path.join(self.manifest_dir, name), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 空行或 worker 还没写完的行
+                    finished = record.get("finished", 0)
+                    image = record.get("image")
+                    if image not in results or finished >= results[image][0]:
+                        results[image] = (finished, bool(record.get("ok")))
+        counts["images_ok"] = sum(1 for _, ok in results.values() if ok)
+        counts["images_failed"] = len(results) - counts["images_ok"]
+        return counts
+
+    @staticmethod
+    def _write_json(path, data):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+
+class Heartbeat:
+    """后台定期刷新 claimed 文件的修改时间；文件已被收回时 lost 置为 True。"""
+    def __init__(self, path, interval):
+        self.path = path
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                os.utime(self.path)
+            except OSError:
+                self.lost = True
+                return
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def work(root, worker_id=None, lease=300.0, poll=None):
+    """
+    领取并处理分片，直到队列中既没有待处理也没有被领取的分片。
+    别人持有的分片未完成时继续等待，以便在对方崩溃后收回重做。返回处理的图片数。
+    """
+    queue = ShardQueue(root)
+    job = queue.load_job()
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    poll = poll or min(10.0, lease / 4)
+    manifest_path = os.path.join(queue.manifest_dir, f"{worker_id}.jsonl")
+    processed = 0
+
+    while True:
+        queue.reclaim_expired(lease)
+        claimed_path = queue.claim(worker_id)
+        if claimed_path is None:
+            if not os.listdir(queue.todo_dir) and not os.listdir(queue.claimed_dir):
+                break
+            time.sleep(poll)
+            continue
+
+        shard = os.path.basename(claimed_path).rsplit("@", 1)[0]
+        with open(claimed_path, 'r', encoding='utf-8') as f:
+            names = json.load(f)
+        heartbeat = Heartbeat(claimed_path, lease / 3)
+        try:
+            with open(manifest_path, 'a', encoding='utf-8') as manifest:
+                for name in names:
+                    if heartbeat.lost:
+                        break
+                    record = {"image": name, "shard": shard, "worker": worker_id}
+                    try:
+                        record.update(process_file(os.path.join(job["source"], name), job["output"], job["params"]), ok=True)
+                    except Exception as e:
+                        print(f"[{worker_id}] 处理失败 {name}: {e}")
+                        record.update(ok=False, error=str(e))
+                    record["finished"] = time.time()
+                    manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    manifest.flush()
+                    processed += 1
+        finally:
+            heartbeat.stop()
+        if heartbeat.lost or not queue.complete(claimed_path):
+            print(f"[{worker_id}] 分片 {shard} 的租约已被收回，交由其他 worker 重做")
+        else:
+            print(f"[{worker_id}] 完成分片 {shard} ({len(names)} 张)")
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="共享目录分片批量处理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    init = sub.add_parser("init", help="创建队列")
+    init.add_argument("queue")
+    init.add_argument("--source", required=True, help="输入图片文件夹")
+    init.add_argument("--output", required=True, help="切片保存文件夹")
+    init.add_argument("--mode", default="gray", help="ImageProcessor.MODES 中的模式名称")
+    init.add_argument("--params", help="其余参数的 JSON 文件")
+    init.add_argument("--shard-size", type=int, default=50)
+    run = sub.add_parser("work", help="领取并处理分片")
+    run.add_argument("queue")
+    run.add_argument("--lease", type=float, default=300, help="租约秒数，超过后分片被其他 worker 收回")
+    run.add_argument("--processes", type=int, default=1, help="本机启动的 worker 进程数")
+    status = sub.add_parser("status", help="查看进度")
+    status.add_argument("queue")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        if args.mode not in ImageProcessor.MODES:
+            parser.error(f"未知模式 {args.mode}，可选: {', '.join(ImageProcessor.MODES)}")
+        params = {}
+        if args.params:
+            with open(args.params, 'r', encoding='utf-8') as f:
+                params = json.load(f)
+        params["mode"] = args.mode
+        queue = ShardQueue.create(args.queue, args.source, args.output, params, args.shard_size)
+        print(f"已创建队列: {len(os.listdir(queue.todo_dir))} 个分片")
+    elif args.command == "work":
+        if args.processes <= 1:
+            print(f"处理了 {work(args.queue, lease=args.lease)} 张图片")
+            return
+        host = socket.gethostname()
+        processes = [multiprocessing.Process(target=work, args=(args.queue, f"{host}-{os.getpid()}-{i}", args.lease))
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        print(json.dumps(ShardQueue(args.queue).status(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,201 +4,1405 @@
 # @File    : rembg拆分.py
 # @Software: PyCharm
 import os
-import sys
 import cv2
 import numpy as np
 import json
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from PIL import Image, ImageTk
-from rembg import remove, new_session
-import onnxruntime as ort
 import threading
 import queue
+import time
+import itertools
+import hashlib
+import sqlite3
+import zlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from ipf_engine import ImageProcessor, CropEngine, MaskEncoder, MaskStages, Profiler, BatchRunner
+from ipf_engine.client import EngineClient, DEFAULT_URL
 
 # ==========================================
-# 路径配置 (Path Config)
+# 核心逻辑类 (Core Logic)
 # ==========================================
-if getattr(sys, 'frozen', False):
-    base_path = os.path.dirname(sys.executable)
-else:
-    base_path = os.path.dirname(os.path.abspath(__file__))
+def union_rects(rects):
+    """多个 (x0, y0, x1, y1) 矩形的外接矩形，没有矩形时返回 None。"""
+    result = None
+    for x0, y0, x1, y1 in rects:
+        if result is None:
+            result = (x0, y0, x1, y1)
+        else:
+            result = (min(result[0], x0), min(result[1], y0), max(result[2], x1), max(result[3], y1))
+    return result
 
-# 项目本地模型目录
-local_models_dir = os.path.join(base_path, "models")
-if not os.path.exists(local_models_dir):
-    os.makedirs(local_models_dir)
-os.environ["REMBG_HOME"] = local_models_dir
 
+class ManualLayer:
+    """
+    稀疏、按位压缩的手动修补层 (画笔/橡皮)。
+    只为画过的瓦片分配存储，每个瓦片用 np.packbits 按行压缩 (每像素 1 bit，值只有 0/255)，
+    涂抹后全空的瓦片直接丢弃；没画过的图层不占内存。
+    压缩瓦片只读，绘制时解压、绘制后生成新的压缩瓦片替换，因此 snapshot() 只需复制字典，
+    快照可以直接交给后台线程。
+    """
+    TILE_SIZE = 256
+    DIRTY_LOG_SIZE = 64
+    _versions = itertools.count(1)  # 全局递增，保证不同图层的版本号也不会重复
+
+    def __init__(self, h, w):
+        self.shape = (h, w)
+        self.version = next(self._versions)
+        # 最近若干次修改的 (版本号, 脏矩形)，用于增量更新；早于 _log_base 的修改已无记录
+        self._dirty_log = []
+        self._log_base = self.version
+        self._tiles = {}  # (ty, tx) -> 压缩瓦片
+        self._stroke = None  # 笔画进行中: (ty, tx) -> 笔画开始前的压缩瓦片 (None 表示原本为空)
 
+    @classmethod
+    def from_dense(cls, dense):
+        layer = cls(*dense.shape[:2])
+        layer._tiles = cls.pack_tiles(dense)
+        return layer
 
+    @classmethod
+    def pack_tiles(cls, dense):
+        """把整张图层切成瓦片并压缩，全零的瓦片不保存。"""
+        t = cls.TILE_SIZE
+        h, w = dense.shape[:2]
+        tiles = {}
+        for ty in range((h + t - 1) // t):
+            for tx in range((w + t - 1) // t):
+                tile = dense[ty * t:(ty + 1) * t, tx * t:(tx + 1) * t]
+                if tile.any():
+                    tiles[(ty, tx)] = cls.pack(tile)
+        return tiles
 
-# ==========================================
-# 核心逻辑类 (Core Logic)
-# ==========================================
-class CustomSession:
+    @staticmethod
+    def pack(tile):
+        packed = np.packbits(tile > 0, axis=1)
+        packed.flags.writeable = False
+        return packed
+
+    @staticmethod
+    def unpack(packed, width):
+        tile = np.unpackbits(packed, axis=1, count=width)
+        tile *= 255
+        return tile
+
+    def draw_circle(self, center, radius, value):
+        x, y = center
+        h, w = self.shape
+        rect = (max(0, x - radius), max(0, y - radius), min(w, x + radius + 1), min(h, y + radius + 1))
+        if rect[0] >= rect[2] or rect[1] >= rect[3]: return
+        t = self.TILE_SIZE
+        changed = False
+        for ty in range(max(0, (y - radius) // t), min((h - 1) // t, (y + radius) // t) + 1):
+            for tx in range(max(0, (x - radius) // t), min((w - 1) // t, (x + radius) // t) + 1):
+                packed = self._tiles.get((ty, tx))
+                if packed is None and value == 0:
+                    continue  # 在空瓦片上擦除，什么也不用做
+                th, tw = min(t, h - ty * t), min(t, w - tx * t)
+                tile = np.zeros((th, tw), dtype=np.uint8) if packed is None else self.unpack(packed, tw)
+                cv2.circle(tile, (x - tx * t, y - ty * t), radius, value, -1)
+                if self._stroke is not None:
+                    self._stroke.setdefault((ty, tx), packed)
+                if tile.any():
+                    new_packed = self.pack(tile)
+                    if self.same_tile(packed, new_packed):
+                        continue  # 圆落在已经是 value 的像素上，瓦片内容没变，保留原对象
+                    self._tiles[(ty, tx)] = new_packed
+                elif packed is not None:
+                    del self._tiles[(ty, tx)]
+                else:
+                    continue  # 圆只擦过瓦片的外接框，没有落到像素上
+                changed = True
+        if changed:
+            self._touch(rect)
+
+    def begin_stroke(self):
+        self._stroke = {}
+
+    def end_stroke(self):
+        """结束笔画，返回 (改动前, 改动后) 两个瓦片字典，只包含这一笔实际改动过的瓦片。"""
+        stroke, self._stroke = self._stroke or {}, None
+        # 按内容比较：一笔先画后擦回原样的瓦片也不算改动
+        before = {key: packed for key, packed in stroke.items() if not self.same_tile(packed, self._tiles.get(key))}
+        return before, {key: self._tiles.get(key) for key in before}
+
+    @staticmethod
+    def same_tile(a, b):
+        """两个压缩瓦片 (None 为空) 的内容是否相同。"""
+        if a is None or b is None:
+            return a is b
+        return a is b or np.array_equal(a, b)
+
+    def restore_tiles(self, tiles):
+        """用 (ty, tx) -> 压缩瓦片 (None 为空) 替换对应瓦片，供撤销/重做使用。"""
+        if not tiles: return
+        t = self.TILE_SIZE
+        h, w = self.shape
+        for key, packed in tiles.items():
+            if packed is None:
+                self._tiles.pop(key, None)
+            else:
+                self._tiles[key] = packed
+        self._touch(union_rects((tx * t, ty * t, min(w, (tx + 1) * t), min(h, (ty + 1) * t)) for ty, tx in tiles))
+
+    def _touch(self, rect):
+        self.version = next(self._versions)
+        self._dirty_log.append((self.version, rect))
+        if len(self._dirty_log) > self.DIRTY_LOG_SIZE:
+            self._log_base = self._dirty_log.pop(0)[0]
+
+    def snapshot(self):
+        return LayerSnapshot(self.shape, dict(self._tiles), self.version, self.TILE_SIZE,
+                             tuple(self._dirty_log), self._log_base)
+
+    def to_dense(self):
+        return self.snapshot().to_dense()
+
+    @classmethod
+    def from_bytes(cls, shape, data):
+        """从 LayerSnapshot.to_bytes() 的结果恢复图层。"""
+        layer = cls(*shape)
+        raw = zlib.decompress(data)
+        count = int(np.frombuffer(raw, dtype=np.uint32, count=1)[0])
+        keys = np.frombuffer(raw, dtype=np.uint32, count=count * 2, offset=4).reshape(-1, 2)
+        t, (h, w) = cls.TILE_SIZE, shape
+        offset = 4 + keys.nbytes
+        for ty, tx in keys.tolist():
+            th, row_bytes = min(t, h - ty * t), (min(t, w - tx * t) + 7) // 8
+            layer._tiles[(ty, tx)] = np.frombuffer(raw, dtype=np.uint8, count=th * row_bytes, offset=offset).reshape(th, row_bytes)
+            offset += th * row_bytes
+        return layer
+
+
+class LayerSnapshot:
+    """ManualLayer 在某个版本的只读快照。瓦片在遍历时才解压，不展开成整张图层。"""
+    def __init__(self, shape, tiles, version, tile_size, dirty_log=(), log_base=0):
+        self.shape = shape
+        self.version = version
+        self._tiles = tiles
+        self._tile_size = tile_size
+        self._dirty_log = dirty_log
+        self._log_base = log_base
+
+    def dirty_rect_since(self, version):
+        """返回自 version 之后所有修改的外接矩形 (x0, y0, x1, y1)；无修改返回 None，无记录时返回整图。"""
+        if version == self.version:
+            return None
+        h, w = self.shape
+        if version is None or version < self._log_base:
+            return 0, 0, w, h
+        return union_rects(rect for v, rect in self._dirty_log if v > version)
+
+    def _unpack(self, ty, tx):
+        packed = self._tiles[(ty, tx)]
+        return ManualLayer.unpack(packed, min(self._tile_size, self.shape[1] - tx * self._tile_size))
+
+    def iter_tiles(self, rect=None):
+        """遍历画过的瓦片 (解压为 0/255)，产出 (y, x, 瓦片)；指定 rect 时只产出与之相交的部分。"""
+        t = self._tile_size
+        if rect is None:
+            for ty, tx in self._tiles:
+                yield ty * t, tx * t, self._unpack(ty, tx)
+            return
+        x0, y0, x1, y1 = rect
+        for ty, tx in self._tiles:
+            ya, xa = max(y0, ty * t), max(x0, tx * t)
+            yb, xb = min(y1, (ty + 1) * t, self.shape[0]), min(x1, (tx + 1) * t, self.shape[1])
+            if ya < yb and xa < xb:
+                yield ya, xa, self._unpack(ty, tx)[ya - ty * t:yb - ty * t, xa - tx * t:xb - tx * t]
+
+    def to_dense(self):
+        dense = np.zeros(self.shape, dtype=np.uint8)
+        for y, x, tile in self.iter_tiles():
+            dense[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        return dense
+
+    def to_bytes(self):
+        """瓦片数量、瓦片坐标和各压缩瓦片依次拼接后再用 zlib 压缩，用于持久保存。"""
+        keys = sorted(self._tiles)
+        header = np.array([len(keys)] + [v for key in keys for v in key], dtype=np.uint32)
+        return zlib.compress(header.tobytes() + b"".join(self._tiles[key].tobytes() for key in keys), 1)
+
+
+class EditHistory:
     """
-    自定义 Session，用于直接加载本地 ONNX 模型，绕过 rembg 的下载和校验逻辑。
+    蒙版编辑的撤销/重做栈。每一步只记录这一笔改动过的瓦片在改动前后的压缩数据，
+    撤销/重做只替换这些瓦片，代价与笔画面积成正比而与图片大小无关。
+    两个栈的总占用超过 max_bytes 时丢弃最早的步骤。
     """
-    def __init__(self, model_path):
-        self.model_name = os.path.splitext(os.path.basename(model_path))[0]
-        # 显式指定 providers，优先使用 CPU，避免部分环境 CUDA 报错
-        # 如果您有 GPU 环境，onnxruntime 会自动优先尝试 CUDAExecutionProvider
-        self.inner_session = ort.InferenceSession(
-            model_path, 
-            providers=ort.get_available_providers()
-        )
-
-class ImageProcessor:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._undo = []  # 每一步: [(图层, 改动前瓦片, 改动后瓦片), ...]
+        self._redo = []
+        self._bytes = 0
+
+    def push(self, changes):
+        changes = [change for change in changes if change[1]]
+        if not changes: return
+        self._redo.clear()
+        self._undo.append(changes)
+        self._bytes = sum(self._size(step) for step in self._undo)
+        while self._bytes > self.max_bytes and len(self._undo) > 1:
+            self._bytes -= self._size(self._undo.pop(0))
+
+    def undo(self):
+        return self._move(self._undo, self._redo, 1)
+
+    def redo(self):
+        return self._move(self._redo, self._undo, 2)
+
+    def clear(self):
+        self._undo, self._redo, self._bytes = [], [], 0
+
+    @staticmethod
+    def _move(source, target, side):
+        if not source: return False
+        step = source.pop()
+        for change in step:
+            change[0].restore_tiles(change[side])
+        target.append(step)
+        return True
+
+    @staticmethod
+    def _size(step):
+        return sum(packed.nbytes for _, before, after in step
+                   for tiles in (before, after) for packed in tiles.values() if packed is not None)
+
+
+class PipelineCancelled(Exception):
+    """请求已被更新的请求取代，流水线中途放弃。"""
+
+
+class CancelToken:
     """
-    负责图像处理的核心算法，与UI解耦。
+    请求的取消令牌。UI 每发出一个新请求就取消上一个请求的令牌，
+    流水线在每个需要重算的阶段开始前检查，做到“最新请求优先”。
     """
-    _sessions = {}
+    def __init__(self):
+        self.cancelled = False
 
-    @classmethod
-    def get_session(cls, model_name):
-        if model_name not in cls._sessions:
-            print(f"正在请求模型: {model_name} ...")
-            
-            # 1. 检查项目本地目录
-            local_path = os.path.join(local_models_dir, f"{model_name}.onnx")
+    def cancel(self):
+        self.cancelled = True
 
-            
-            target_path = None
-            
-            if os.path.exists(local_path):
-                print(f"✅ 在项目目录找到模型: {local_path}")
-                target_path = local_path
-            
-            try:
-                # 只有在需要下载时，才强制指定下载目录到项目下的 models
-                # 这样下载后的文件就在项目里，方便打包
-                cls._sessions[model_name] = new_session(model_name)
-            except Exception as e:
-                print(f"❌ 模型加载失败: {e}")
-                return None
-                
-        return cls._sessions[model_name]
+    def check(self):
+        if self.cancelled:
+            raise PipelineCancelled()
+
+
+class ProcessingRequest:
+    """
+    UI 线程交给后台线程的一次处理请求。
+    只携带引用和版本号：原图在加载后即为只读，手动图层以写时复制快照传递。
+    """
+    def __init__(self, params, raw_image, image_id, image_version, manual_draw, manual_erase, force_full=False, scale=1.0,
+                 token=None, decoded=None):
+        self.params = params
+        self.raw_image = raw_image
+        self.decoded = decoded        # DecodedImage，全分辨率时直接复用其中缓存的颜色空间转换
+        self.image_id = image_id
+        self.image_version = image_version
+        self.manual_draw = manual_draw
+        self.manual_erase = manual_erase
+        self.force_full = force_full  # 要求返回完整蒙版而不是局部补丁
+        self.scale = scale            # < 1 时在缩小的代理图上预览
+        self.token = token or CancelToken()
+
+
+class ProcessingResult:
+    """
+    后台线程返回的结果。rect 为 None 时 mask 是完整蒙版 (result_id 为其编号)；
+    否则 mask 只是 rect 区域的补丁，需要叠加到编号为 base_id 的完整蒙版上。
+    """
+    def __init__(self, image_version, mask, match_ratio, stage_stats, result_id=None, rect=None, base_id=None, scale=1.0,
+                 token=None):
+        self.image_version = image_version
+        self.scale = scale
+        self.token = token  # 产生该结果的请求，用于判断蒙版是否对应最新的参数和图层
+        self.done_time = time.perf_counter()  # 用于统计结果从完成到上屏的延迟
+        self.mask = mask
+        self.match_ratio = match_ratio
+        self.stage_stats = stage_stats
+        self.result_id = result_id
+        self.rect = rect
+        self.base_id = base_id
+
+
+class MaskPipeline:
+    """
+    分阶段的蒙版流水线：颜色转换 → 基础蒙版 → 位移 → 形态学 → 手动合并 → 阈值。
+    每个阶段的缓存键 = 上游阶段的键 + 本阶段自己的参数，
+    参数变化时只有该阶段及其下游会重新计算，其余阶段直接命中缓存。
+    位移、形态学、阈值用 ipf_engine 的 MaskStages 计算，与批量处理 (ipf_engine.process) 结果一致。
+    """
+    STAGES = (("convert", "转换"), ("base", "基础"), ("shift", "位移"),
+              ("morph", "形态"), ("manual", "手动"), ("threshold", "阈值"))
+
+    # 本地处理服务 (python -m ipf_engine.server) 可用时，AI 推理交给它，省去加载模型的时间
+    remote = None
+
+    # 界面上的模式 -> ImageProcessor.MODES 中的名称 (本工具的“彩色背景”是 RGBA 范围)
+    ENGINE_MODES = {"color": "rgba_range", "gray": "gray", "yellow": "yellow", "rembg": "rembg"}
+
+    # 各模式的基础蒙版只依赖这些参数
+    BASE_PARAMS = {mode: ImageProcessor.MODES[name].params for mode, name in ENGINE_MODES.items()}
+
+    # convert 阶段输出的颜色空间
+    COLOR_SPACES = {mode: ImageProcessor.MODES[name].color_space for mode, name in ENGINE_MODES.items()}
+
+    _rembg_cache = {}  # AI 推理很慢，额外保留最近几张图的全分辨率结果，代理/全分辨率流水线共用
+
+    def __init__(self):
+        self._cache = {}        # stage -> (key, value)，每个阶段只保留最近一次结果
+        self._scaled_layers = (None, None)
+        self.stats = []
+        self.dirty_rect = None  # 本次只在该区域内增量更新了最终蒙版 (原地修改缓存)
+        self._token = None
+
+    def _stage(self, name, key, compute, cancellable=True):
+        start = time.perf_counter()
+        cached = self._cache.get(name)
+        hit = cached is not None and cached[0] == key
+        if hit:
+            value = cached[1]
+        else:
+            # 只在真正要重算前检查取消；每个阶段的缓存都在计算完成后才写入，取消不会留下不一致的状态。
+            # 例如 AI 推理本身无法中断，但推理结果会先进入缓存，过期请求在后续形态学等阶段之前就被放弃。
+            if cancellable and self._token is not None:
+                self._token.check()
+            with Profiler.span(f"stage.{name}"):
+                value = compute()
+            self._cache[name] = (key, value)
+        self.stats.append((name, hit, (time.perf_counter() - start) * 1000))
+        return value
+
+    def run(self, request):
+        """
+        执行流水线，返回 (最终蒙版, 颜色匹配率)。各阶段命中情况与耗时记录在 self.stats。
+        返回的蒙版属于流水线缓存，后续增量更新会原地修改它，调用方需要自行复制。
+        请求被取消时抛出 PipelineCancelled。
+        """
+        self.stats = []
+        self.dirty_rect = None
+        self._token = request.token
+        params, raw_image, scale = request.params, request.raw_image, request.scale
+        manual_draw, manual_erase = request.manual_draw, request.manual_erase
+        mode = params['mode']
+        if scale != 1:
+            manual_draw, manual_erase = self._scaled_manual_layers(request)
+
+        key = (request.image_id, request.image_version, scale, self.COLOR_SPACES.get(mode, "bgr"))
+        image = self._stage("convert", key, lambda: self._convert(raw_image, mode, scale, request.decoded))
+
+        mode_params = tuple(params.get(name) for name in self.BASE_PARAMS.get(mode, ()))
+        key = (key, mode) + mode_params
+        base_mask, match_ratio = self._stage("base", key, lambda: self._compute_base(
+            mode, image, params, (request.image_id,) + mode_params, raw_image, scale))
+
+        # 代理预览时，所有以像素为单位的参数都按比例缩放，保证与全分辨率结果一致
+        shift = MaskStages.shift_args(self.ENGINE_MODES.get(mode), params, scale)
+        key = (key,) + shift
+        mask = self._stage("shift", key, lambda: MaskStages.shift(base_mask, *shift))
+
+        morph = MaskStages.morph_args(params, scale)
+        key = (key,) + morph
+        mask = self._stage("morph", key, lambda: MaskStages.morph(mask, *morph))
+
+        morph_key = key
+        key = (key, manual_draw and manual_draw.version, manual_erase and manual_erase.version)
+        thresh_val = MaskStages.threshold_args(params)
+        rect = self._incremental_rect(morph_key, mask, manual_draw, manual_erase, thresh_val) if scale == 1 else None
+        if rect is not None:
+            return self._update_region(rect, key, thresh_val, mask, manual_draw, manual_erase), match_ratio
+
+        mask = self._stage("manual", key, lambda: self._merge_manual(mask, manual_draw, manual_erase))
+
+        key = (key, thresh_val)
+        mask = self._stage("threshold", key, lambda: MaskStages.threshold(mask, thresh_val), cancellable=False)
+
+        return mask, match_ratio
+
+    def _incremental_rect(self, morph_key, morph_mask, manual_draw, manual_erase, thresh_val):
+        """
+        只有手动图层变化、且变化区域不大时，返回需要重算的区域。
+        形态学在手动合并之前，笔触不影响上游阶段，因此区域无需按形态学核外扩。
+        阈值也变了时缓存的最终蒙版整张都过期，不能只重算笔触区域。
+        """
+        if manual_draw is None or manual_erase is None:
+            return None
+        manual, threshold = self._cache.get("manual"), self._cache.get("threshold")
+        if manual is None or threshold is None or threshold[0] != (manual[0], thresh_val):
+            return None
+        (cached_morph_key, draw_version, erase_version), merged = manual
+        if cached_morph_key != morph_key or merged is morph_mask:
+            return None
+        rect = union_rects(r for r in (manual_draw.dirty_rect_since(draw_version),
+                                       manual_erase.dirty_rect_since(erase_version)) if r is not None)
+        if rect is None or (rect[2] - rect[0]) * (rect[3] - rect[1]) * 2 > morph_mask.size:
+            return None
+        return rect
+
+    def _update_region(self, rect, key, thresh_val, morph_mask, manual_draw, manual_erase):
+        """在缓存的手动合并/阈值结果上原地重算 rect 区域。"""
+        x0, y0, x1, y1 = rect
+
+        start = time.perf_counter()
+        merged = self._cache["manual"][1]
+        merged[y0:y1, x0:x1] = morph_mask[y0:y1, x0:x1]
+        self._merge_manual(merged, manual_draw, manual_erase, rect)
+        self._cache["manual"] = (key, merged)
+        self.stats.append(("manual", None, (time.perf_counter() - start) * 1000))
+
+        start = time.perf_counter()
+        final = self._cache["threshold"][1]
+        region = final[y0:y1, x0:x1]
+        MaskStages.threshold(merged[y0:y1, x0:x1], thresh_val, dst=region)
+        self._cache["threshold"] = ((key, thresh_val), final)
+        self.stats.append(("threshold", None, (time.perf_counter() - start) * 1000))
+
+        self.dirty_rect = rect
+        return final
 
     @staticmethod
-    def cv_imread(file_path):
+    def _convert(raw_image, mode, scale, decoded=None):
+        """按模式转换颜色空间；黄色模式返回 HSV 三个平面。结果随 convert 阶段按图片缓存。"""
+        if decoded is not None and scale == 1:
+            return decoded.view(MaskPipeline.COLOR_SPACES.get(mode, "bgr"))
+        if scale != 1:
+            h, w = raw_image.shape[:2]
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            raw_image = cv2.resize(raw_image, size, interpolation=cv2.INTER_AREA)
+        return ImageProcessor.convert(raw_image, MaskPipeline.COLOR_SPACES.get(mode, "bgr"))
+
+    def _scaled_manual_layers(self, request):
+        """把手动图层缩放到代理分辨率，按图层版本缓存。"""
+        key = (request.manual_draw.version, request.manual_erase.version, request.scale)
+        if self._scaled_layers[0] != key:
+            h, w = request.raw_image.shape[:2]
+            size = (max(1, int(w * request.scale)), max(1, int(h * request.scale)))
+            layers = []
+            for snapshot in (request.manual_draw, request.manual_erase):
+                dense = cv2.resize(snapshot.to_dense(), size, interpolation=cv2.INTER_NEAREST)
+                layers.append(LayerSnapshot(dense.shape, ManualLayer.pack_tiles(dense), snapshot.version, ManualLayer.TILE_SIZE))
+            self._scaled_layers = (key, tuple(layers))
+        return self._scaled_layers[1]
+
+    def _compute_base(self, mode, image, params, rembg_key, raw_image, scale):
+        base_mask, match_ratio = None, 0
+        if mode == 'rembg':
+            # 按文件路径缓存，来回切换图片时也能复用推理结果；
+            # 模型输入尺寸固定，代理预览直接缩小全分辨率结果，避免重复推理
+            if rembg_key in self._rembg_cache:
+                base_mask = self._rembg_cache[rembg_key]
+            else:
+                base_mask = self._remote_rembg(raw_image, params)
+                if base_mask is None:
+                    base_mask, _ = ImageProcessor.compute_mask("rembg", ImageProcessor.to_bgr(raw_image), params)
+                if len(self._rembg_cache) > 5: self._rembg_cache.clear()
+                self._rembg_cache[rembg_key] = base_mask
+            if scale != 1:
+                base_mask = cv2.resize(base_mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_AREA)
+        elif mode in self.ENGINE_MODES:
+            base_mask, match_ratio = ImageProcessor.compute_mask(self.ENGINE_MODES[mode], image, params, scale)
+
+        if base_mask is None:
+            base_mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        return base_mask, match_ratio
+
+    def _remote_rembg(self, raw_image, params):
+        """通过处理服务计算 AI 基础蒙版；服务不可用或出错时返回 None，之后改为本地推理。"""
+        client = MaskPipeline.remote
+        if client is None:
+            return None
         try:
-            return cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            return client.process(ImageProcessor.to_bgr(raw_image), dict(params, mode="rembg"), base_only=True,
+                                  priority=1)["mask"]
         except Exception as e:
-            print(f"Error reading file {file_path}: {e}")
+            print(f"处理服务调用失败，改为本地推理: {e}")
+            MaskPipeline.remote = None
             return None
 
     @staticmethod
-    def cv_imwrite(file_path, img):
+    @Profiler.timed("merge_manual")
+    def _merge_manual(mask, manual_draw, manual_erase, rect=None):
+        """合并手动图层；不指定 rect 时返回新数组，指定 rect 时只原地修改该区域。"""
+        if manual_draw is None and manual_erase is None:
+            return mask
+        if rect is None:
+            mask = mask.copy()
+        if manual_draw is not None:
+            for y, x, tile in manual_draw.iter_tiles(rect):
+                region = mask[y:y + tile.shape[0], x:x + tile.shape[1]]
+                np.bitwise_or(region, tile, out=region)
+        if manual_erase is not None:
+            for y, x, tile in manual_erase.iter_tiles(rect):
+                region = mask[y:y + tile.shape[0], x:x + tile.shape[1]]
+                np.bitwise_and(region, np.bitwise_not(tile), out=region)
+        return mask
+
+    def format_stats(self):
+        """✓ 命中缓存，✗ 完整重算，△ 仅重算脏区域。"""
+        labels = dict(self.STAGES)
+        marks = {True: '✓', False: '✗', None: '△'}
+        return " ".join(f"{labels[name]}{marks[hit]}{ms:.1f}ms" for name, hit, ms in self.stats)
+
+
+class ShelfPacker:
+    """
+    货架 (shelf) 装箱：矩形按高度从高到低排序，依次放进第一个放得下的货架 (行)；
+    都放不下时在图集底部新开货架，图集满了再开新图集。空间利用率略低于 MaxRects，
+    但只需 O(矩形数 × 货架数)，上千个切片也是瞬间完成。
+    """
+    def __init__(self, max_size=4096, padding=2):
+        self.max_size = max_size
+        self.padding = padding  # 切片之间留空，避免纹理采样时相互渗色
+
+    def pack(self, sizes):
+        """sizes 为 [(w, h), ...]；返回 (每个矩形的 (图集序号, x, y), 每个图集的 (宽, 高))。"""
+        pad, limit = self.padding, self.max_size
+        placements = [None] * len(sizes)
+        atlases = []  # 每个图集: [已用宽, 已用高, 货架列表 (超大切片为 None)]，货架为 [y, 高, 已用宽]
+        for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])):
+            w, h = sizes[i]
+            if w > limit or h > limit:
+                # 比图集还大的切片单独成一张图集
+                placements[i] = (len(atlases), 0, 0)
+                atlases.append([w, h, None])
+                continue
+            placements[i] = self._place(atlases, w, h, pad, limit)
+        return placements, [(width, height) for width, height, _ in atlases]
+
+    @staticmethod
+    def _place(atlases, w, h, pad, limit):
+        # 先找已有货架，再在某张图集底部新开货架
+        for index, (_, _, shelves) in enumerate(atlases):
+            for shelf in shelves or ():
+                if shelf[1] >= h and shelf[2] + w <= limit:
+                    x = shelf[2]
+                    shelf[2] += w + pad
+                    atlases[index][0] = max(atlases[index][0], x + w)
+                    return index, x, shelf[0]
+        for index, atlas in enumerate(atlases):
+            y = atlas[1] + pad
+            if atlas[2] is not None and y + h <= limit:
+                atlas[2].append([y, h, w + pad])
+                atlas[0], atlas[1] = max(atlas[0], w), y + h
+                return index, 0, y
+        atlases.append([w, h, [[0, h, w + pad]]])
+        return len(atlases) - 1, 0, 0
+
+
+class CropBatch:
+    """一张图片 (或一张图集) 的写入任务。written / failed 由写入线程累加，UI 线程只读取。"""
+    def __init__(self, name, total, on_done=None):
+        self.name = name
+        self.total = total
+        self.written = 0
+        self.failed = 0
+        self.summary = None     # 完成后的说明文字，为 None 时按切片数显示
+        self.on_done = on_done  # 全部写完后由 UI 线程调用
+
+    @property
+    def done(self):
+        return self.written + self.failed >= self.total
+
+
+class CropWriter:
+    """
+    后台切片写入：裁剪、合成透明通道、PNG 编码和写盘都在线程池中完成，UI 线程只负责提交。
+    可以每个切片写一个文件 (submit)，也可以打包成图集 (cut_sprites + submit_atlas)。
+    每完成一个任务调用一次 on_progress(batch) (在写入线程中)。
+    """
+    def __init__(self, on_progress, workers=None):
+        self._pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                        thread_name_prefix="crop-writer")
+        self._on_progress = on_progress
+        self._lock = threading.Lock()
+        self.packer = ShelfPacker()
+
+    def submit(self, name, raw_image, alpha_mask, boxes, output_dir, base_name, png_compression=1, on_done=None):
+        """
+        raw_image 需为只读 (不会再被修改) 的原图；alpha_mask 为 None 时保留原图透明度，
+        否则与其按位与。返回 CropBatch 用于查询进度。
+        """
+        batch = CropBatch(name, len(boxes), on_done)
+        for i, box in enumerate(boxes):
+            save_path = os.path.join(output_dir, f"{base_name}_{i}.png")
+            self._pool.submit(self._write, batch, raw_image, alpha_mask, box, save_path, png_compression)
+        return batch
+
+    def cut_sprites(self, source_name, raw_image, alpha_mask, boxes, base_name):
+        """在后台裁出切片并去掉四周全透明的边，返回 Future，结果为 submit_atlas 所需的切片列表。"""
+        return self._pool.submit(self._cut_sprites, source_name, raw_image, alpha_mask, boxes, base_name)
+
+    def submit_atlas(self, name, sprite_futures, output_dir, atlas_name, png_compression=1, on_done=None):
+        """
+        把若干 cut_sprites 的结果装箱成图集，写出 {atlas_name}_{n}.png 和 {atlas_name}.json。
+        整个图集算一个任务，写完后 batch.summary 给出切片和图集数量。
+        """
+        batch = CropBatch(name, 1, on_done)
+        self._pool.submit(self._write_atlas, batch, sprite_futures, output_dir, atlas_name, png_compression)
+        return batch
+
+    def _write(self, batch, raw_image, alpha_mask, box, save_path, png_compression):
+        # 异常也要计入失败，否则这一批永远凑不满 total，状态栏一直停在“后台保存中”
         try:
-            is_success, im_buf = cv2.imencode(".png", img)
-            if is_success:
-                im_buf.tofile(file_path)
-                return True
+            success = ImageProcessor.cv_imwrite(save_path, CropEngine.cut(raw_image, alpha_mask, box), png_compression)
         except Exception as e:
-            print(f"Error writing file {file_path}: {e}")
-        return False
+            print(f"切片写入失败 {save_path}: {e}")
+            success = False
+        self._finish(batch, success)
+
+    def _finish(self, batch, success):
+        with self._lock:
+            if success:
+                batch.written += 1
+            else:
+                batch.failed += 1
+        self._on_progress(batch)
+
+    def submit_vectors(self, name, mask, labels, label_objects, boxes, output_dir, base_name, epsilon=1.0, on_done=None):
+        """
+        把每个对象的 RLE 和多边形追加到 output_dir/masks.jsonl (一行一个对象)。
+        labels / label_objects 来自 CropEngine.find_objects，mask 交给后台后不能再被修改。
+        """
+        batch = CropBatch(name, 1, on_done)
+        self._pool.submit(self._write_vectors, batch, name, mask, labels, label_objects, boxes, output_dir, base_name, epsilon)
+        return batch
+
+    def _write_vectors(self, batch, name, mask, labels, label_objects, boxes, output_dir, base_name, epsilon):
+        try:
+            height, width = mask.shape[:2]
+            lines = []
+            for i, (x, y, w, h) in enumerate(boxes):
+                obj = ((label_objects[labels[y:y + h, x:x + w]] == i) & (mask[y:y + h, x:x + w] > 0)).astype(np.uint8)
+                record = {"image": name, "name": f"{base_name}_{i}", "bbox": [x, y, w, h],
+                          "area": int(np.count_nonzero(obj)),
+                          "rle": {"size": [height, width], "counts": MaskEncoder.rle(obj, x, y, height, width)},
+                          "polygons": MaskEncoder.polygons(obj, x, y, epsilon)}
+                lines.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            # 多个写入线程可能同时追加同一个文件
+            with self._lock:
+                with open(os.path.join(output_dir, "masks.jsonl"), 'a', encoding='utf-8') as f:
+                    f.write("\n".join(lines) + "\n")
+            batch.summary = f"{len(lines)} 个对象的矢量蒙版已写入 masks.jsonl"
+            success = True
+        except Exception as e:
+            print(f"矢量蒙版写入失败 {name}: {e}")
+            success = False
+        self._finish(batch, success)
+
+    def _cut_sprites(self, source_name, raw_image, alpha_mask, boxes, base_name):
+        sprites = []
+        for i, box in enumerate(boxes):
+            crop = CropEngine.cut(raw_image, alpha_mask, box)
+            tx, ty, tw, th = cv2.boundingRect(crop[:, :, 3])
+            if tw == 0 or th == 0:
+                continue
+            sprites.append({"name": f"{base_name}_{i}", "source": source_name, "rect": box,
+                            "trim": (tx, ty, tw, th), "image": crop[ty:ty + th, tx:tx + tw]})
+        return sprites
+
+    def _write_atlas(self, batch, sprite_futures, output_dir, atlas_name, png_compression):
+        try:
+            sprites = [sprite for future in sprite_futures for sprite in future.result()]
+            placements, sizes = self.packer.pack([(s["image"].shape[1], s["image"].shape[0]) for s in sprites])
+            atlases = [np.zeros((h, w, 4), dtype=np.uint8) for w, h in sizes]
+            frames = {}
+            for sprite, (index, x, y) in zip(sprites, placements):
+                image = sprite["image"]
+                atlases[index][y:y + image.shape[0], x:x + image.shape[1]] = image
+                sx, sy, sw, sh = sprite["rect"]
+                tx, ty, tw, th = sprite["trim"]
+                frames[sprite["name"]] = {
+                    "atlas": f"{atlas_name}_{index}.png",
+                    "frame": {"x": x, "y": y, "w": tw, "h": th},
+                    "source": {"image": sprite["source"], "x": sx, "y": sy, "w": sw, "h": sh},
+                    "trimmed": (tw, th) != (sw, sh),
+                    "spriteSourceSize": {"x": tx, "y": ty, "w": tw, "h": th},
+                    "sourceSize": {"w": sw, "h": sh},
+                }
+
+            success = True
+            for index, atlas in enumerate(atlases):
+                success &= ImageProcessor.cv_imwrite(os.path.join(output_dir, f"{atlas_name}_{index}.png"), atlas, png_compression)
+            meta = {"atlases": [{"image": f"{atlas_name}_{i}.png", "w": w, "h": h} for i, (w, h) in enumerate(sizes)],
+                    "padding": self.packer.padding}
+            with open(os.path.join(output_dir, f"{atlas_name}.json"), 'w', encoding='utf-8') as f:
+                json.dump({"frames": frames, "meta": meta}, f, ensure_ascii=False, indent=1)
+            batch.summary = f"{len(sprites)} 个切片已打包为 {len(atlases)} 张图集"
+        except Exception as e:
+            print(f"图集写入失败 {atlas_name}: {e}")
+            success = False
+        self._finish(batch, success)
 
-    @staticmethod
-    def get_mask_rgba_range(raw_image, r_min, r_max, g_min, g_max, b_min, b_max, a_min, a_max, invert=True):
-        if len(raw_image.shape) == 2:
-            image_bgra = cv2.cvtColor(raw_image, cv2.COLOR_GRAY2BGRA)
-        elif raw_image.shape[2] == 3:
-            image_bgra = cv2.cvtColor(raw_image, cv2.COLOR_BGR2BGRA)
-        else:
-            image_bgra = raw_image
 
-        lower_bound = np.array([b_min, g_min, r_min, a_min], dtype=np.uint8)
-        upper_bound = np.array([b_max, g_max, r_max, a_max], dtype=np.uint8)
-        
-        mask = cv2.inRange(image_bgra, lower_bound, upper_bound)
-        match_ratio = np.count_nonzero(mask) / (mask.shape[0] * mask.shape[1])
-        
-        if invert:
-            return cv2.bitwise_not(mask), match_ratio
-        else:
-            return mask, match_ratio
+class FolderIndexer:
+    """
+    后台扫描图片文件夹：用 os.scandir 遍历，按自然顺序 (frame_2 < frame_10) 分批交给 UI，
+    批次大小逐次翻倍，第一张图很快就能显示，合并排序的总开销也不大。
+    索引 (文件名 -> [大小, 修改时间, 宽, 高]) 保存在 {文件夹}/.ipf_cache/index.json：
+    - 文件夹修改时间没变 (没有增删改名) 时直接使用索引，不再逐个 stat；
+    - 否则重新扫描，大小和修改时间都没变的文件沿用索引里的尺寸，只读取变化文件的图片头。
+    """
+    VALID_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+    CACHE_DIR = ".ipf_cache"
+    FIRST_BATCH = 256
+
+    def __init__(self, folder, on_batch):
+        self.folder = folder
+        self.on_batch = on_batch  # 在扫描线程中调用 on_batch(indexer, 本批文件名, 是否扫描完毕)
+        self.cancelled = False
+        self.entries = {}
+        self.index_path = os.path.join(folder, self.CACHE_DIR, "index.json")
 
     @staticmethod
-    def get_mask_yellow(img, h_center, h_tol, s_min, v_min):
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        min_h, max_h = h_center - h_tol, h_center + h_tol
-
-        if min_h < 0:
-            lower1, upper1 = np.array([min_h + 180, s_min, v_min]), np.array([179, 255, 255])
-            lower2, upper2 = np.array([0, s_min, v_min]), np.array([max_h, 255, 255])
-            mask = cv2.bitwise_or(cv2.inRange(hsv, lower1, upper1), cv2.inRange(hsv, lower2, upper2))
-        elif max_h > 179:
-            lower1, upper1 = np.array([min_h, s_min, v_min]), np.array([179, 255, 255])
-            lower2, upper2 = np.array([0, s_min, v_min]), np.array([max_h - 180, 255, 255])
-            mask = cv2.bitwise_or(cv2.inRange(hsv, lower1, upper1), cv2.inRange(hsv, lower2, upper2))
-        else:
-            lower, upper = np.array([min_h, s_min, v_min]), np.array([max_h, 255, 255])
-            mask = cv2.inRange(hsv, lower, upper)
+    def natural_key(name):
+        # re.split 的结果总是 文本, 数字, 文本, ... 交替，同一位置的类型一致，可以直接比较
+        return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name.lower())]
 
-        return mask
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
 
-    @staticmethod
-    def get_mask_gray(img, thresh_val, bg_type):
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        type_flag = cv2.THRESH_BINARY if bg_type == "black" else cv2.THRESH_BINARY_INV
+    def cancel(self):
+        self.cancelled = True
 
-        if thresh_val == 0:
-            type_flag += cv2.THRESH_OTSU
+    def _run(self):
+        try:
+            # 先建好缓存目录，它本身不会再改变文件夹的修改时间
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        except OSError:
+            pass  # 只读文件夹：照常扫描，只是不保存索引
+        try:
+            dir_mtime = os.stat(self.folder).st_mtime_ns
+        except OSError as e:
+            print(f"无法读取文件夹 {self.folder}: {e}")
+            self.on_batch(self, [], True)
+            return
 
-        _, mask = cv2.threshold(blurred, thresh_val, 255, type_flag)
-        return mask
+        cached_mtime, cached = self._load_index()
+        if cached and cached_mtime == dir_mtime:
+            self.entries = cached
+            self.on_batch(self, sorted(cached, key=self.natural_key), True)
+        else:
+            if not self._scan(cached):
+                return
+        if self._fill_dimensions() or cached_mtime != dir_mtime:
+            # 记录扫描开始时的文件夹时间：扫描期间有变化时，下次会重新扫描
+            self._save_index(dir_mtime)
+
+    def _scan(self, cached):
+        """返回 False 表示中途被取消。"""
+        batch, limit = [], self.FIRST_BATCH
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if self.cancelled:
+                    return False
+                name = entry.name
+                if not name.lower().endswith(self.VALID_EXTS) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                old = cached.get(name)
+                if old and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+                    self.entries[name] = old
+                else:
+                    self.entries[name] = [stat.st_size, stat.st_mtime_ns, None, None]
+                batch.append(name)
+                if len(batch) >= limit:
+                    self.on_batch(self, sorted(batch, key=self.natural_key), False)
+                    batch, limit = [], len(self.entries)
+        self.on_batch(self, sorted(batch, key=self.natural_key), True)
+        return True
+
+    def _fill_dimensions(self):
+        """读取缺少尺寸的图片头 (PIL 只解析文件头，不解码像素)。返回是否有更新。"""
+        updated = False
+        for name, entry in self.entries.items():
+            if self.cancelled:
+                break
+            if entry[2] is not None:
+                continue
+            try:
+                with Image.open(os.path.join(self.folder, name)) as im:
+                    entry[2], entry[3] = im.size
+            except Exception:
+                entry[2], entry[3] = 0, 0  # 无法识别的文件，之后不再重复尝试
+            updated = True
+        return updated
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data.get("dir_mtime"), data.get("entries", {})
+        except (OSError, ValueError):
+            return None, {}
+
+    def _save_index(self, dir_mtime):
+        try:
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"dir_mtime": dir_mtime, "entries": self.entries}, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            print(f"索引保存失败 {self.index_path}: {e}")
+
+
+class DecodedImage:
+    """
+    解码后的只读图片，以及按需转换并缓存的视图 ("bgr" / "bgra" / "hsv" 平面)，可在线程间共享。
+    """
+    def __init__(self, raw):
+        raw.flags.writeable = False
+        self.raw = raw
+        self._views = {}
+
+    def view(self, kind):
+        if kind not in self._views:
+            if kind == "bgr":
+                value = ImageProcessor.to_bgr(self.raw)
+            elif kind == "bgra":
+                value = ImageProcessor.to_bgra(self.raw)
+            else:
+                value = ImageProcessor.to_hsv_planes(self.view("bgr"))
+            for array in (value if isinstance(value, tuple) else (value,)):
+                array.flags.writeable = False
+            self._views[kind] = value  # 两个线程同时转换时只是多算一次，结果相同
+        return self._views[kind]
+
+    @property
+    def nbytes(self):
+        arrays = {id(self.raw): self.raw}
+        for value in list(self._views.values()):
+            for array in (value if isinstance(value, tuple) else (value,)):
+                arrays[id(array)] = array
+        return sum(array.nbytes for array in arrays.values())
+
+
+class ImageRingBuffer:
+    """
+    当前图片前后各 radius 张的解码缓存。focus() 告知当前位置后，后台线程按距离由近到远预先解码；
+    超出范围的图片立即淘汰，总内存超过 max_bytes 时再从最远的开始淘汰 (当前图片始终保留)。
+    来回切换时直接取缓存，不再重新解码。
+    """
+    def __init__(self, radius=3, max_bytes=1536 * 1024 * 1024):
+        self.radius = radius
+        self.max_bytes = max_bytes
+        self._images = {}       # (文件夹, 文件名) -> DecodedImage
+        self._wanted = []       # 按预读优先级排列的键，第一个是当前图片
+        self._skipped = set()   # 本轮解码失败的键
+        self._stalled = False   # 预读结果放不下时，本轮停止预读
+        self._decoding = None
+        self._lock = threading.Condition()
+        threading.Thread(target=self._prefetch_loop, daemon=True).start()
+
+    def focus(self, folder, files, index):
+        order = [index]
+        for step in range(1, self.radius + 1):
+            order += [index + step, index - step]  # 向后优先，多数时候是在往下翻
+        with self._lock:
+            self._wanted = [(folder, files[i]) for i in order if 0 <= i < len(files)]
+            self._skipped = set()
+            self._stalled = False
+            self._trim()
+            self._lock.notify_all()
+
+    def get(self, folder, name):
+        """取出解码结果；不在缓存中时同步解码。无法读取时返回 None。"""
+        key = (folder, name)
+        with self._lock:
+            while self._decoding == key:
+                self._lock.wait()  # 预读线程正在解码这张，等它完成
+            image = self._images.get(key)
+        if image is None:
+            image = self._decode(key)
+            if image is not None:
+                with self._lock:
+                    self._images[key] = image
+                    self._trim()
+        return image
 
     @staticmethod
-    def get_mask_rembg(img, model_name="u2net", alpha_matting=False, am_fg_thresh=240, am_bg_thresh=10, am_erode=10):
+    def _decode(key):
+        raw = ImageProcessor.cv_imread(os.path.join(*key))
+        if raw is None:
+            return None
+        image = DecodedImage(raw)
+        image.view("bgr")  # 显示一定会用到
+        return image
+
+    def _next_missing(self):
+        if self._stalled:
+            return None
+        for key in self._wanted:
+            if key not in self._images and key not in self._skipped:
+                return key
+        return None
+
+    def _prefetch_loop(self):
+        while True:
+            with self._lock:
+                key = self._next_missing()
+                while key is None:
+                    self._lock.wait()
+                    key = self._next_missing()
+                self._decoding = key
+            image = self._decode(key)
+            with self._lock:
+                self._decoding = None
+                if image is None:
+                    self._skipped.add(key)
+                elif key in self._wanted:
+                    self._images[key] = image
+                    self._trim()
+                    # 刚解码的图被淘汰说明内存预算已满，更远的图也放不下
+                    self._stalled = key not in self._images
+                self._lock.notify_all()
+
+    def _trim(self):
+        rank = {key: i for i, key in enumerate(self._wanted)}
+        for key in [key for key in self._images if key not in rank]:
+            del self._images[key]
+        total = sum(image.nbytes for image in self._images.values())
+        for key in sorted(self._images, key=lambda k: rank[k], reverse=True):
+            if total <= self.max_bytes or rank[key] == 0:
+                break
+            total -= self._images.pop(key).nbytes
+
+
+class ThumbnailCache:
+    """
+    文件夹缩略图：后台线程池生成，持久保存在 {文件夹}/.ipf_cache/thumbs/，
+    文件名由 文件名+修改时间+大小 哈希而来，原图改动后自动生成新的缩略图。
+    JPEG 用 IMREAD_REDUCED_* 在解码时直接缩小 (1/2~1/8)，只解码需要的分辨率。
+    只处理最近一次 request() 仍然需要的图片，快速滚动时排队的旧任务会直接跳过。
+    """
+    SIZE = 96
+    QUALITY = 85
+    REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+    def __init__(self, folder, on_ready, workers=None):
+        self.folder = folder
+        self.on_ready = on_ready  # 在线程池中调用，结果通过 ready 队列取出
+        self.ready = queue.Queue()  # (文件名, RGB 缩略图 或 None)
+        self.thumb_dir = os.path.join(folder, FolderIndexer.CACHE_DIR, "thumbs")
+        self._lock = threading.Lock()
+        self._wanted = set()
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                            thread_name_prefix="thumbs")
         try:
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            pil_img = Image.fromarray(img_rgb)
-            
-            session = ImageProcessor.get_session(model_name)
-            if session is None:
-                return np.zeros(img.shape[:2], dtype=np.uint8)
-
-            output = remove(
-                pil_img,
-                session=session,
-                alpha_matting=alpha_matting,
-                alpha_matting_foreground_threshold=am_fg_thresh,
-                alpha_matting_background_threshold=am_bg_thresh,
-                alpha_matting_erode_size=am_erode
-            )
-            
-            output_np = np.array(output)
-            if output_np.shape[2] == 4:
-                return output_np[:, :, 3]
-            return np.zeros(img.shape[:2], dtype=np.uint8)
+            os.makedirs(self.thumb_dir, exist_ok=True)
+        except OSError:
+            self.thumb_dir = None  # 只读文件夹：照常生成，只是不保存
+
+    def request(self, names):
+        """names 为当前需要的全部文件名 (可见的和即将可见的)，未在生成中的提交到线程池。"""
+        with self._lock:
+            self._wanted = set(names)
+            new = [name for name in names if name not in self._pending]
+            self._pending.update(new)
+        for name in new:
+            self._executor.submit(self._load, name)
+
+    def close(self):
+        with self._lock:
+            self._wanted = set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load(self, name):
+        with self._lock:
+            if name not in self._wanted:
+                self._pending.discard(name)
+                return
+        thumb = None
+        try:
+            thumb = self._get(name)
         except Exception as e:
-            print(f"Rembg error: {e}")
-            return np.zeros(img.shape[:2], dtype=np.uint8)
+            print(f"缩略图生成失败 {name}: {e}")
+        with self._lock:
+            self._pending.discard(name)
+        self.ready.put((name, thumb))
+        self.on_ready()
+
+    def _get(self, name):
+        path = os.path.join(self.folder, name)
+        stat = os.stat(path)
+        cache_path = None
+        if self.thumb_dir:
+            key = hashlib.sha1(f"{name}\0{stat.st_mtime_ns}\0{stat.st_size}".encode("utf-8")).hexdigest()
+            cache_path = os.path.join(self.thumb_dir, key + ".jpg")
+            if os.path.exists(cache_path):
+                thumb = cv2.imdecode(np.fromfile(cache_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if thumb is not None:
+                    return cv2.cvtColor(thumb, cv2.COLOR_BGR2RGB)
+
+        thumb = self._decode(path)
+        if thumb is None:
+            return None
+        if cache_path:
+            ok, buf = cv2.imencode(".jpg", thumb, [cv2.IMWRITE_JPEG_QUALITY, self.QUALITY])
+            if ok:
+                # 先写临时文件再改名，多个进程同时生成也不会读到半个文件
+                temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+                buf.tofile(temp_path)
+                os.replace(temp_path, cache_path)
+        return cv2.cvtColor(thumb, cv2.COLOR_BGR2RGB)
+
+    def _decode(self, path):
+        data = np.fromfile(path, dtype=np.uint8)
+        flag = cv2.IMREAD_COLOR
+        if path.lower().endswith(('.jpg', '.jpeg')):
+            try:
+                with Image.open(path) as im:
+                    longest = max(im.size)  # 只解析文件头
+                flag = next((f for factor, f in self.REDUCED_FLAGS if longest // factor >= self.SIZE), flag)
+            except Exception:
+                pass
+        img = cv2.imdecode(data, flag)
+        if img is None:
+            return None
+        h, w = img.shape[:2]
+        scale = self.SIZE / max(h, w)
+        if scale < 1:
+            img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        return img
 
-    @staticmethod
-    def shift_mask(mask, dx, dy):
-        if dx == 0 and dy == 0:
-            return mask
-        h, w = mask.shape
-        M = np.float32([[1, 0, dx], [0, 1, dy]])
-        return cv2.warpAffine(mask, M, (w, h))
 
-    @staticmethod
-    def apply_morphology(mask, clean_k, connect_k, iters):
-        if clean_k > 0:
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN,
-                                    cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (clean_k, clean_k)))
-        if connect_k > 0 and iters > 0:
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE,
-                                    cv2.getStructuringElement(cv2.MORPH_RECT, (connect_k, connect_k)), iterations=iters)
-        return mask
+class ImageStateStore:
+    """
+    每个文件夹一个 SQLite 文件 ({文件夹}/.ipf_cache/state.sqlite)，按文件名保存图片的处理状态：
+    参数、压缩后的手动图层，以及最终蒙版 (按位压缩)。回到这张图片时直接恢复，无需重新计算。
+    记录附带原图的修改时间和大小，原图改动后旧状态自动作废。
+    写入在单独的线程中排队执行，切换图片不必等待压缩和写盘。
+    """
+    FILE_NAME = "state.sqlite"
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, FolderIndexer.CACHE_DIR, self.FILE_NAME)
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._db = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS image_state (
+                name TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, width INTEGER, height INTEGER,
+                params TEXT, draw BLOB, erase BLOB, mask BLOB)""")
+            self._db.commit()
+        except (OSError, sqlite3.Error) as e:
+            print(f"状态文件不可用 {self.path}: {e}")
+            self._db = None  # 只读文件夹等情况：照常使用，只是不保存
+
+    def load(self, name):
+        """返回 {"params", "draw", "erase", "mask"}；没有记录或原图已改动时返回 None。mask 可能为 None。"""
+        if self._db is None: return None
+        try:
+            stat = os.stat(os.path.join(self.folder, name))
+            with self._lock:
+                row = self._db.execute("SELECT mtime_ns, size, width, height, params, draw, erase, mask "
+                                       "FROM image_state WHERE name = ?", (name,)).fetchone()
+        except (OSError, sqlite3.Error) as e:
+            print(f"读取图片状态失败 {name}: {e}")
+            return None
+        if row is None or row[0] != stat.st_mtime_ns or row[1] != stat.st_size:
+            return None
+        shape = (row[3], row[2])
+        mask = None
+        if row[7] is not None:
+            bits = np.frombuffer(zlib.decompress(row[7]), dtype=np.uint8)
+            mask = np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape)
+            mask *= 255
+        return {"params": json.loads(row[4]), "draw": ManualLayer.from_bytes(shape, row[5]),
+                "erase": ManualLayer.from_bytes(shape, row[6]), "mask": mask}
+
+    def save(self, name, params, draw, erase, mask=None):
+        """draw/erase 为 LayerSnapshot；mask 为最终蒙版 (二值)，不是最新结果时传 None。调用后不能再修改 mask。"""
+        if self._db is not None:
+            self._writer.submit(self._save, name, params, draw, erase, mask)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _save(self, name, params, draw, erase, mask):
+        try:
+            stat = os.stat(os.path.join(self.folder, name))
+            mask_blob = None if mask is None else zlib.compress(np.packbits(mask > 0).tobytes(), 1)
+            row = (name, stat.st_mtime_ns, stat.st_size, draw.shape[1], draw.shape[0], json.dumps(params),
+                   draw.to_bytes(), erase.to_bytes(), mask_blob)
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO image_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                self._db.commit()
+        except (OSError, sqlite3.Error) as e:
+            print(f"保存图片状态失败 {name}: {e}")
 
 
 # ==========================================
 # 用户界面类 (UI)
 # ==========================================
+class ViewportRenderer:
+    """
+    只渲染画布可见区域的预览渲染器。
+    原图与蒙版各自维护一套 2 倍降采样金字塔，每帧选取分辨率不低于屏幕的最小一级，
+    只裁出可见区域并缩放到屏幕尺寸后合成，复用同一个 PhotoImage，
+    因此缩放/平移的开销只与画布大小有关，与原图大小无关。
+    """
+    TAG = "preview"
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.image_key = None
+        self.image_levels = []  # BGR 原图金字塔，按需构建
+        self.mask = None
+        self.mask_levels = []   # 蒙版金字塔，按需构建；高层级是覆盖率 (0~255)
+        self.contours = None
+        self.photo = None
+
+    def set_image(self, image, key):
+        if key != self.image_key:
+            self.image_key = key
+            self.image_levels = [image]
+
+    def set_mask(self, mask, dirty_rect=None):
+        """mask 换了新数组时重建金字塔；原数组被局部修改时只更新 dirty_rect 对应的区域。"""
+        if mask is not self.mask:
+            self.mask = mask
+            self.mask_levels = [mask]
+        elif dirty_rect is not None:
+            self._update_mask_levels(dirty_rect)
+        else:
+            return
+        self.contours = None
+
+    def _update_mask_levels(self, rect):
+        x0, y0, x1, y1 = rect
+        for i in range(1, len(self.mask_levels)):
+            prev, level = self.mask_levels[i - 1], self.mask_levels[i]
+            x0, y0 = x0 // 2, y0 // 2
+            x1, y1 = min(level.shape[1], (x1 + 1) // 2), min(level.shape[0], (y1 + 1) // 2)
+            if x0 >= x1 or y0 >= y1: break
+            # 区域按 2 像素对齐，INTER_AREA 精确等于 2x2 块平均，与整图降采样结果一致
+            level[y0:y1, x0:x1] = cv2.resize(prev[y0 * 2:y1 * 2, x0 * 2:x1 * 2], (x1 - x0, y1 - y0),
+                                             interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _sample(levels, view):
+        """从金字塔中取出可见区域，并缩放到屏幕尺寸。"""
+        new_w, new_h, ox, oy, vx0, vy0, vx1, vy1 = view
+        index = 0
+        while True:
+            h, w = levels[index].shape[:2]
+            if w // 2 < new_w or h // 2 < new_h or w < 2 or h < 2: break
+            if index + 1 == len(levels):
+                levels.append(cv2.resize(levels[index][:h // 2 * 2, :w // 2 * 2], (w // 2, h // 2),
+                                         interpolation=cv2.INTER_AREA))
+            index += 1
+        level = levels[index]
+        h, w = level.shape[:2]
+        kx, ky = new_w / w, new_h / h
+
+        # 与 cv2.resize 相同的像素中心映射：屏幕 = k * (层内坐标 + 0.5) - 0.5 + 偏移
+        lx0 = max(0, int((vx0 - ox + 0.5) / kx - 0.5) - 1)
+        ly0 = max(0, int((vy0 - oy + 0.5) / ky - 0.5) - 1)
+        lx1 = min(w, int((vx1 - ox + 0.5) / kx) + 2)
+        ly1 = min(h, int((vy1 - oy + 0.5) / ky) + 2)
+        M = np.float32([[kx, 0, kx * (lx0 + 0.5) - 0.5 + ox - vx0],
+                        [0, ky, ky * (ly0 + 0.5) - 0.5 + oy - vy0]])
+        return cv2.warpAffine(level[ly0:ly1, lx0:lx1], M, (vx1 - vx0, vy1 - vy0),
+                              flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def render(self, new_w, new_h, ox, oy, canvas_w, canvas_h, editing):
+        """
+        以 (ox, oy) 为左上角、new_w×new_h 的尺寸显示图片。
+        非编辑模式返回检测到的对象数量，编辑模式返回 None。
+        """
+        vx0, vy0 = max(0, ox), max(0, oy)
+        vx1, vy1 = min(canvas_w, ox + new_w), min(canvas_h, oy + new_h)
+        if vx0 >= vx1 or vy0 >= vy1:
+            self.canvas.delete(self.TAG)
+            self.photo = None
+            return None
+        view = (new_w, new_h, ox, oy, vx0, vy0, vx1, vy1)
+        img_rgb = cv2.cvtColor(self._sample(self.image_levels, view), cv2.COLOR_BGR2RGB)
+        mask = self._sample(self.mask_levels, view)
+
+        object_count = None
+        if editing:
+            zeros = np.zeros_like(mask)
+            vis = cv2.addWeighted(img_rgb, 0.4, cv2.merge([mask, zeros, zeros]), 0.6, 0)
+        else:
+            alpha = mask.astype(np.float32) / 255
+            bg = (img_rgb * 0.3).astype(np.uint8)
+            bg[:, :, 0] = np.clip(bg[:, :, 0] + 50, 0, 255)
+            vis = cv2.blendLinear(img_rgb, bg, alpha, 1 - alpha)
+
+            if self.contours is None:
+                with Profiler.span("findContours", self.mask):
+                    self.contours, _ = cv2.findContours(self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            mask_h, mask_w = self.mask.shape[:2]
+            to_screen = np.array([new_w / mask_w, new_h / mask_h])
+            shift = np.array([ox - vx0, oy - vy0])
+            cv2.drawContours(vis, [(c * to_screen + shift).astype(np.int32) for c in self.contours], -1, (0, 255, 0), 2)
+            object_count = len(self.contours)
+
+        with Profiler.span("PhotoImage", vis):
+            pil_img = Image.fromarray(vis)
+            if self.photo is not None and (self.photo.width(), self.photo.height()) == pil_img.size:
+                self.photo.paste(pil_img)
+            else:
+                self.photo = ImageTk.PhotoImage(pil_img)
+        if self.canvas.find_withtag(self.TAG):
+            self.canvas.itemconfig(self.TAG, image=self.photo)
+            self.canvas.coords(self.TAG, vx0, vy0)
+        else:
+            self.canvas.create_image(vx0, vy0, anchor=tk.NW, image=self.photo, tags=self.TAG)
+            self.canvas.tag_lower(self.TAG)
+        return object_count
+
+
+class Filmstrip:
+    """
+    横向缩略图条。只为可见的格子创建画布元素，滚动位置自己维护 (不设置 scrollregion)，
+    十万张图片与一百张一样流畅。缩略图由 ThumbnailCache 在后台生成，PhotoImage 只保留最近用过的一批。
+    """
+    CELL = ThumbnailCache.SIZE + 8
+    PREFETCH = 8         # 可见范围两侧各多请求几张，滚动时缩略图已就绪
+    MAX_PHOTOS = 600
+
+    def __init__(self, parent, on_select):
+        self.on_select = on_select
+        self.files = []
+        self.current = -1
+        self.offset = 0.0      # 第一个格子左边缘之前滚过的像素
+        self.cache = None
+        self.photos = {}       # 文件名 -> PhotoImage (按使用顺序，超出上限时淘汰最早的)
+        self.failed = set()
+        self.render_job = None
+
+        frame = ttk.Frame(parent)
+        frame.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
+        self.canvas = tk.Canvas(frame, height=self.CELL + 14, bg="#1e1e1e", highlightthickness=0)
+        self.canvas.pack(fill=tk.X)
+        self.scrollbar = ttk.Scrollbar(frame, orient=tk.HORIZONTAL, command=self.xview)
+        self.scrollbar.pack(fill=tk.X)
+
+        self.canvas.bind("<Configure>", lambda e: self.schedule_render())
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll(-e.delta / 120 * self.CELL))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll(-self.CELL))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll(self.CELL))
+        self.canvas.bind("<Button-1>", self._on_click)
+
+    def set_folder(self, cache):
+        if self.cache: self.cache.close()
+        self.cache = cache
+        self.files, self.current, self.offset = [], -1, 0.0
+        self.photos, self.failed = {}, set()
+        self.schedule_render()
+
+    def set_files(self, files, current):
+        self.files, self.current = files, current
+        self._clamp()
+        self.schedule_render()
+
+    def set_current(self, index):
+        """高亮当前图片，不在可见范围内时滚动到居中。"""
+        self.current = index
+        width = self.canvas.winfo_width()
+        x = index * self.CELL - self.offset
+        if x < 0 or x + self.CELL > width:
+            self.offset = index * self.CELL - (width - self.CELL) / 2
+            self._clamp()
+        self.schedule_render()
+
+    def scroll(self, dx):
+        self.offset += dx
+        self._clamp()
+        self.schedule_render()
+
+    def xview(self, *args):
+        """滚动条回调：moveto 比例 / scroll n units|pages。"""
+        total = len(self.files) * self.CELL
+        width = self.canvas.winfo_width()
+        if args[0] == "moveto":
+            self.offset = float(args[1]) * total
+        elif args[0] == "scroll":
+            step = width if args[2] == "pages" else self.CELL
+            self.offset += int(args[1]) * step
+        self._clamp()
+        self.schedule_render()
+
+    def on_thumbs_ready(self, event=None):
+        if not self.cache: return
+        changed = False
+        while True:
+            try:
+                name, thumb = self.cache.ready.get_nowait()
+            except queue.Empty:
+                break
+            if thumb is None:
+                self.failed.add(name)
+            else:
+                self.photos[name] = ImageTk.PhotoImage(Image.fromarray(thumb))
+            changed = True
+        while len(self.photos) > self.MAX_PHOTOS:
+            del self.photos[next(iter(self.photos))]
+        if changed:
+            self.schedule_render()
+
+    def schedule_render(self):
+        # 同一轮事件里的多次滚动/缩略图到达只重绘一次
+        if self.render_job is None:
+            self.render_job = self.canvas.after_idle(self.render)
+
+    def render(self):
+        self.render_job = None
+        self.canvas.delete("all")
+        width = self.canvas.winfo_width()
+        total = len(self.files) * self.CELL
+        if total:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + width) / total))
+        else:
+            self.scrollbar.set(0, 1)
+        if not self.files or width < 10: return
+
+        first = int(self.offset // self.CELL)
+        last = min(len(self.files), int((self.offset + width) // self.CELL) + 1)
+        size = ThumbnailCache.SIZE
+        for i in range(first, last):
+            name = self.files[i]
+            x = i * self.CELL - self.offset + 4
+            if i == self.current:
+                self.canvas.create_rectangle(x - 3, 1, x + size + 3, size + 7, outline="#4fc3f7", width=2)
+            photo = self.photos.pop(name, None)
+            if photo is not None:
+                self.photos[name] = photo  # 移到末尾，表示最近用过
+                self.canvas.create_image(x + size // 2, 4 + size // 2, image=photo)
+            else:
+                self.canvas.create_rectangle(x, 4, x + size, 4 + size, outline="#444444",
+                                             fill="#3a1f1f" if name in self.failed else "#2b2b2b")
+            self.canvas.create_text(x + size // 2, size + 12, text=str(i + 1), fill="#aaaaaa", font=("Arial", 8))
+
+        if self.cache:
+            lo, hi = max(0, first - self.PREFETCH), min(len(self.files), last + self.PREFETCH)
+            self.cache.request([name for name in self.files[lo:hi] if name not in self.photos and name not in self.failed])
+
+    def _clamp(self):
+        max_offset = max(0.0, len(self.files) * self.CELL - self.canvas.winfo_width())
+        self.offset = min(max(self.offset, 0.0), max_offset)
+
+    def _on_click(self, event):
+        index = int((event.x + self.offset) // self.CELL)
+        if 0 <= index < len(self.files):
+            self.on_select(index)
+
+
 class ImageCutterApp:
     def __init__(self, root):
         self.root = root
@@ -210,20 +1414,36 @@ class ImageCutterApp:
         self.input_path = ""
         self.output_path = ""
         self.files = []
+        self.file_keys = []     # 与 files 一一对应的自然排序键
+        self.indexer = None
+        self.index_queue = queue.Queue()
         self.current_index = 0
         self.raw_image = None
         self.current_image = None
+        self.decoded_image = None
+        self.image_buffer = ImageRingBuffer()
         self.current_filename = ""
         self.processed_mask = None
-        self.display_image = None
+        self.mask_result_id = None
+        self.mask_token = None      # 当前蒙版对应的请求；与 request_token 相同时说明蒙版是最新的
+        self.stale_result = None    # 已被取代、未显示的完整结果，仅作为后续补丁的底图
+        self.state_store = None     # 当前文件夹的 ImageStateStore
 
         self.is_auto_detecting = False
         self.is_processing = False
         self.debounce_job = None
+        self.full_res_job = None
+        self.profiler_job = None
+        self.mask_is_proxy = False
+        self.pending_save = False
         self.is_picking_color = False
 
         self.manual_draw_layer = None
         self.manual_erase_layer = None
+        self.image_version = 0
+        self.undo_memory_mb = 64
+        self.engine_daemon = DEFAULT_URL  # 本地处理服务地址，为空时不使用
+        self.edit_history = EditHistory(self.undo_memory_mb * 1024 * 1024)
 
         self.is_editing_mask = False
         self.drawing = False
@@ -237,27 +1457,56 @@ class ImageCutterApp:
         self.pan_offset_y = 0
 
         self.processing_request_queue = queue.Queue(maxsize=1)
+        self.request_token = None
         self.processing_result_queue = queue.Queue()
 
+        # 切片在后台写盘，保存后立即切换到下一张
+        self.crop_writer = CropWriter(lambda batch: self._notify_ui("<<CropProgress>>"))
+        self.save_batches = []
+        self.pending_atlas_sprites = []  # 整批图集模式下暂存的 cut_sprites 结果
+        self.pending_atlas_count = 0
+        self.batch_runner = None    # 批量应用到文件夹，同一时间只运行一批
+        self.batch_window = None
+
         self.setup_ui()
+        self.renderer = ViewportRenderer(self.canvas)
 
         threading.Thread(target=self._processing_worker, daemon=True).start()
-        self.root.after(100, self._check_result_queue)
+        self.root.bind("<<ResultReady>>", self._on_result_ready)
+        self.root.bind("<<CropProgress>>", self._on_crop_progress)
+        self.root.bind("<<BatchProgress>>", self._on_batch_progress)
+        self.root.bind("<<IndexBatch>>", self._on_index_batch)
+        self.root.bind("<<ThumbReady>>", self.filmstrip.on_thumbs_ready)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.root.after(150, self.init_directories)
 
     def init_directories(self):
-        if self.load_settings():
+        loaded = self.load_settings()
+        threading.Thread(target=self._connect_engine_daemon, daemon=True).start()
+        if loaded:
             self.refresh_file_list()
             print(f"已自动加载配置：输入={self.input_path}, 输出={self.output_path}")
         else:
             self.ask_directories()
 
+    def _connect_engine_daemon(self):
+        """在后台探测本地处理服务，不阻塞启动；连不上时照常在本进程中推理。"""
+        if not self.engine_daemon: return
+        client = EngineClient(self.engine_daemon, config_file=self.config_file)
+        health = client.health()
+        if health is not None:
+            MaskPipeline.remote = client
+            print(f"已连接处理服务 {self.engine_daemon}，已加载的模型: {health['sessions']}")
+
     def load_settings(self):
         if not os.path.exists(self.config_file):
             return False
         try:
             with open(self.config_file, 'r', encoding='utf-8') as f:
                 config = json.load(f)
+                self.undo_memory_mb = config.get("undo_memory_mb", self.undo_memory_mb)
+                self.edit_history.max_bytes = self.undo_memory_mb * 1024 * 1024
+                self.engine_daemon = config.get("engine_daemon", self.engine_daemon)
                 input_path = config.get("input_path", "")
                 output_path = config.get("output_path", "")
                 if input_path and os.path.exists(input_path) and output_path and os.path.exists(output_path):
@@ -269,7 +1518,15 @@ class ImageCutterApp:
         return False
 
     def save_settings(self):
-        config = {"input_path": self.input_path, "output_path": self.output_path}
+        config = {}
+        try:
+            # 保留处理服务写入的 engine_token 等其他配置项
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            pass
+        config.update(input_path=self.input_path, output_path=self.output_path, undo_memory_mb=self.undo_memory_mb,
+                      engine_daemon=self.engine_daemon)
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=4)
@@ -300,14 +1557,50 @@ class ImageCutterApp:
         self.refresh_file_list()
 
     def refresh_file_list(self):
+        """在后台扫描输入文件夹，文件名分批送达 (见 _on_index_batch)。"""
         if not self.input_path: return
-        valid_exts = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
-        self.files = [f for f in os.listdir(self.input_path) if f.lower().endswith(valid_exts)]
-        if not self.files:
+        if self.indexer: self.indexer.cancel()
+        self._save_image_state()
+        if self.state_store: self.state_store.close()
+        self.state_store = ImageStateStore(self.input_path)
+        self.files, self.file_keys = [], []
+        self.current_index, self.current_filename = 0, ""
+        self.status_label.config(text="正在扫描文件夹...")
+        self.filmstrip.set_folder(ThumbnailCache(self.input_path, lambda: self._notify_ui("<<ThumbReady>>")))
+        self.indexer = FolderIndexer(self.input_path, self._on_indexer_batch)
+        self.indexer.start()
+
+    def _on_indexer_batch(self, indexer, names, done):
+        # 扫描线程中调用
+        self.index_queue.put((indexer, names, done))
+        self._notify_ui("<<IndexBatch>>")
+
+    def _on_index_batch(self, event=None):
+        """把新到的一批文件名按自然顺序并入列表；第一批到达时就开始显示。"""
+        added, finished = [], False
+        while True:
+            try:
+                indexer, names, done = self.index_queue.get_nowait()
+            except queue.Empty:
+                break
+            if indexer is not self.indexer: continue  # 已切换文件夹
+            added.extend(names)
+            finished = finished or done
+        if added:
+            # 两段各自有序，Timsort 合并近似线性
+            entries = list(zip(self.file_keys, self.files))
+            entries.extend((FolderIndexer.natural_key(name), name) for name in added)
+            entries.sort(key=lambda e: e[0])
+            self.file_keys = [key for key, _ in entries]
+            self.files = [name for _, name in entries]
+            self.filmstrip.set_files(self.files, self.files.index(self.current_filename) if self.current_filename else -1)
+            if self.current_filename:
+                self.current_index = self.files.index(self.current_filename)
+                self.root.title(f"AI图片处理工厂 - {self.current_filename} ({self.current_index + 1}/{len(self.files)})")
+            else:
+                self.load_image(0, force_auto_detect=True)
+        if finished and not self.files:
             messagebox.showwarning("警告", f"在文件夹:\n{self.input_path}\n中没有找到图片文件！")
-            return
-        self.current_index = 0
-        self.load_image(0, force_auto_detect=True)
 
     def change_input_directory(self):
         directory = filedialog.askdirectory(title="更改输入图片文件夹")
@@ -332,6 +1625,8 @@ class ImageCutterApp:
         ttk.Label(top_bar, text=" | ").pack(side=tk.LEFT)
         self.status_label = ttk.Label(top_bar, text="准备就绪", foreground="gray")
         self.status_label.pack(side=tk.LEFT, padx=5)
+        self.save_status_label = ttk.Label(top_bar, text="", foreground="gray")
+        self.save_status_label.pack(side=tk.RIGHT, padx=5)
 
         main_paned = ttk.PanedWindow(self.root, orient=tk.HORIZONTAL)
         main_paned.pack(fill=tk.BOTH, expand=True)
@@ -448,10 +1743,26 @@ class ImageCutterApp:
 
         self.morph_frame = ttk.LabelFrame(self.main_controls_frame, text="形态学处理 (连接主体)", padding="5")
         self.morph_frame.pack(fill=tk.X, pady=10)
-        self.add_slider(self.morph_frame, "clean_kernel", "去噪核大小 (Open)", 0, 10, 3)
-        self.add_slider(self.morph_frame, "connect_kernel", "连接核大小 (Close)", 0, 20, 5)
+        self.add_slider(self.morph_frame, "clean_kernel", "去噪核大小 (Open)", 0, 100, 3)
+        self.add_slider(self.morph_frame, "connect_kernel", "连接核大小 (Close)", 0, 60, 5)
         self.add_slider(self.morph_frame, "connect_iters", "连接迭代次数", 0, 10, 2)
 
+        self.crop_frame = ttk.LabelFrame(self.main_controls_frame, text="切片提取", padding="5")
+        self.crop_frame.pack(fill=tk.X, pady=10)
+        self.add_slider(self.crop_frame, "crop_min_area", "最小面积 (像素)", 0, 5000, 0)
+        self.add_slider(self.crop_frame, "crop_merge_dist", "碎片合并距离", 0, 100, 0)
+        self.add_slider(self.crop_frame, "png_compression", "PNG 压缩等级 (越高越小越慢)", 0, 9, 1)
+        ttk.Label(self.crop_frame, text="输出方式:").pack(anchor=tk.W, pady=(5, 0))
+        self.output_mode_var = tk.StringVar(value="files")
+        ttk.Radiobutton(self.crop_frame, text="每个切片一个文件", variable=self.output_mode_var, value="files").pack(anchor=tk.W)
+        ttk.Radiobutton(self.crop_frame, text="每张图片打包一个图集", variable=self.output_mode_var, value="atlas_image").pack(anchor=tk.W)
+        ttk.Radiobutton(self.crop_frame, text="整批打包图集 (暂存到手动导出)", variable=self.output_mode_var, value="atlas_batch").pack(anchor=tk.W)
+        ttk.Radiobutton(self.crop_frame, text="不输出图片 (仅矢量蒙版)", variable=self.output_mode_var, value="vector").pack(anchor=tk.W)
+        self.export_vector_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.crop_frame, text="同时导出矢量蒙版 (RLE/多边形 → masks.jsonl)", variable=self.export_vector_var).pack(anchor=tk.W, pady=(5, 0))
+        ttk.Button(self.crop_frame, text="导出整批图集", command=self.export_batch_atlas).pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(self.crop_frame, text="📁 批量应用到文件夹...", command=self.open_batch_dialog).pack(fill=tk.X, pady=(5, 0))
+
         action_frame = ttk.Frame(self.main_controls_frame)
         action_frame.pack(fill=tk.X, pady=10)
         
@@ -470,6 +1781,12 @@ class ImageCutterApp:
         self.info_label = ttk.Label(self.main_controls_frame, text="", foreground="blue", wraplength=280)
         self.info_label.pack(pady=5)
 
+        profiler_frame = ttk.LabelFrame(self.main_controls_frame, text="性能分析", padding="5")
+        profiler_frame.pack(fill=tk.X, pady=10)
+        self.profiler_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(profiler_frame, text="记录耗时并显示叠加层 (F3)", variable=self.profiler_var, command=self.toggle_profiler).pack(anchor=tk.W)
+        ttk.Button(profiler_frame, text="导出 Chrome Trace", command=self.export_trace).pack(fill=tk.X, pady=(5, 0))
+
         self.edit_controls_frame = ttk.Frame(self.control_frame, padding="10")
         ttk.Label(self.edit_controls_frame, text="蒙版编辑模式", font=("Arial", 14, "bold")).pack(pady=10)
         edit_mode_frame = ttk.Frame(self.edit_controls_frame)
@@ -480,10 +1797,15 @@ class ImageCutterApp:
         ttk.Label(self.edit_controls_frame, text="笔刷大小:").pack(anchor=tk.W, pady=(10, 0))
         self.size_slider = ttk.Scale(self.edit_controls_frame, from_=1, to=100, value=self.brush_size, orient=tk.HORIZONTAL, command=self._update_brush_size)
         self.size_slider.pack(fill=tk.X)
+        history_frame = ttk.Frame(self.edit_controls_frame)
+        history_frame.pack(fill=tk.X, pady=(10, 0))
+        ttk.Button(history_frame, text="↶ 撤销 (Ctrl+Z)", command=self.undo_edit).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        ttk.Button(history_frame, text="↷ 重做 (Ctrl+Y)", command=self.redo_edit).pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(5, 0))
         ttk.Button(self.edit_controls_frame, text="✅ 完成编辑 (M)", command=self.toggle_mask_editing, style="Accent.TButton").pack(fill=tk.X, pady=20)
 
         preview_frame = ttk.Frame(main_paned, padding="10")
         main_paned.add(preview_frame, weight=1)
+        self.filmstrip = Filmstrip(preview_frame, self.load_image)
         self.canvas = tk.Canvas(preview_frame, bg="#2b2b2b")
         self.canvas.pack(fill=tk.BOTH, expand=True)
 
@@ -494,6 +1816,10 @@ class ImageCutterApp:
         self.root.bind("<n>", lambda e: self.next_image())
         self.root.bind("<b>", lambda e: self.edit_mode_var.set("draw") or self._set_edit_mode())
         self.root.bind("<e>", lambda e: self.edit_mode_var.set("erase") or self._set_edit_mode())
+        self.root.bind("<F3>", lambda e: self.profiler_var.set(not self.profiler_var.get()) or self.toggle_profiler())
+        self.root.bind("<Control-z>", self.undo_edit)
+        self.root.bind("<Control-y>", self.redo_edit)
+        self.root.bind("<Control-Shift-Z>", self.redo_edit)
         self.root.bind("[", self.decrease_brush)
         self.root.bind("]", self.increase_brush)
         self.canvas.bind("<B1-Motion>", self.paint)
@@ -511,115 +1837,221 @@ class ImageCutterApp:
 
     # --- 异步与防抖 ---
     def _processing_worker(self):
-        rembg_cache = {}
+        pipeline = MaskPipeline()
+        proxy_pipeline = MaskPipeline()  # 代理预览单独缓存，避免与全分辨率结果互相挤占
+        result_ids = itertools.count(1)
+        last_result_id = None
         while True:
             try:
-                params, raw_image, manual_draw, manual_erase, image_id = self.processing_request_queue.get()
-                
-                mode = params['mode']
-                base_mask = None
-                match_ratio = 0
-                
-                if mode == 'rembg':
-                    cache_key = (image_id, params.get("rembg_model"), params.get("rembg_alpha_matting"), params.get("rembg_fg_thresh"), params.get("rembg_bg_thresh"), params.get("rembg_erode"))
-                    if cache_key in rembg_cache:
-                        base_mask = rembg_cache[cache_key].copy()
-                    else:
-                        if len(raw_image.shape) == 2: bgr_image = cv2.cvtColor(raw_image, cv2.COLOR_GRAY2BGR)
-                        elif raw_image.shape[2] == 4: bgr_image = cv2.cvtColor(raw_image, cv2.COLOR_BGRA2BGR)
-                        else: bgr_image = raw_image
-                        base_mask = ImageProcessor.get_mask_rembg(bgr_image, model_name=params.get("rembg_model", "u2net"), alpha_matting=params.get("rembg_alpha_matting", False), am_fg_thresh=params.get("rembg_fg_thresh", 240), am_bg_thresh=params.get("rembg_bg_thresh", 10), am_erode=params.get("rembg_erode", 10))
-                        if len(rembg_cache) > 5: rembg_cache.clear()
-                        rembg_cache[cache_key] = base_mask.copy()
-                elif mode == 'color':
-                    base_mask, match_ratio = ImageProcessor.get_mask_rgba_range(
-                        raw_image, 
-                        params["color_r_min"], params["color_r_max"], 
-                        params["color_g_min"], params["color_g_max"], 
-                        params["color_b_min"], params["color_b_max"], 
-                        params["color_a_min"], params["color_a_max"],
-                        invert=params.get("color_invert", True)
-                    )
+                request = self.processing_request_queue.get()
+                if request.token.cancelled:
+                    continue
+                if request.scale != 1:
+                    final_mask, match_ratio = proxy_pipeline.run(request)
+                    self.processing_result_queue.put(ProcessingResult(
+                        request.image_version, final_mask.copy(), match_ratio, proxy_pipeline.format_stats(),
+                        scale=request.scale, token=request.token))
+                    self._notify_ui("<<ResultReady>>")
+                    continue
+
+                final_mask, match_ratio = pipeline.run(request)
+                rect = pipeline.dirty_rect
+                if rect is not None and last_result_id is not None and not request.force_full:
+                    x0, y0, x1, y1 = rect
+                    result = ProcessingResult(request.image_version, final_mask[y0:y1, x0:x1].copy(), match_ratio,
+                                              pipeline.format_stats(), rect=rect, base_id=last_result_id, token=request.token)
                 else:
-                    if len(raw_image.shape) == 2: bgr_image = cv2.cvtColor(raw_image, cv2.COLOR_GRAY2BGR)
-                    elif raw_image.shape[2] == 4: bgr_image = cv2.cvtColor(raw_image, cv2.COLOR_BGRA2BGR)
-                    else: bgr_image = raw_image
-                    if mode == 'gray':
-                        base_mask = ImageProcessor.get_mask_gray(bgr_image, params["gray_thresh"], params["bg_type"])
-                    elif mode == 'yellow':
-                        base_mask = ImageProcessor.get_mask_yellow(bgr_image, params["yellow_h_center"], params["yellow_h_tol"], params["yellow_s_min"], params["yellow_v_min"])
-
-                if base_mask is None:
-                    h, w = raw_image.shape[:2]
-                    base_mask = np.zeros((h, w), dtype=np.uint8)
-
-                final_mask = self._apply_post_processing(base_mask, params, manual_draw, manual_erase)
-                self.processing_result_queue.put((final_mask, match_ratio))
-
+                    # 流水线之后会原地更新自己的缓存，交给 UI 的必须是独立副本
+                    last_result_id = next(result_ids)
+                    result = ProcessingResult(request.image_version, final_mask.copy(), match_ratio,
+                                              pipeline.format_stats(), result_id=last_result_id, token=request.token)
+                self.processing_result_queue.put(result)
+                self._notify_ui("<<ResultReady>>")
+
+            except PipelineCancelled:
+                # 已有更新的请求在排队；已完成的阶段留在缓存里，新请求可以直接复用
+                continue
             except Exception as e:
                 print(f"后台处理错误: {e}")
 
-    def _apply_post_processing(self, mask, params, manual_draw_layer, manual_erase_layer):
-        if params['mode'] == "rembg":
-            sx, sy = params.get("rembg_shift_x", 0), params.get("rembg_shift_y", 0)
-            if sx != 0 or sy != 0:
-                mask = ImageProcessor.shift_mask(mask, sx, sy)
-        
-        mask = ImageProcessor.apply_morphology(mask, params["clean_kernel"], params["connect_kernel"], params["connect_iters"])
-        
-        if manual_draw_layer is not None:
-            mask = cv2.bitwise_or(mask, manual_draw_layer)
-        if manual_erase_layer is not None:
-            mask = cv2.bitwise_and(mask, cv2.bitwise_not(manual_erase_layer))
-            
-        return mask
-
-    def _check_result_queue(self):
+    def _notify_ui(self, sequence):
+        """从后台线程唤醒 Tk 主循环，由绑定的虚拟事件在主线程中处理。"""
         try:
-            result_mask, match_ratio = self.processing_result_queue.get_nowait()
-            self.processed_mask = result_mask
+            self.root.event_generate(sequence, when="tail")
+        except (RuntimeError, tk.TclError) as e:
+            print(f"通知界面失败: {e}")
+
+    def _on_result_ready(self, event=None):
+        results = []
+        while True:
+            try:
+                results.append(self.processing_result_queue.get_nowait())
+            except queue.Empty:
+                break
+        if not results: return
+        if any(r.token is self.request_token for r in results):
             self.is_processing = False
-            
-            # 更新状态栏信息
-            status_text = f"当前文件: {self.current_filename}"
-            if self.mode_var.get() == "color":
-                status_text += f" | 颜色匹配率: {match_ratio:.1%}"
-            self.status_label.config(text=status_text)
-            
+
+        # 已切换到其他图片的结果直接丢弃；只保留最新的完整蒙版及其之后的补丁
+        results = [r for r in results if r.image_version == self.image_version]
+        if not results: return
+        full_indices = [i for i, r in enumerate(results) if r.rect is None]
+        if full_indices:
+            results = results[full_indices[-1]:]
+
+        full_refresh, dirty_rect = False, None
+        for result in results:
+            if result.rect is None:
+                if result.token is not self.request_token:
+                    # 取消检查之前就已算完的旧请求仍会送达结果：不当作当前蒙版显示，
+                    # 只留作底图，以便后台基于它发来的补丁还能接上
+                    self.stale_result = result
+                    continue
+                self._set_full_mask(result)
+                full_refresh = True
+            elif result.base_id == self.mask_result_id or (
+                    self.stale_result is not None and result.base_id == self.stale_result.result_id):
+                if result.base_id != self.mask_result_id:
+                    self._set_full_mask(self.stale_result)
+                    full_refresh = True
+                x0, y0, x1, y1 = result.rect
+                self.processed_mask[y0:y1, x0:x1] = result.mask
+                self.mask_token = result.token
+                dirty_rect = union_rects(r for r in (dirty_rect, result.rect) if r is not None)
+            else:
+                # 补丁对应的底图不是当前显示的蒙版，重新请求完整结果
+                self.update_preview(force_full=True)
+                break
+
+        if full_refresh:
             self.update_display()
-        except queue.Empty:
-            pass
-        finally:
-            self.root.after(100, self._check_result_queue)
+        elif dirty_rect is not None:
+            self.update_display(dirty_rect=dirty_rect)
+
+        # 更新状态栏信息
+        latest = results[-1]
+        status_text = f"当前文件: {self.current_filename}"
+        if self.mode_var.get() == "color":
+            status_text += f" | 颜色匹配率: {latest.match_ratio:.1%}"
+        status_text += f" | {latest.stage_stats} | 送达{(time.perf_counter() - latest.done_time) * 1000:.1f}ms"
+        self.status_label.config(text=status_text)
+
+        # 只有最新请求的全分辨率结果才能用于保存
+        if (self.pending_save and not self.mask_is_proxy and self.mask_token is self.request_token
+                and not (self.request_token and self.request_token.cancelled)):
+            self.pending_save = False
+            self.save_crops()
+
+    def _set_full_mask(self, result):
+        self.processed_mask = result.mask
+        self.mask_result_id = result.result_id
+        self.mask_is_proxy = result.scale != 1
+        self.mask_token = result.token
+        self.stale_result = None
 
     def schedule_update(self):
+        """参数变化：先用代理图快速预览，输入停止一段时间后再计算全分辨率结果。"""
         if self.debounce_job:
             self.root.after_cancel(self.debounce_job)
-        self.debounce_job = self.root.after(250, self.update_preview)
+        self.debounce_job = self.root.after(250, self._run_proxy_preview)
+        self._schedule_full_res()
+
+    def _run_proxy_preview(self):
+        self.debounce_job = None
+        self.update_preview(proxy=True)
+
+    def _schedule_full_res(self):
+        if self.full_res_job:
+            self.root.after_cancel(self.full_res_job)
+        self.full_res_job = self.root.after(800, self._run_full_res)
+
+    def _run_full_res(self):
+        self.full_res_job = None
+        self.update_preview()
+
+    def _proxy_scale(self):
+        """代理图与当前画布显示比例一致；接近原图大小时代理没有意义，返回 1。"""
+        geometry = self._display_geometry()
+        if geometry is None or geometry[0] >= 0.75:
+            return 1.0
+        return geometry[0]
 
-    def update_preview(self):
+    def update_preview(self, force_full=False, proxy=False):
         if self.current_image is None: return
+        if proxy and self.pending_save: return  # 等待保存用的全分辨率结果，不能被代理预览取消
+        scale = self._proxy_scale() if proxy else 1.0
         
-        params = {'mode': self.mode_var.get(), 'bg_type': self.bg_type_var.get()}
-        params['rembg_model'] = self.rembg_model_var.get()
-        params['rembg_alpha_matting'] = self.rembg_alpha_matting_var.get()
-        params['color_invert'] = self.color_invert_var.get()
-        for name, var in self.sliders.items():
-            params[name] = var.get()
+        params = self._collect_params()
 
+        # 最新请求优先：取消正在执行的旧请求，并丢弃还在排队的请求
+        if self.request_token is not None:
+            self.request_token.cancel()
+        self.request_token = CancelToken()
         if not self.processing_request_queue.empty():
             try:
                 self.processing_request_queue.get_nowait()
             except queue.Empty:
                 pass
         
-        request_data = (params, self.raw_image.copy(), self.manual_draw_layer.copy(), self.manual_erase_layer.copy(), self.current_filename)
-        self.processing_request_queue.put(request_data)
+        request = ProcessingRequest(params, self.raw_image, os.path.join(self.input_path, self.current_filename),
+                                    self.image_version, self.manual_draw_layer.snapshot(), self.manual_erase_layer.snapshot(),
+                                    force_full=force_full, scale=scale, token=self.request_token, decoded=self.decoded_image)
+        self.processing_request_queue.put(request)
 
         if not self.is_processing:
             self.is_processing = True
             self.status_label.config(text="处理中...")
 
+    def _collect_params(self):
+        params = {'mode': self.mode_var.get(), 'bg_type': self.bg_type_var.get()}
+        params['rembg_model'] = self.rembg_model_var.get()
+        params['rembg_alpha_matting'] = self.rembg_alpha_matting_var.get()
+        params['color_invert'] = self.color_invert_var.get()
+        for name, var in self.sliders.items():
+            params[name] = var.get()
+        return params
+
+    def _apply_params(self, params):
+        """恢复保存的参数，不触发重新计算。"""
+        self.is_auto_detecting = True  # 程序设置参数，不算用户修改
+        self.mode_var.set(params.get('mode', self.mode_var.get()))
+        self.bg_type_var.set(params.get('bg_type', self.bg_type_var.get()))
+        self.rembg_model_var.set(params.get('rembg_model', self.rembg_model_var.get()))
+        self.rembg_alpha_matting_var.set(params.get('rembg_alpha_matting', self.rembg_alpha_matting_var.get()))
+        self.color_invert_var.set(params.get('color_invert', self.color_invert_var.get()))
+        for name, var in self.sliders.items():
+            if name in params: var.set(params[name])
+        self.on_mode_change(update=False)
+        self.is_auto_detecting = False
+
+    # --- 图片状态 (参数、手动图层、蒙版) 持久化 ---
+    def _save_image_state(self):
+        if self.state_store is None or not self.current_filename or self.manual_draw_layer is None: return
+        # 只有对应最新参数和图层的全分辨率蒙版才值得保存，否则下次打开时重新计算
+        mask = self.processed_mask
+        if (mask is None or self.mask_is_proxy or self.full_res_job or self.mask_token is not self.request_token
+                or mask.shape != self.manual_draw_layer.shape):
+            mask = None
+        self.state_store.save(self.current_filename, self._collect_params(),
+                              self.manual_draw_layer.snapshot(), self.manual_erase_layer.snapshot(), mask)
+
+    def _restore_image_state(self, state):
+        """恢复保存的参数和手动图层；有保存的蒙版时直接显示，返回 True。"""
+        self.manual_draw_layer, self.manual_erase_layer = state["draw"], state["erase"]
+        self.edit_history.clear()
+        self._apply_params(state["params"])
+        if state["mask"] is None:
+            return False
+        if self.request_token is not None:
+            self.request_token.cancel()  # 上一张图片的计算不再需要
+        self.request_token = self.mask_token = None
+        self.processed_mask = state["mask"]
+        self.mask_result_id = None
+        self.mask_is_proxy = False
+        self.update_display()
+        self.status_label.config(text=f"当前文件: {self.current_filename} | 已恢复上次的处理结果")
+        return True
+
     # --- 逻辑方法 ---
     def toggle_mask_editing(self):
         self.is_editing_mask = not self.is_editing_mask
@@ -628,6 +2060,8 @@ class ImageCutterApp:
             self.edit_controls_frame.pack(fill=tk.X)
             self.edit_mask_button.config(text="完成编辑 (M)")
             self.canvas.config(cursor="none")
+            if self.mask_is_proxy:
+                self.update_preview()  # 编辑需要全分辨率蒙版
         else:
             self.edit_controls_frame.pack_forget()
             self.main_controls_frame.pack(fill=tk.X)
@@ -658,12 +2092,28 @@ class ImageCutterApp:
             self.pick_color(event)
             return
         if not self.is_editing_mask: return
+        if self.manual_draw_layer is None or self.manual_erase_layer is None: return
         self.drawing = True
+        self.manual_draw_layer.begin_stroke()
+        self.manual_erase_layer.begin_stroke()
         self.paint(event)
 
     def stop_paint(self, event):
-        if not self.is_editing_mask: return
+        if not self.drawing: return
         self.drawing = False
+        self.edit_history.push([(layer,) + layer.end_stroke() for layer in (self.manual_draw_layer, self.manual_erase_layer)])
+
+    def undo_edit(self, event=None):
+        if self.drawing: return
+        if self.edit_history.undo():
+            self.update_preview()
+            self.status_label.config(text="已撤销一步蒙版编辑")
+
+    def redo_edit(self, event=None):
+        if self.drawing: return
+        if self.edit_history.redo():
+            self.update_preview()
+            self.status_label.config(text="已重做一步蒙版编辑")
 
     def paint(self, event):
         if not self.drawing or not self.is_editing_mask: return
@@ -682,8 +2132,8 @@ class ImageCutterApp:
 
         layer_to_draw = self.manual_draw_layer if self.edit_mode == "draw" else self.manual_erase_layer
         layer_to_clear = self.manual_erase_layer if self.edit_mode == "draw" else self.manual_draw_layer
-        cv2.circle(layer_to_draw, (x, y), real_brush_radius, 255, -1)
-        cv2.circle(layer_to_clear, (x, y), real_brush_radius, 0, -1)
+        layer_to_draw.draw_circle((x, y), real_brush_radius, 255)
+        layer_to_clear.draw_circle((x, y), real_brush_radius, 0)
 
         self.update_preview() # For painting, we want immediate feedback
         self.update_brush_cursor(event)
@@ -714,7 +2164,7 @@ class ImageCutterApp:
         self.update_display()
         if self.is_editing_mask: self.update_brush_cursor(self.last_mouse_pos)
 
-    def on_mode_change(self):
+    def on_mode_change(self, update=True):
         if not self.is_auto_detecting: self.auto_apply_var.set(False)
         mode = self.mode_var.get()
         self.color_frame.pack_forget()
@@ -727,7 +2177,7 @@ class ImageCutterApp:
         elif mode == "yellow": self.yellow_frame.pack(fill=tk.X, expand=True)
         elif mode == "rembg": self.rembg_frame.pack(fill=tk.X, expand=True)
         
-        self.schedule_update()
+        if update: self.schedule_update()
 
     def add_slider(self, parent, name, label, min_val, max_val, default):
         frame = ttk.Frame(parent)
@@ -765,45 +2215,49 @@ class ImageCutterApp:
     def load_image(self, index, force_auto_detect=False):
         if not self.files: return
         if self.is_editing_mask: self.toggle_mask_editing()
+        self._save_image_state()
 
+        self.pending_save = False
         self.current_index = max(0, min(index, len(self.files) - 1))
         self.current_filename = self.files[self.current_index]
-        file_path = os.path.join(self.input_path, self.current_filename)
-        img = ImageProcessor.cv_imread(file_path)
-        if img is None:
+        self.image_buffer.focus(self.input_path, self.files, self.current_index)
+        decoded = self.image_buffer.get(self.input_path, self.current_filename)
+        if decoded is None:
             messagebox.showerror("错误", f"无法读取图片: {self.current_filename}")
             return
 
-        self.raw_image = img
-        if len(img.shape) == 3 and img.shape[2] == 4:
-            self.current_image = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-        elif len(img.shape) == 2:
-            self.current_image = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-        else:
-            self.current_image = img
+        # 原图解码后只读，后台线程可以直接共享引用
+        self.decoded_image = decoded
+        self.raw_image = decoded.raw
+        self.image_version += 1
+        self.stale_result = None
+        self.current_image = decoded.view("bgr")
+        self.filmstrip.set_current(self.current_index)
 
         self.root.title(f"AI图片处理工厂 - {self.current_filename} ({self.current_index + 1}/{len(self.files)})")
         self.status_label.config(text=f"当前文件: {self.current_filename}")
         self.zoom_scale, self.pan_offset_x, self.pan_offset_y = 1.0, 0, 0
         h, w = self.current_image.shape[:2]
 
-        should_reset_manual = not self.keep_manual_mask_var.get() or self.manual_draw_layer is None
-        if not should_reset_manual:
-            try:
-                if self.manual_draw_layer.shape != (h, w):
-                    self.manual_draw_layer = cv2.resize(self.manual_draw_layer, (w, h), interpolation=cv2.INTER_NEAREST)
-                    self.manual_erase_layer = cv2.resize(self.manual_erase_layer, (w, h), interpolation=cv2.INTER_NEAREST)
-            except:
-                should_reset_manual = True
-        
-        if should_reset_manual:
-            self.manual_draw_layer = np.zeros((h, w), dtype=np.uint8)
-            self.manual_erase_layer = np.zeros((h, w), dtype=np.uint8)
+        # 这张图片处理过：恢复当时的参数、手动图层和蒙版
+        state = self.state_store.load(self.current_filename) if self.state_store else None
+        if state is not None and state["draw"].shape == (h, w):
+            if not self._restore_image_state(state):
+                self.update_preview(proxy=True)
+                self._schedule_full_res()
+            return
+
+        # 保留手动修补只适用于尺寸相同的图片；缩放后的笔迹对不上新图片，不如重新开始
+        if not self.keep_manual_mask_var.get() or self.manual_draw_layer is None or self.manual_draw_layer.shape != (h, w):
+            self.manual_draw_layer = ManualLayer(h, w)
+            self.manual_erase_layer = ManualLayer(h, w)
+            self.edit_history.clear()
 
         if force_auto_detect or self.auto_apply_var.get():
             self.auto_detect_params()
         else:
-            self.update_preview()
+            self.update_preview(proxy=True)
+            self._schedule_full_res()
 
     def auto_detect_params(self):
         self.is_auto_detecting = True
@@ -830,45 +2284,31 @@ class ImageCutterApp:
         self.on_mode_change()
         self.is_auto_detecting = False
 
-    def update_display(self):
+    @Profiler.timed("update_display")
+    def update_display(self, dirty_rect=None):
         if self.current_image is None or self.processed_mask is None: return
+        geometry = self._display_geometry()
+        if geometry is None: return
+        _, new_w, new_h = geometry
 
-        img_rgb = cv2.cvtColor(self.current_image, cv2.COLOR_BGR2RGB)
-        final_vis = None
-
-        thresh_val = self.sliders.get("rembg_mask_thresh", tk.IntVar(value=127)).get()
-        _, display_mask = cv2.threshold(self.processed_mask, thresh_val, 255, cv2.THRESH_BINARY)
+        canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
+        x = (canvas_w - new_w) // 2 + self.pan_offset_x
+        y = (canvas_h - new_h) // 2 + self.pan_offset_y
 
-        if self.is_editing_mask:
-            overlay = np.zeros_like(img_rgb)
-            overlay[display_mask == 255] = [255, 0, 0]
-            final_vis = cv2.addWeighted(img_rgb, 0.4, overlay, 0.6, 0)
-        else:
-            mask_3c = cv2.cvtColor(display_mask, cv2.COLOR_GRAY2RGB)
-            fg = cv2.bitwise_and(img_rgb, mask_3c)
-            bg = cv2.bitwise_and(img_rgb, cv2.bitwise_not(mask_3c))
-            bg = (bg * 0.3).astype(np.uint8)
-            bg[:, :, 0] = np.clip(bg[:, :, 0] + 50, 0, 255)
-            final_vis = cv2.add(fg, bg)
-            contours, _ = cv2.findContours(display_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            cv2.drawContours(final_vis, contours, -1, (0, 255, 0), 2)
-            self.info_label.config(text=f"检测到 {len(contours)} 个对象")
+        # 阈值已在流水线的最后一个阶段完成
+        self.renderer.set_image(self.current_image, self.image_version)
+        self.renderer.set_mask(self.processed_mask, dirty_rect)
+        object_count = self.renderer.render(new_w, new_h, x, y, canvas_w, canvas_h, self.is_editing_mask)
+        if object_count is not None:
+            self.info_label.config(text=f"检测到 {object_count} 个对象")
 
+    def _display_geometry(self):
+        """返回 (缩放比例, 显示宽, 显示高)，画布尚未布局时返回 None。"""
         canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
-        if canvas_w < 10 or canvas_h < 10: return
-
-        h, w, _ = final_vis.shape
+        if canvas_w < 10 or canvas_h < 10: return None
+        h, w = self.current_image.shape[:2]
         current_scale = min(canvas_w / w, canvas_h / h) * self.zoom_scale
-        new_w, new_h = int(w * current_scale), int(h * current_scale)
-
-        final_vis_resized = cv2.resize(final_vis, (new_w, new_h))
-        img_pil = Image.fromarray(final_vis_resized)
-        self.display_image = ImageTk.PhotoImage(img_pil)
-
-        self.canvas.delete("all")
-        x = (canvas_w - new_w) // 2 + self.pan_offset_x
-        y = (canvas_h - new_h) // 2 + self.pan_offset_y
-        self.canvas.create_image(x, y, anchor=tk.NW, image=self.display_image)
+        return current_scale, int(w * current_scale), int(h * current_scale)
 
     def prev_image(self, event=None):
         if self.current_index > 0:
@@ -880,45 +2320,221 @@ class ImageCutterApp:
         else:
             messagebox.showinfo("完成", "已经是最后一张图片了。")
 
+    @Profiler.timed("save_crops")
     def save_crops(self):
         if self.processed_mask is None or self.raw_image is None: return
+        if self.mask_is_proxy or self.full_res_job or self.debounce_job or self.mask_token is not self.request_token:
+            # 当前只有代理预览 (或参数刚改、最新请求的结果还没回来)，先计算全分辨率蒙版，结果返回后再保存；
+            # 待发的代理预览也要取消，否则它会把这次全分辨率请求顶掉
+            for job in (self.full_res_job, self.debounce_job):
+                if job: self.root.after_cancel(job)
+            self.full_res_job = self.debounce_job = None
+            self.pending_save = True
+            self.update_preview()
+            return
 
-        if len(self.raw_image.shape) == 3 and self.raw_image.shape[2] == 4:
-            b, g, r, original_a = cv2.split(self.raw_image)
-        else:
-            bgr_image = cv2.cvtColor(self.raw_image, cv2.COLOR_GRAY2BGR) if len(self.raw_image.shape) == 2 else self.raw_image
-            b, g, r = cv2.split(bgr_image)
-            original_a = np.full(self.raw_image.shape[:2], 255, dtype=np.uint8)
-
-        thresh_val = self.sliders.get("rembg_mask_thresh", tk.IntVar(value=127)).get()
-        _, save_mask = cv2.threshold(self.processed_mask, thresh_val, 255, cv2.THRESH_BINARY)
-        
-        if self.apply_mask_var.get():
-            final_alpha = cv2.bitwise_and(original_a, save_mask)
-        else:
-            final_alpha = original_a
-            
-        final_full_image = cv2.merge([b, g, r, final_alpha])
-
-        contours, _ = cv2.findContours(save_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        base_name = os.path.splitext(self.current_filename)[0]
-        count = 0
-
-        if not contours:
+        # 原图只读可直接共享；蒙版之后可能被补丁原地修改，交给后台前复制一份
+        save_mask = self.processed_mask.copy()
+        boxes, labels, label_objects = CropEngine.find_objects(save_mask, self.sliders["crop_min_area"].get(), self.sliders["crop_merge_dist"].get())
+        if not boxes:
             self.info_label.config(text="未检测到可保存的对象！")
             return
 
-        for i, cnt in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w < 10 or h < 10: continue
-            crop = final_full_image[y:y + h, x:x + w]
-            save_name = f"{base_name}_{count}.png"
-            save_path = os.path.join(self.output_path, save_name)
-            if ImageProcessor.cv_imwrite(save_path, crop):
-                count += 1
+        alpha_mask = save_mask if self.apply_mask_var.get() else None
+        base_name = os.path.splitext(self.current_filename)[0]
+        output_mode = self.output_mode_var.get()
+        if output_mode == "vector" or self.export_vector_var.get():
+            batch = self.crop_writer.submit_vectors(self.current_filename, save_mask, labels, label_objects, boxes,
+                                                    self.output_path, base_name, on_done=self._on_crops_saved)
+            self.save_batches.append(batch)
+        if output_mode == "files":
+            batch = self.crop_writer.submit(self.current_filename, self.raw_image, alpha_mask, boxes, self.output_path, base_name,
+                                            self.sliders["png_compression"].get(), on_done=self._on_crops_saved)
+            self.save_batches.append(batch)
+        elif output_mode != "vector":
+            sprites = self.crop_writer.cut_sprites(self.current_filename, self.raw_image, alpha_mask, boxes, base_name)
+            if output_mode == "atlas_image":
+                batch = self.crop_writer.submit_atlas(self.current_filename, [sprites], self.output_path, f"{base_name}_atlas",
+                                                      self.sliders["png_compression"].get(), on_done=self._on_crops_saved)
+                self.save_batches.append(batch)
+            else:
+                self.pending_atlas_sprites.append(sprites)
+                self.pending_atlas_count += len(boxes)
+                self.save_status_label.config(
+                    text=f"整批图集待导出: {len(self.pending_atlas_sprites)} 张图片 / {self.pending_atlas_count} 个切片")
+        self._on_crop_progress()
+        self.next_image()
+
+    def export_batch_atlas(self):
+        """把整批模式下暂存的切片打包成图集写出。"""
+        if not self.pending_atlas_sprites:
+            messagebox.showinfo("提示", "没有待导出的切片。")
+            return
+        name = f"整批图集 ({len(self.pending_atlas_sprites)} 张图片)"
+        atlas_name = time.strftime("atlas_%Y%m%d_%H%M%S")
+        batch = self.crop_writer.submit_atlas(name, self.pending_atlas_sprites, self.output_path, atlas_name,
+                                              self.sliders["png_compression"].get(), on_done=self._on_crops_saved)
+        self.save_batches.append(batch)
+        self.pending_atlas_sprites, self.pending_atlas_count = [], 0
+        self._on_crop_progress()
+
+    def on_closing(self):
+        if self.pending_atlas_sprites and messagebox.askyesno(
+                "提示", f"还有 {self.pending_atlas_count} 个切片未导出为图集，是否先导出？"):
+            self.export_batch_atlas()  # 写入线程会在程序退出前完成
+        if self.batch_runner and not self.batch_runner.finished:
+            self.batch_runner.cancel()
+        self._save_image_state()
+        if self.state_store: self.state_store.close()
+        self.root.destroy()
+
+    def _on_crop_progress(self, event=None):
+        """在状态栏显示所有未完成批次的总进度，完成的批次调用其回调。"""
+        for batch in [b for b in self.save_batches if b.done]:
+            self.save_batches.remove(batch)
+            if batch.on_done: batch.on_done(batch)
+        if self.save_batches:
+            written = sum(b.written + b.failed for b in self.save_batches)
+            total = sum(b.total for b in self.save_batches)
+            self.save_status_label.config(text=f"后台保存中 {written}/{total}")
+
+    def _on_crops_saved(self, batch):
+        text = f"{batch.name}: {batch.summary or f'已保存 {batch.written} 个切片'}"
+        if batch.failed:
+            text += f"，{batch.failed} 个失败"
+        self.save_status_label.config(text=text)
+
+    # --- 批量应用到文件夹 ---
+    def open_batch_dialog(self):
+        """选择文件并把当前参数 (不含手动修补) 套用到它们，进度面板在同一个窗口中。"""
+        if not self.files or not self.output_path:
+            messagebox.showwarning("提示", "请先选择输入和保存文件夹。")
+            return
+        if self.batch_window is not None:
+            self.batch_window.lift()
+            return
+        win = tk.Toplevel(self.root)
+        win.title("批量应用到文件夹")
+        win.geometry("440x560")
+        win.protocol("WM_DELETE_WINDOW", self._close_batch_dialog)
+        self.batch_window = win
+
+        ttk.Label(win, text="按住 Ctrl / Shift 多选，不选时处理全部文件。\n"
+                            "使用当前参数、不含手动修补，每个切片输出一个文件；\n"
+                            "源图和参数都没变的图片会按结果清单跳过。", foreground="gray").pack(anchor=tk.W, padx=10, pady=(10, 5))
+        list_frame = ttk.Frame(win)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        self.batch_listbox = tk.Listbox(list_frame, selectmode=tk.EXTENDED, activestyle="none")
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=self.batch_listbox.yview)
+        self.batch_listbox.configure(yscrollcommand=scrollbar.set)
+        self.batch_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.batch_listbox.insert(tk.END, *self.files)
+
+        self.batch_progress = ttk.Progressbar(win, maximum=1)
+        self.batch_progress.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.batch_stats_label = ttk.Label(win, text="", justify=tk.LEFT)
+        self.batch_stats_label.pack(anchor=tk.W, padx=10, pady=5)
+        ttk.Label(win, text="失败:").pack(anchor=tk.W, padx=10)
+        self.batch_failure_list = tk.Listbox(win, height=4, foreground="red")
+        self.batch_failure_list.pack(fill=tk.X, padx=10)
+
+        button_frame = ttk.Frame(win)
+        button_frame.pack(fill=tk.X, padx=10, pady=10)
+        self.batch_start_button = ttk.Button(button_frame, text="▶ 开始", command=self.start_batch)
+        self.batch_start_button.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.batch_cancel_button = ttk.Button(button_frame, text="■ 取消", command=self.cancel_batch)
+        self.batch_cancel_button.pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(5, 0))
+        self._on_batch_progress()
+
+    def _close_batch_dialog(self):
+        """关闭面板不影响正在运行的批次，进度继续显示在状态栏。"""
+        self.batch_window.destroy()
+        self.batch_window = None
+
+    def start_batch(self):
+        if self.batch_runner and not self.batch_runner.finished:
+            return
+        selection = self.batch_listbox.curselection()
+        names = [self.files[i] for i in selection] if selection else list(self.files)
+        params = self._collect_params()
+        params['mode'] = MaskPipeline.ENGINE_MODES[params['mode']]
+        params['apply_mask'] = self.apply_mask_var.get()
+        self.batch_runner = BatchRunner(self.input_path, names, self.output_path, params,
+                                        on_progress=lambda runner: self._notify_ui("<<BatchProgress>>")).start()
+        self.batch_failure_list.delete(0, tk.END)
+        self._on_batch_progress()
+
+    def cancel_batch(self):
+        if self.batch_runner and not self.batch_runner.finished:
+            self.batch_runner.cancel()
+            self._on_batch_progress()
+
+    def _on_batch_progress(self, event=None):
+        """刷新进度面板 (已关闭时只更新状态栏)：速度、剩余时间、失败列表。"""
+        runner = self.batch_runner
+        if runner is None:
+            if self.batch_window is not None:
+                self.batch_cancel_button.state(["disabled"])
+            return
+        finished = runner.finished
+        counted = runner.processed + runner.skipped
+        if finished:
+            state = "已取消" if runner.cancelled else "已完成"
+            text = f"批量{state}: 处理 {runner.done} 张，跳过 {runner.skipped} 张，失败 {runner.failed} 张"
+        else:
+            text = f"批量处理中 {counted}/{runner.total}"
+        self.save_status_label.config(text=text)
+        if self.batch_window is None:
+            return
 
-        self.info_label.config(text=f"已保存 {count} 个切片！")
-        self.root.after(1000, self.next_image)
+        eta = runner.eta
+        eta_text = "--" if eta is None or finished else f"{int(eta) // 60}:{int(eta) % 60:02d}"
+        stats = (f"{text}\n"
+                 f"已处理 {runner.processed} / 跳过 {runner.skipped} / 共 {runner.total}，切片 {runner.crops} 个\n"
+                 f"速度 {runner.rate:.2f} 张/秒，剩余约 {eta_text}，已用 {runner.elapsed:.0f} 秒，线程 {runner.workers}")
+        self.batch_stats_label.config(text=stats)
+        self.batch_progress.config(maximum=max(1, runner.total), value=counted)
+        failures = runner.failures[self.batch_failure_list.size():]
+        for name, message in failures:
+            self.batch_failure_list.insert(tk.END, f"{name}: {message}")
+        self.batch_start_button.state(["!disabled"] if finished else ["disabled"])
+        self.batch_cancel_button.state(["disabled"] if finished or runner.cancelled else ["!disabled"])
+
+    # --- 性能分析 ---
+    def toggle_profiler(self):
+        Profiler.enabled = self.profiler_var.get()
+        if self.profiler_job:
+            self.root.after_cancel(self.profiler_job)
+            self.profiler_job = None
+        if Profiler.enabled:
+            Profiler.clear()
+            self._refresh_profiler_overlay()
+        else:
+            self.canvas.delete("profiler")
+
+    def _refresh_profiler_overlay(self):
+        """每 500ms 在预览左上角刷新各环节最近 200 次的 p50/p95。"""
+        self.canvas.delete("profiler")
+        lines = [f"{'环节':<22}{'次数':>5}{'p50 ms':>9}{'p95 ms':>9}"]
+        lines += [f"{name:<22}{count:>5}{p50:>9.1f}{p95:>9.1f}" for name, count, p50, p95 in Profiler.summary()]
+        text = self.canvas.create_text(10, 10, anchor=tk.NW, text="\n".join(lines), fill="#e0e0e0",
+                                       font=("Consolas", 9), tags="profiler")
+        x0, y0, x1, y1 = self.canvas.bbox(text)
+        self.canvas.tag_lower(self.canvas.create_rectangle(x0 - 5, y0 - 5, x1 + 5, y1 + 5, fill="#000000",
+                                                           stipple="gray50", outline="", tags="profiler"), text)
+        self.profiler_job = self.root.after(500, self._refresh_profiler_overlay)
+
+    def export_trace(self):
+        path = filedialog.asksaveasfilename(title="导出 Chrome Trace", defaultextension=".json",
+                                            initialfile=time.strftime("ipf_trace_%Y%m%d_%H%M%S.json"),
+                                            filetypes=[("Trace JSON", "*.json")])
+        if not path: return
+        try:
+            count = Profiler.export_chrome_trace(path)
+            messagebox.showinfo("提示", f"已导出 {count} 个事件，可在 chrome://tracing 或 ui.perfetto.dev 中打开。")
+        except OSError as e:
+            messagebox.showerror("错误", f"导出失败: {e}")
 
     def start_color_picking(self):
         if self.is_editing_mask:
@@ -928,17 +2544,10 @@ class ImageCutterApp:
         self.canvas.config(cursor="crosshair")
         self.status_label.config(text="请在图片上点击以吸取颜色...")
 
-    def _get_bgra_from_raw(self, raw_img):
-        if len(raw_img.shape) == 2:
-            return cv2.cvtColor(raw_img, cv2.COLOR_GRAY2BGRA)
-        if raw_img.shape[2] == 3:
-            return cv2.cvtColor(raw_img, cv2.COLOR_BGR2BGRA)
-        return raw_img
-
     def pick_color(self, event):
         if self.raw_image is None: return
 
-        image_bgra = self._get_bgra_from_raw(self.raw_image)
+        image_bgra = self.decoded_image.view("bgra")
         h, w = image_bgra.shape[:2]
 
         canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/16 10:15
+# @Author  : cy1026
+# @File    : test_crops.py
+# @Software: PyCharm
+"""CropEngine.merge_boxes 的网格加速结果须与逐对比较完全一致。    python -m pytest tests"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipf_engine import CropEngine  # noqa: E402
+
+
+def brute_force_merge(boxes, dist):
+    """逐对比较，合并到不再变化为止；返回按坐标排序的框。"""
+    boxes = [list(box) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if max(b[0] - a[2], a[0] - b[2]) <= dist and max(b[1] - a[3], a[1] - b[3]) <= dist:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return sorted(map(tuple, boxes))
+
+
+def random_boxes(rng, n, size=500, long_side=0):
+    x0 = rng.integers(0, size, n)
+    y0 = rng.integers(0, size, n)
+    w = rng.integers(1, 25, n)
+    h = rng.integers(1, 25, n)
+    w[0] += long_side
+    return np.stack([x0, y0, x0 + w, y0 + h], axis=1).astype(np.int32)
+
+
+def test_merge_boxes_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        # 一半的用例混入一个很长的框，覆盖不进网格的大框分支
+        boxes = random_boxes(rng, int(rng.integers(2, 40)), long_side=int(rng.choice([0, 400])))
+        dist = int(rng.integers(0, 40))
+        merged, _ = CropEngine.merge_boxes(boxes, dist)
+        assert sorted(map(tuple, merged.tolist())) == brute_force_merge(boxes.tolist(), dist)
+
+
+def test_boxes_exactly_dist_apart_merge():
+    boxes = np.array([[376, 257, 378, 272], [399, 267, 413, 279]], dtype=np.int32)
+    merged, members = CropEngine.merge_boxes(boxes, 21)
+    assert merged.tolist() == [[376, 257, 413, 279]]
+    assert members.tolist() == [0, 0]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/2 10:15
+# @Author  : cy1026
+# @File    : 形态学基准.py
+# @Software: PyCharm
+"""
+MorphologyEngine 与逐次 cv2.morphologyEx 的对比基准。
+在合成的“精灵图”蒙版上运行 apply_morphology 的几组典型参数，输出耗时、加速比和像素差异；
+再在三类蒙版上逐个比较单独的椭圆核开/闭运算 (含偶数核和多次迭代)，标出按行计算的组合；结果应与原实现完全一致。
+用法: python 形态学基准.py [宽 高 重复次数]
+"""
+import sys
+import time
+import cv2
+import numpy as np
+
+from ipf_engine import MorphologyEngine
+
+
+def make_sprite_sheet(w, h, seed=0):
+    """随机排布的椭圆、矩形“精灵”，外加零星噪点和细缝，模拟待切分的蒙版。"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    cell = 160
+    for y in range(0, h - cell, cell):
+        for x in range(0, w - cell, cell):
+            cx, cy = x + cell // 2, y + cell // 2
+            if rng.random() < 0.5:
+                axes = (int(rng.integers(20, 70)), int(rng.integers(20, 70)))
+                cv2.ellipse(mask, (cx, cy), axes, float(rng.integers(0, 180)), 0, 360, 255, -1)
+            else:
+                hw, hh = int(rng.integers(20, 70)), int(rng.integers(20, 70))
+                cv2.rectangle(mask, (cx - hw, cy - hh), (cx + hw, cy + hh), 255, -1)
+            # 细缝：让连接操作有东西可连
+            cv2.line(mask, (cx - 60, cy), (cx + 60, cy), 0, int(rng.integers(1, 4)))
+    mask[rng.random((h, w)) < 0.002] = 255
+    return mask
+
+
+def make_blobs(w, h, seed=0):
+    """大小不一的平滑椭圆和粗线条，边缘多为曲线。"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    for _ in range(w * h // 12800):
+        center = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+        if rng.random() < 0.5:
+            axes = (int(rng.integers(20, 90)), int(rng.integers(20, 90)))
+            cv2.ellipse(mask, center, axes, float(rng.integers(0, 180)), 0, 360, 255, -1)
+        else:
+            end = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+            cv2.line(mask, center, end, 255, int(rng.integers(40, 110)))
+    return mask
+
+
+def make_sparse_dots(w, h, seed=0):
+    """稀疏的单像素噪点：闭运算是否把它们连起来取决于核边缘的每个像素，对核形状最敏感。"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    mask[rng.random((h, w)) < 0.0004] = 255
+    return mask
+
+
+def reference(mask, clean_k, connect_k, iters):
+    """改动前的实现：每次重建结构元素，迭代交给 morphologyEx。"""
+    if clean_k > 0:
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (clean_k, clean_k)))
+    if connect_k > 0 and iters > 0:
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (connect_k, connect_k)), iterations=iters)
+    return mask
+
+
+def engine(mask, clean_k, connect_k, iters):
+    if clean_k > 0:
+        mask = MorphologyEngine.morph(mask, cv2.MORPH_OPEN, cv2.MORPH_ELLIPSE, clean_k)
+    if connect_k > 0 and iters > 0:
+        mask = MorphologyEngine.morph(mask, cv2.MORPH_CLOSE, cv2.MORPH_RECT, connect_k, iters)
+    return mask
+
+
+def timed(func, repeat):
+    func()  # 预热 (包括结构元素缓存)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    w, h, repeat = (int(v) for v in sys.argv[1:4]) if len(sys.argv) >= 4 else (4000, 3000, 3)
+    mask = make_sprite_sheet(w, h)
+    cases = [(3, 5, 2), (9, 20, 3), (31, 20, 10), (50, 50, 3), (61, 60, 5), (66, 45, 2), (100, 60, 10), (101, 60, 10)]
+
+    print(f"蒙版 {w}x{h}, 每组重复 {repeat} 次")
+    print(f"{'去噪核':>6} {'连接核':>6} {'迭代':>4} {'原实现ms':>10} {'新实现ms':>10} {'加速':>7} {'差异像素':>10} {'差异比例':>9}")
+    for clean_k, connect_k, iters in cases:
+        ref_ms, ref_mask = timed(lambda: reference(mask, clean_k, connect_k, iters), repeat)
+        new_ms, new_mask = timed(lambda: engine(mask, clean_k, connect_k, iters), repeat)
+        diff = int(np.count_nonzero(ref_mask != new_mask))
+        print(f"{clean_k:>6} {connect_k:>6} {iters:>4} {ref_ms:>10.1f} {new_ms:>10.1f} {ref_ms / new_ms:>6.1f}x "
+              f"{diff:>10} {diff / mask.size:>8.4%}")
+
+    # 单独的椭圆核：奇偶、开闭、多次迭代，以及按行计算的门槛两侧
+    masks = {"精灵图": mask, "平滑大块": make_blobs(w, h), "稀疏噪点": make_sparse_dots(w, h)}
+    ops = {"开": cv2.MORPH_OPEN, "闭": cv2.MORPH_CLOSE}
+    print(f"\n{'蒙版':<6} {'运算':>4} {'核':>4} {'迭代':>4} {'路径':>6} {'原实现ms':>10} {'新实现ms':>10} {'加速':>7} {'差异像素':>10}")
+    for mask_name, sample in masks.items():
+        for op_name, op in ops.items():
+            for k, iters in ((31, 1), (41, 1), (50, 1), (66, 1), (67, 1), (100, 1), (101, 1), (15, 3), (24, 3), (34, 3)):
+                kernel = MorphologyEngine.kernel(cv2.MORPH_ELLIPSE, k)
+                ref_ms, ref_mask = timed(lambda: cv2.morphologyEx(sample, op, kernel, iterations=iters), 1)
+                new_ms, new_mask = timed(lambda: MorphologyEngine.morph(sample, op, cv2.MORPH_ELLIPSE, k, iters), 1)
+                path = "按行" if MorphologyEngine.uses_rows(cv2.MORPH_ELLIPSE, k, iters) else "OpenCV"
+                diff = int(np.count_nonzero(ref_mask != new_mask))
+                print(f"{mask_name:<6} {op_name:>4} {k:>4} {iters:>4} {path:>6} {ref_ms:>10.1f} {new_ms:>10.1f} "
+                      f"{ref_ms / new_ms:>6.1f}x {diff:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2026/3/9 14:20
+# @Author  : cy1026
+# @File    : 性能基准.py
+# @Software: PyCharm
+"""
+ImageProcessor 各模式与后处理的可复现基准 (无界面)。
+在几种分辨率下生成合成图片 (纯色底、渐变底、白底黄主体、噪声底)，
+测量各蒙版模式、形态学处理和切片提取的耗时，结果输出为 JSON；
+指定基线文件时逐项对比，变慢超过阈值的标记为退化，并以退出码 1 结束。
+本地 models 目录中有模型文件时，同时测量 Rembg 推理。
+
+用法:
+    python 性能基准.py -o baseline.json
+    python 性能基准.py --baseline baseline.json --threshold 0.15
+    python 性能基准.py --sizes 640x480 1920x1080 --repeat 3
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import cv2
+import numpy as np
+
+from ipf_engine import ImageProcessor, CropEngine
+from ipf_engine import models
+
+SCENES = ("solid", "gradient", "yellow", "noisy")
+DEFAULT_SIZES = ("640x480", "1920x1080", "4000x3000")
+
+
+def make_scene(kind, w, h, seed=0):
+    """返回 BGRA 合成图片：背景加一格一个的随机椭圆/矩形主体。"""
+    rng = np.random.default_rng(seed)
+    if kind == "solid":
+        img = np.full((h, w, 3), (60, 180, 90), dtype=np.uint8)
+    elif kind == "gradient":
+        ramp = np.linspace(0, 255, w, dtype=np.float32)
+        img = np.dstack([np.tile(ramp, (h, 1)), np.full((h, w), 128, np.float32),
+                         np.tile(ramp[::-1], (h, 1))]).astype(np.uint8)
+    elif kind == "yellow":
+        img = np.full((h, w, 3), 255, dtype=np.uint8)
+    else:
+        img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+    color = (0, 220, 255) if kind == "yellow" else (200, 40, 160)
+    cell = max(40, min(w, h) // 8)
+    for y in range(0, h - cell + 1, cell):
+        for x in range(0, w - cell + 1, cell):
+            cx, cy, r = x + cell // 2, y + cell // 2, int(cell * rng.uniform(0.2, 0.4))
+            if rng.random() < 0.5:
+                cv2.ellipse(img, (cx, cy), (r, int(r * rng.uniform(0.5, 1.0))), float(rng.integers(0, 180)), 0, 360, color, -1)
+            else:
+                cv2.rectangle(img, (cx - r, cy - r), (cx + r, cy + r), color, -1)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+
+
+def build_cases(raw, model_path):
+    """返回 [(名称, 无参函数)]。颜色空间转换不计入各模式的耗时，与界面中按图片缓存的行为一致。"""
+    bgr = cv2.cvtColor(raw, cv2.COLOR_BGRA2BGR)
+    hsv = ImageProcessor.to_hsv_planes(bgr)
+    mask = ImageProcessor.get_mask_gray(bgr, 0, "white")
+    cases = [
+        ("get_mask_color", lambda: ImageProcessor.get_mask_color(hsv, 15, 40, 40)),
+        ("get_mask_rgba_range", lambda: ImageProcessor.get_mask_rgba_range(raw, 50, 70, 170, 190, 80, 100, 0, 255)),
+        ("get_mask_yellow", lambda: ImageProcessor.get_mask_yellow(hsv, 30, 15, 40, 40)),
+        ("get_mask_gray", lambda: ImageProcessor.get_mask_gray(bgr, 0, "white")),
+        ("apply_morphology", lambda: ImageProcessor.apply_morphology(mask, 3, 5, 2)),
+        ("apply_morphology_large", lambda: ImageProcessor.apply_morphology(mask, 31, 41, 5)),
+        ("crop_extraction", lambda: CropEngine.find_objects(mask, 100, 10)),
+    ]
+    if model_path:
+        cases.append(("get_mask_rembg", lambda: ImageProcessor.get_mask_rembg(bgr)))
+    return cases
+
+
+def timed(func, repeat):
+    func()  # 预热 (查找表、结构元素、模型会话等缓存)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": float(np.median(samples)), "min_ms": min(samples), "repeat": repeat}
+
+
+def run(sizes, repeat):
+    model_path = models.model_path("u2net")
+    if model_path is None:
+        print("未找到本地模型 models/u2net.onnx，跳过 get_mask_rembg")
+
+    results = {}
+    for size in sizes:
+        w, h = (int(v) for v in size.lower().split("x"))
+        for scene in SCENES:
+            raw = make_scene(scene, w, h)
+            for name, func in build_cases(raw, model_path):
+                # 推理很慢且与背景无关，只在一种场景下测
+                if name == "get_mask_rembg" and scene != "solid":
+                    continue
+                key = f"{name}/{scene}/{w}x{h}"
+                results[key] = timed(func, 1 if name == "get_mask_rembg" else repeat)
+                print(f"{key:<48} {results[key]['median_ms']:>10.2f} ms")
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "cv_threads": cv2.getNumThreads(),
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """打印逐项对比，返回退化项数量。两次都很快 (< 0.5ms) 的项抖动太大，不参与判断。"""
+    regressions = 0
+    base = baseline.get("results", {})
+    print(f"\n{'项目':<46} {'基线ms':>10} {'本次ms':>10} {'变化':>8}")
+    for key, result in current["results"].items():
+        if key not in base:
+            print(f"{key:<48} {'-':>10} {result['median_ms']:>10.2f}      新增")
+            continue
+        old, new = base[key]["median_ms"], result["median_ms"]
+        change = new / old - 1 if old > 0 else 0.0
+        flag = ""
+        if change > threshold and max(old, new) >= 0.5:
+            flag = "  ⚠ 退化"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  ✓ 提升"
+        print(f"{key:<48} {old:>10.2f} {new:>10.2f} {change:>+7.1%}{flag}")
+    for key in base.keys() - current["results"].keys():
+        print(f"{key:<48} 本次未运行")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ImageProcessor 性能基准")
+    parser.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES), help="分辨率列表，如 640x480 1920x1080")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数 (取中位数)")
+    parser.add_argument("-o", "--output", help="结果 JSON 的保存路径")
+    parser.add_argument("--baseline", help="与之对比的基线 JSON")
+    parser.add_argument("--threshold", type=float, default=0.15, help="判定为退化的变慢比例 (默认 0.15 即 15%%)")
+    args = parser.parse_args()
+
+    cv2.setRNGSeed(0)
+    current = run(args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        print(f"\n{regressions} 项退化 (阈值 {args.threshold:.0%})")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,103 +12,15 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from PIL import Image, ImageTk
 
-# ==========================================
-# 核心逻辑类 (Core Logic)
-# ==========================================
-class ImageProcessor:
-    """
-    负责图像处理的核心算法，与UI解耦。
-    """
-    @staticmethod
-    def cv_imread(file_path):
-        try:
-            # 支持中文路径读取
-            return cv2.imdecode(np.fromfile(file_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-        except Exception as e:
-            print(f"Error reading file {file_path}: {e}")
-            return None
-
-    @staticmethod
-    def cv_imwrite(file_path, img):
-        try:
-            # 支持中文路径保存
-            is_success, im_buf = cv2.imencode(".png", img)
-            if is_success:
-                im_buf.tofile(file_path)
-                return True
-        except Exception as e:
-            print(f"Error writing file {file_path}: {e}")
-        return False
-
-    @staticmethod
-    def get_mask_color(img, hue_tol, sat_min, val_min):
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        h, w, _ = img.shape
-        # 取四个角作为背景色参考
-        corners_hsv = [hsv[0,0], hsv[0, w-1], hsv[h-1, 0], hsv[h-1, w-1]]
-        bg_hsv = np.median(corners_hsv, axis=0)
-        bg_h = bg_hsv[0]
-
-        min_h, max_h = bg_h - hue_tol, bg_h + hue_tol
-        
-        # 处理色相环绕 (0-180)
-        if min_h < 0:
-            lower1, upper1 = np.array([min_h + 180, sat_min, val_min]), np.array([179, 255, 255])
-            lower2, upper2 = np.array([0, sat_min, val_min]), np.array([max_h, 255, 255])
-            mask = cv2.bitwise_or(cv2.inRange(hsv, lower1, upper1), cv2.inRange(hsv, lower2, upper2))
-        elif max_h > 179:
-            lower1, upper1 = np.array([min_h, sat_min, val_min]), np.array([179, 255, 255])
-            lower2, upper2 = np.array([0, sat_min, val_min]), np.array([max_h - 180, 255, 255])
-            mask = cv2.bitwise_or(cv2.inRange(hsv, lower1, upper1), cv2.inRange(hsv, lower2, upper2))
-        else:
-            lower, upper = np.array([min_h, sat_min, val_min]), np.array([max_h, 255, 255])
-            mask = cv2.inRange(hsv, lower, upper)
-
-        return cv2.bitwise_not(mask) # 反转，保留前景
-
-    @staticmethod
-    def get_mask_yellow(img, h_center, h_tol, s_min, v_min):
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        min_h, max_h = h_center - h_tol, h_center + h_tol
-
-        if min_h < 0:
-            lower1, upper1 = np.array([min_h + 180, s_min, v_min]), np.array([179, 255, 255])
-            lower2, upper2 = np.array([0, s_min, v_min]), np.array([max_h, 255, 255])
-            mask = cv2.bitwise_or(cv2.inRange(hsv, lower1, upper1), cv2.inRange(hsv, lower2, upper2))
-        elif max_h > 179:
-            lower1, upper1 = np.array([min_h, s_min, v_min]), np.array([179, 255, 255])
-            lower2, upper2 = np.array([0, s_min, v_min]), np.array([max_h - 180, 255, 255])
-            mask = cv2.bitwise_or(cv2.inRange(hsv, lower1, upper1), cv2.inRange(hsv, lower2, upper2))
-        else:
-            lower, upper = np.array([min_h, s_min, v_min]), np.array([max_h, 255, 255])
-            mask = cv2.inRange(hsv, lower, upper)
-        
-        return mask
-
-    @staticmethod
-    def get_mask_gray(img, thresh_val, bg_type):
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        type_flag = cv2.THRESH_BINARY if bg_type == "black" else cv2.THRESH_BINARY_INV
-        
-        if thresh_val == 0:
-            type_flag += cv2.THRESH_OTSU
-        
-        _, mask = cv2.threshold(blurred, thresh_val, 255, type_flag)
-        return mask
-
-    @staticmethod
-    def apply_morphology(mask, clean_k, connect_k, iters):
-        if clean_k > 0:
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (clean_k, clean_k)))
-        if connect_k > 0 and iters > 0:
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (connect_k, connect_k)), iterations=iters)
-        return mask
+from ipf_engine import ImageProcessor, CropEngine
 
 # ==========================================
 # 用户界面类 (UI)
 # ==========================================
 class ImageCutterApp:
+    # 界面上的模式 -> ImageProcessor.MODES 中的名称 (本工具的“彩色背景”按背景色相识别)
+    ENGINE_MODES = {"color": "hsv_color", "yellow": "yellow", "gray": "gray"}
+
     def __init__(self, root):
         self.root = root
         self.root.title("AI图片处理工厂 - 交互式切分工具")
@@ -134,6 +46,14 @@ class ImageCutterApp:
         # 手动修补层 (Manual Mask Layers)
         self.manual_draw_layer = None  # 记录画笔 (Positive)
         self.manual_erase_layer = None # 记录橡皮 (Negative)
+        self.manual_version = 0        # 手动层每次修改加一，用于缓存缩小后的手动层
+
+        # 代理预览：拖动滑块时在与画布比例一致的小图上计算，停止操作后再算全分辨率
+        self.mask_is_proxy = False
+        self.full_res_job = None
+        self.proxy_image = (None, None)
+        self.proxy_layers = (None, None)
+        self.hsv_planes = (None, None)  # (缩放比例, HSV 平面)，每张图片只转换一次颜色空间
 
         # 编辑状态
         self.is_editing_mask = False
@@ -185,10 +105,15 @@ class ImageCutterApp:
 
     def save_settings(self):
         """保存配置文件"""
-        config = {
-            "input_path": self.input_path,
-            "output_path": self.output_path
-        }
+        config = {}
+        try:
+            # 与 rembg拆分.py 共用配置文件，保留其中的其他配置项 (如处理服务的 engine_token)
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            pass
+        config["input_path"] = self.input_path
+        config["output_path"] = self.output_path
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=4)
@@ -334,10 +259,15 @@ class ImageCutterApp:
         # 形态学参数
         self.morph_frame = ttk.LabelFrame(self.main_controls_frame, text="形态学处理 (连接主体)", padding="5")
         self.morph_frame.pack(fill=tk.X, pady=10)
-        self.add_slider(self.morph_frame, "clean_kernel", "去噪核大小 (Open)", 0, 10, 3)
-        self.add_slider(self.morph_frame, "connect_kernel", "连接核大小 (Close)", 0, 20, 5)
+        self.add_slider(self.morph_frame, "clean_kernel", "去噪核大小 (Open)", 0, 100, 3)
+        self.add_slider(self.morph_frame, "connect_kernel", "连接核大小 (Close)", 0, 60, 5)
         self.add_slider(self.morph_frame, "connect_iters", "连接迭代次数", 0, 10, 2)
 
+        self.crop_frame = ttk.LabelFrame(self.main_controls_frame, text="切片提取", padding="5")
+        self.crop_frame.pack(fill=tk.X, pady=10)
+        self.add_slider(self.crop_frame, "crop_min_area", "最小面积 (像素)", 0, 5000, 0)
+        self.add_slider(self.crop_frame, "crop_merge_dist", "碎片合并距离", 0, 100, 0)
+
         # 操作按钮
         action_frame = ttk.Frame(self.main_controls_frame)
         action_frame.pack(fill=tk.X, pady=10)
@@ -417,7 +347,10 @@ class ImageCutterApp:
             self.edit_controls_frame.pack(fill=tk.X)
             self.edit_mask_button.config(text="完成编辑 (M)")
             self.canvas.config(cursor="none")
-            self.update_display()
+            if self.mask_is_proxy:
+                self.update_preview() # 编辑需要全分辨率蒙版
+            else:
+                self.update_display()
         else:
             self.edit_controls_frame.pack_forget()
             self.main_controls_frame.pack(fill=tk.X)
@@ -486,6 +419,7 @@ class ImageCutterApp:
             cv2.circle(self.manual_erase_layer, (x, y), real_brush_radius, 255, -1)
             # 如果在橡皮层画了，画笔层对应位置应该清除
             cv2.circle(self.manual_draw_layer, (x, y), real_brush_radius, 0, -1)
+        self.manual_version += 1
 
         self.update_preview()
         # FIX 3: 在绘画后立即更新光标位置
@@ -558,7 +492,7 @@ class ImageCutterApp:
                 
             lbl.config(text=f"{label}: {int(float(val))}")
             if not self.is_editing_mask:
-                self.update_preview()
+                self.update_preview(proxy=True)
         slider = ttk.Scale(frame, from_=min_val, to=max_val, variable=var, orient=tk.HORIZONTAL, command=on_change)
         slider.pack(fill=tk.X)
         self.sliders[name] = var
@@ -614,6 +548,9 @@ class ImageCutterApp:
         if should_reset_manual:
             self.manual_draw_layer = np.zeros((h, w), dtype=np.uint8)
             self.manual_erase_layer = np.zeros((h, w), dtype=np.uint8)
+        self.manual_version += 1
+        self.proxy_image = (None, None)
+        self.hsv_planes = (None, None)
 
         # 核心逻辑修改：
         # 1. 如果是强制自动检测（比如刚打开文件夹），则执行检测。
@@ -653,51 +590,100 @@ class ImageCutterApp:
         # 关闭标志位
         self.is_auto_detecting = False
 
-    def get_mask(self):
+    def get_mask(self, scale=1.0):
         if self.current_image is None: return None
         img = self.current_image
+        draw_layer, erase_layer = self.manual_draw_layer, self.manual_erase_layer
+        if scale != 1:
+            img, draw_layer, erase_layer = self.get_proxy_inputs(scale)
         mode = self.mode_var.get()
         mask = None
 
         # 1. 计算算法蒙版
-        if mode == "color":
-            mask = ImageProcessor.get_mask_color(img, self.sliders["hue_tol"].get(), self.sliders["sat_min"].get(), self.sliders["val_min"].get())
-        elif mode == "yellow":
-            mask = ImageProcessor.get_mask_yellow(img, self.sliders["yellow_h_center"].get(), self.sliders["yellow_h_tol"].get(), self.sliders["yellow_s_min"].get(), self.sliders["yellow_v_min"].get())
-        else:
-            mask = ImageProcessor.get_mask_gray(img, self.sliders["gray_thresh"].get(), self.bg_type_var.get())
+        engine_mode = self.ENGINE_MODES.get(mode, "gray")
+        if ImageProcessor.MODES[engine_mode].color_space == "hsv":
+            img = self.get_hsv_planes(img, scale)
+        params = {name: slider.get() for name, slider in self.sliders.items()}
+        params["bg_type"] = self.bg_type_var.get()
+        mask, _ = ImageProcessor.compute_mask(engine_mode, img, params, scale)
 
-        mask = ImageProcessor.apply_morphology(mask, self.sliders["clean_kernel"].get(), self.sliders["connect_kernel"].get(), self.sliders["connect_iters"].get())
+        # 核大小按代理比例缩放，保证预览与全分辨率结果一致
+        mask = ImageProcessor.apply_morphology(mask, ImageProcessor.scale_kernel(self.sliders["clean_kernel"].get(), scale), ImageProcessor.scale_kernel(self.sliders["connect_kernel"].get(), scale), self.sliders["connect_iters"].get())
 
         # 2. 叠加手动修补层
-        if self.manual_draw_layer is not None and self.manual_erase_layer is not None:
+        if draw_layer is not None and erase_layer is not None:
             # 添加画笔内容 (OR)
-            mask = cv2.bitwise_or(mask, self.manual_draw_layer)
+            mask = cv2.bitwise_or(mask, draw_layer)
             # 移除橡皮内容 (AND NOT)
-            mask = cv2.bitwise_and(mask, cv2.bitwise_not(self.manual_erase_layer))
+            mask = cv2.bitwise_and(mask, cv2.bitwise_not(erase_layer))
 
         return mask
 
-    def update_preview(self):
+    def get_hsv_planes(self, img, scale):
+        """当前图片 (或其代理图) 的 HSV 平面，按缩放比例缓存。"""
+        if self.hsv_planes[0] != scale:
+            self.hsv_planes = (scale, ImageProcessor.to_hsv_planes(img))
+        return self.hsv_planes[1]
+
+    def get_proxy_inputs(self, scale):
+        """返回缩小后的 (图片, 画笔层, 橡皮层)；图片按比例缓存，手动层再按版本缓存。"""
+        h, w = self.current_image.shape[:2]
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        if self.proxy_image[0] != scale:
+            self.proxy_image = (scale, cv2.resize(self.current_image, size, interpolation=cv2.INTER_AREA))
+        if self.proxy_layers[0] != (scale, self.manual_version):
+            self.proxy_layers = ((scale, self.manual_version), (
+                cv2.resize(self.manual_draw_layer, size, interpolation=cv2.INTER_NEAREST),
+                cv2.resize(self.manual_erase_layer, size, interpolation=cv2.INTER_NEAREST)))
+        return (self.proxy_image[1],) + self.proxy_layers[1]
+
+    def get_display_geometry(self):
+        """返回 (缩放比例, 显示宽, 显示高)，画布尚未布局时返回 None。"""
+        canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if canvas_w < 10 or canvas_h < 10: return None
+        h, w = self.current_image.shape[:2]
+        current_scale = min(canvas_w / w, canvas_h / h) * self.zoom_scale
+        return current_scale, int(w * current_scale), int(h * current_scale)
+
+    def update_preview(self, proxy=False):
         # FIX 1: 总是重新计算最终蒙版
-        self.processed_mask = self.get_mask()
+        if self.full_res_job:
+            self.root.after_cancel(self.full_res_job)
+            self.full_res_job = None
+        scale = 1.0
+        if proxy and self.current_image is not None:
+            geometry = self.get_display_geometry()
+            # 显示比例接近原图时代理没有意义
+            if geometry is not None and geometry[0] < 0.75:
+                scale = geometry[0]
+        self.processed_mask = self.get_mask(scale)
+        self.mask_is_proxy = scale != 1
+        if self.mask_is_proxy:
+            # 输入空闲后再计算一次全分辨率结果
+            self.full_res_job = self.root.after(600, self.update_preview)
         self.update_display()
 
     def update_display(self):
         if self.current_image is None or self.processed_mask is None: return
 
-        img_rgb = cv2.cvtColor(self.current_image, cv2.COLOR_BGR2RGB)
+        geometry = self.get_display_geometry()
+        if geometry is None: return
+        _, new_w, new_h = geometry
+
+        # 在显示分辨率下合成 (蒙版可能是代理分辨率)
+        img_rgb = cv2.cvtColor(cv2.resize(self.current_image, (new_w, new_h)), cv2.COLOR_BGR2RGB)
+        display_mask = cv2.resize(self.processed_mask, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
 
         if self.is_editing_mask:
             overlay = np.zeros_like(img_rgb)
             # 显示最终蒙版区域
-            overlay[self.processed_mask == 255] = [255, 0, 0] 
+            overlay[display_mask == 255] = [255, 0, 0] 
             
             # FIX 2: 增加蒙版对比度，让红色更显眼
             final_vis = cv2.addWeighted(img_rgb, 0.4, overlay, 0.6, 0)
         else:
-            mask_inv = cv2.bitwise_not(self.processed_mask)
-            mask_3c = cv2.cvtColor(self.processed_mask, cv2.COLOR_GRAY2RGB)
+            mask_inv = cv2.bitwise_not(display_mask)
+            mask_3c = cv2.cvtColor(display_mask, cv2.COLOR_GRAY2RGB)
             mask_inv_3c = cv2.cvtColor(mask_inv, cv2.COLOR_GRAY2RGB)
             fg = cv2.bitwise_and(img_rgb, mask_3c)
             bg = cv2.bitwise_and(img_rgb, mask_inv_3c)
@@ -705,21 +691,15 @@ class ImageCutterApp:
             bg[:, :, 0] = np.clip(bg[:, :, 0] + 50, 0, 255)
             final_vis = cv2.add(fg, bg)
             contours, _ = cv2.findContours(self.processed_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            cv2.drawContours(final_vis, contours, -1, (0, 255, 0), 2)
+            mask_h, mask_w = self.processed_mask.shape[:2]
+            to_display = np.array([new_w / mask_w, new_h / mask_h])
+            cv2.drawContours(final_vis, [(c * to_display).astype(np.int32) for c in contours], -1, (0, 255, 0), 2)
             self.info_label.config(text=f"检测到 {len(contours)} 个对象")
 
-        canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
-        if canvas_w < 10 or canvas_h < 10: return
-
-        h, w, _ = final_vis.shape
-        base_scale = min(canvas_w / w, canvas_h / h)
-        current_scale = base_scale * self.zoom_scale
-        new_w, new_h = int(w * current_scale), int(h * current_scale)
-
-        final_vis_resized = cv2.resize(final_vis, (new_w, new_h))
-        img_pil = Image.fromarray(final_vis_resized)
+        img_pil = Image.fromarray(final_vis)
         self.display_image = ImageTk.PhotoImage(img_pil)
 
+        canvas_w, canvas_h = self.canvas.winfo_width(), self.canvas.winfo_height()
         self.canvas.delete("all")
         x = (canvas_w - new_w) // 2 + self.pan_offset_x
         y = (canvas_h - new_h) // 2 + self.pan_offset_y
@@ -737,6 +717,8 @@ class ImageCutterApp:
 
     def save_crops(self):
         if self.processed_mask is None or self.raw_image is None: return
+        if self.mask_is_proxy:
+            self.update_preview() # 保存前一定使用全分辨率蒙版
 
         if len(self.raw_image.shape) == 3 and self.raw_image.shape[2] == 4:
             b, g, r, original_a = cv2.split(self.raw_image)
@@ -748,17 +730,15 @@ class ImageCutterApp:
         final_alpha = cv2.bitwise_and(original_a, self.processed_mask)
         final_full_image = cv2.merge([b, g, r, final_alpha])
 
-        contours, _ = cv2.findContours(self.processed_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = CropEngine.find_boxes(self.processed_mask, self.sliders["crop_min_area"].get(), self.sliders["crop_merge_dist"].get())
         base_name = os.path.splitext(self.current_filename)[0]
         count = 0
 
-        if not contours:
+        if not boxes:
             self.info_label.config(text="未检测到可保存的对象！")
             return
 
-        for i, cnt in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(cnt)
-            if w < 10 or h < 10: continue
+        for x, y, w, h in boxes:
             crop = final_full_image[y:y+h, x:x+w]
             save_name = f"{base_name}_{count}.png"
             save_path = os.path.join(self.output_path, save_name)
@@ -4,10 +4,80 @@
 # @File    : 部分补全.py
 # @Software: PyCharm
 
+import zlib
 import tkinter as tk
 from tkinter import filedialog, messagebox, Scale, HORIZONTAL
 from PIL import Image, ImageTk, ImageDraw
 
+
+class MaskHistory:
+    """
+    蒙版的撤销/重做栈。按 256 像素的瓦片记录：一笔涂抹只保存它碰到的瓦片在改动前后的内容 (zlib 压缩)，
+    撤销时只把这些瓦片贴回去，代价与笔画面积成正比。总占用超过 max_bytes 时丢弃最早的步骤。
+    """
+    TILE_SIZE = 256
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.undo_stack = []  # 每一步: [(瓦片区域, 改动前, 改动后), ...]
+        self.redo_stack = []
+        self.stroke = None    # 笔画进行中: 瓦片区域 -> 改动前的压缩数据
+
+    def clear(self):
+        self.undo_stack, self.redo_stack, self.stroke = [], [], None
+
+    def record(self, mask, bbox):
+        """在修改 bbox 区域之前调用，保存其中尚未记录的瓦片。"""
+        if self.stroke is None:
+            self.stroke = {}
+        t = self.TILE_SIZE
+        w, h = mask.size
+        x0, y0 = max(0, int(bbox[0])) // t, max(0, int(bbox[1])) // t
+        x1, y1 = min(w - 1, int(bbox[2])) // t, min(h - 1, int(bbox[3])) // t
+        for ty in range(y0, y1 + 1):
+            for tx in range(x0, x1 + 1):
+                box = (tx * t, ty * t, min(w, (tx + 1) * t), min(h, (ty + 1) * t))
+                if box not in self.stroke:
+                    self.stroke[box] = self._pack(mask, box)
+
+    def commit(self, mask):
+        """结束一笔，保存改动后的瓦片。"""
+        stroke, self.stroke = self.stroke, None
+        if not stroke: return
+        step = [(box, before, self._pack(mask, box)) for box, before in stroke.items()]
+        step = [change for change in step if change[1] != change[2]]
+        if not step: return
+        self.redo_stack.clear()
+        self.undo_stack.append(step)
+        size = sum(self._size(s) for s in self.undo_stack)
+        while size > self.max_bytes and len(self.undo_stack) > 1:
+            size -= self._size(self.undo_stack.pop(0))
+
+    def undo(self, mask):
+        return self._move(mask, self.undo_stack, self.redo_stack, 1)
+
+    def redo(self, mask):
+        return self._move(mask, self.redo_stack, self.undo_stack, 2)
+
+    @staticmethod
+    def _move(mask, source, target, side):
+        if not source: return False
+        step = source.pop()
+        for change in step:
+            box = change[0]
+            mask.paste(Image.frombytes("L", (box[2] - box[0], box[3] - box[1]), zlib.decompress(change[side])), box[:2])
+        target.append(step)
+        return True
+
+    @staticmethod
+    def _pack(mask, box):
+        return zlib.compress(mask.crop(box).tobytes(), 1)
+
+    @staticmethod
+    def _size(step):
+        return sum(len(before) + len(after) for _, before, after in step)
+
+
 class ImageRestorerApp:
     def __init__(self, root):
         self.root = root
@@ -23,6 +93,7 @@ class ImageRestorerApp:
         self.brush_size = 20      # 笔刷大小
         self.scale_ratio = 1.0    # 显示缩放比例
         self.image_pos = (0, 0)   # 图片在画布上的偏移量
+        self.history = MaskHistory()  # 涂抹的撤销/重做记录
 
         # 界面布局
         self.setup_ui()
@@ -32,6 +103,9 @@ class ImageRestorerApp:
         self.canvas.bind("<Button-1>", self.paint)
         self.canvas.bind("<ButtonRelease-1>", self.on_paint_release)
         self.root.bind("<Configure>", self.on_resize)
+        self.root.bind("<Control-z>", self.undo)
+        self.root.bind("<Control-y>", self.redo)
+        self.root.bind("<Control-Shift-Z>", self.redo)
 
     def setup_ui(self):
         # 顶部控制栏
@@ -54,6 +128,12 @@ class ImageRestorerApp:
         self.btn_reset = tk.Button(self.controls_frame, text="重置涂抹", command=self.reset_mask, bg="#ffccbc")
         self.btn_reset.pack(**btn_opts)
 
+        self.btn_undo = tk.Button(self.controls_frame, text="撤销 (Ctrl+Z)", command=self.undo)
+        self.btn_undo.pack(side=tk.LEFT)
+
+        self.btn_redo = tk.Button(self.controls_frame, text="重做 (Ctrl+Y)", command=self.redo)
+        self.btn_redo.pack(side=tk.LEFT, padx=(5, 10))
+
         self.btn_save = tk.Button(self.controls_frame, text="保存结果", command=self.save_image, bg="#c8e6c9")
         self.btn_save.pack(**btn_opts)
 
@@ -98,15 +178,28 @@ class ImageRestorerApp:
         # 创建一个全黑的蒙版 (L模式)
         self.mask_image = Image.new("L", self.target_image.size, 0)
         self.draw = ImageDraw.Draw(self.mask_image)
+        self.history.clear()
         self.update_display()
 
     def reset_mask(self):
         if self.target_image:
-            self.mask_image = Image.new("L", self.target_image.size, 0)
-            self.draw = ImageDraw.Draw(self.mask_image)
+            # 重置也可以撤销：只记录涂抹过的区域
+            bbox = self.mask_image.getbbox()
+            if bbox:
+                self.history.record(self.mask_image, bbox)
+                self.mask_image.paste(0, bbox)
+                self.history.commit(self.mask_image)
             self.canvas.delete("brush_stroke")
             self.update_display()
 
+    def undo(self, event=None):
+        if self.mask_image is not None and self.history.stroke is None and self.history.undo(self.mask_image):
+            self.update_display()
+
+    def redo(self, event=None):
+        if self.mask_image is not None and self.history.stroke is None and self.history.redo(self.mask_image):
+            self.update_display()
+
     def on_resize(self, event):
         # 窗口大小改变时重新绘制
         if self.target_image:
@@ -173,10 +266,14 @@ class ImageRestorerApp:
         iy = (event.y - self.image_pos[1]) / self.scale_ratio
         
         r_real = self.brush_size / 2
-        self.draw.ellipse((ix-r_real, iy-r_real, ix+r_real, iy+r_real), fill=255, outline=255)
+        bbox = (ix-r_real, iy-r_real, ix+r_real, iy+r_real)
+        self.history.record(self.mask_image, bbox)
+        self.draw.ellipse(bbox, fill=255, outline=255)
 
     def on_paint_release(self, event):
         # 鼠标松开时，清除临时痕迹，刷新整体显示
+        if self.mask_image is not None:
+            self.history.commit(self.mask_image)
         self.canvas.delete("brush_stroke")
         self.update_display()
 